@@ -43,6 +43,7 @@ opt_params = {
     'Sequence trim length (-1 for no trimming)': ['integer', '-1'],
     'Minimum dataset-wide read threshold': ['integer', '0'],
     'Minimum per-sample read threshold': ['integer', '2'],
+    # 0 sizes them from the input and the node
     'Threads per sample': ['integer', '1'],
     'Jobs to start': ['integer', '1'],
     'Reference phylogeny for SEPP': ['choice:["Greengenes_13.8"]',
@@ -6,23 +6,50 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os import mkdir, environ
-from os.path import join, exists
+from os import (mkdir, makedirs, listdir, symlink, rename, utime,
+                getpid, stat)
+from os.path import join, exists, dirname, getsize, splitext, abspath
+from shutil import rmtree, which
+import sys
 
 from future.utils import viewitems
-from functools import partial
+from functools import partial, lru_cache
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import sha256
+from heapq import heappop, heappush
+from math import ceil
 import json
-from skbio import TreeNode
+import h5py
+from scipy.sparse import coo_matrix
 import pandas as pd
 
 from biom import Table, load_table
 from biom.util import biom_open
 from qiita_client import ArtifactInfo
-from qiita_client.util import system_call
 
 from qiita_files.demux import to_per_sample_files
 import qp_deblur
+from qp_deblur import engine as deblur_engine
+from qp_deblur.metrics import JobMetrics, disk_usage
+from qp_deblur.placements import (
+    PlacementStore, Placements, write_jplace)
+from qp_deblur.trees import (
+    fill_branch_lengths, insert_placements, load_reference_tree,
+    relabel_tree, tip_names, _load_revnamemap)
+from qp_deblur.references import (
+    DEFAULT_REFERENCE, get_reference, _reference_checksum)
+from qp_deblur.util import (
+    get_setting, file_checksum, evict_lru, object_checksum, load_manifest,
+    step_completed, record_step, available_cpus, available_memory,
+    run_command, file_lock)
+
+# the deblur version is part of the per sample cache keys
+try:
+    from deblur import __version__ as DEBLUR_VERSION
+except ImportError:
+    DEBLUR_VERSION = None
 
 
 DEBLUR_PARAMS = {
@@ -41,6 +68,141 @@ DEBLUR_PARAMS = {
     'Jobs to start': 'jobs-to-start',
     'Reference phylogeny for SEPP': 'Greengenes_13.8'}
 
+# deblur parameters that don't change the per sample results; the
+# dataset-wide read threshold is applied after merging all samples
+SAMPLE_CACHE_IGNORED_PARAMS = {'threads-per-sample', 'jobs-to-start',
+                               'min-reads'}
+
+# estimates used to size 'auto' parallelism: the peak memory of a single
+# deblur job and the number of fragments that keep a SEPP thread busy
+AUTO_DEBLUR_JOB_MEMORY = 1024 ** 3
+AUTO_SEPP_FRAGMENTS_PER_THREAD = 1000
+
+
+def _deblur_options(parameters):
+    """Translates the command's parameters to deblur workflow options
+
+    Parameters
+    ----------
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Returns
+    -------
+    OrderedDict of {str: object}
+        The deblur workflow options, sorted by option name; options left to
+        their deblur default are not included
+    """
+    translated_params = {DEBLUR_PARAMS[k]: v
+                         for k, v
+                         in parameters.items()
+                         if k != 'Reference phylogeny for SEPP'}
+    return OrderedDict((k, v) for k, v in sorted(translated_params.items())
+                       if v != 'default')
+
+
+def _use_deblur_engine():
+    """Returns whether deblur runs in-process, see QP_DEBLUR_ENGINE
+
+    Returns
+    -------
+    bool
+        True if the in-process engine is selected and the deblur library is
+        installed, otherwise the deblur command is used
+
+    Raises
+    ------
+    ValueError
+        If QP_DEBLUR_ENGINE is not 'command' or 'library'
+    """
+    engine = get_setting('ENGINE', 'command')
+    if engine not in ('command', 'library'):
+        raise ValueError("QP_DEBLUR_ENGINE should be 'command' or 'library', "
+                         "not '%s'" % engine)
+    return engine == 'library' and deblur_engine.available()
+
+
+@contextmanager
+def _no_pool():
+    """Stands in for the worker pool when the deblur command is used"""
+    yield None
+
+
+def _run_deblur(preprocessed_fp, out_dir, parameters, executor=None):
+    """Runs the deblur workflow
+
+    Parameters
+    ----------
+    preprocessed_fp : list of str
+        A list of one element with the input fastq or per-sample folder
+    out_dir : str
+        The deblur output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    executor : concurrent.futures.Executor, optional
+        The worker pool of the in-process engine, see
+        qp_deblur.engine.worker_pool. If None, the deblur command is used.
+
+    Raises
+    ------
+    ValueError
+        If there is more than 1 file passed as preprocessed_fp or deblur fails
+
+    Notes
+    -----
+    The outputs of the deblur command are logged next to out_dir, to
+    <out_dir>.deblur.stdout.log and <out_dir>.deblur.stderr.log.
+    """
+    argv = _deblur_argv(preprocessed_fp, out_dir, parameters)
+    if executor is not None:
+        deblur_engine.run_workflow(
+            preprocessed_fp[0], out_dir, _deblur_options(parameters),
+            executor)
+        return
+
+    std_out, std_err, return_value = run_command(
+        argv, '%s.deblur' % out_dir,
+        timeout=get_setting('DEBLUR_TIMEOUT', 0) or None)
+    if return_value != 0:
+        raise ValueError("Error running deblur:\nStd out: %s\nStd err: %s"
+                         % (std_out, std_err))
+
+
+def _deblur_argv(preprocessed_fp, out_dir, parameters):
+    """Generates the arguments of the deblur command
+
+    Parameters
+    ----------
+    preprocessed_fp : list of str
+        A list of one element with the input fastq or per-sample folder
+    out_dir : str
+        The deblur output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Returns
+    -------
+    list of str
+        The deblur command and its arguments, the same options as
+        generate_deblur_workflow_commands without going through a shell
+
+    Raises
+    ------
+    ValueError
+        If there is more than 1 file passed as preprocessed_fp
+    """
+    if len(preprocessed_fp) != 1:
+        raise ValueError("deblur doesn't accept more than one filepath: "
+                         "%s" % ', '.join(preprocessed_fp))
+
+    argv = ['deblur', 'workflow', '--seqs-fp', preprocessed_fp[0],
+            '--output-dir', out_dir]
+    for k, v in viewitems(_deblur_options(parameters)):
+        argv.append('--%s' % k)
+        if v is not True:
+            argv.append(str(v))
+    return argv
+
 
 def generate_deblur_workflow_commands(preprocessed_fp, out_dir, parameters):
     """Generates the deblur commands
@@ -68,73 +230,589 @@ def generate_deblur_workflow_commands(preprocessed_fp, out_dir, parameters):
         raise ValueError("deblur doesn't accept more than one filepath: "
                          "%s" % ', '.join(preprocessed_fp))
 
-    translated_params = {DEBLUR_PARAMS[k]: v
-                         for k, v
-                         in parameters.items()
-                         if k != 'Reference phylogeny for SEPP'}
-    params = OrderedDict(sorted(translated_params.items(), key=lambda t: t[0]))
     params = ['--%s "%s"' % (k, v) if v is not True else '--%s' % k
-              for k, v in viewitems(params) if v != 'default']
+              for k, v in viewitems(_deblur_options(parameters))]
     cmd = 'deblur workflow --seqs-fp "%s" --output-dir "%s" %s' % (
         preprocessed_fp[0], out_dir, ' '.join(params))
 
     return cmd
 
 
-def _reorder_fields(plcmnt, obs_order_fields, EXP_ORDER_FIELDS=[
-        'edge_num', 'likelihood', 'like_weight_ratio', 'distal_length',
-        'pendant_length']):
-    """Re-orders field information in all lines for a list of placements.
+def _partition_samples(weights, n_shards):
+    """Partitions samples into shards of similar total weight
 
     Parameters
     ----------
-    plcmnt : [[float]]
-        The original placement as a list of lists (=lines) with multiple
-        fields.
-    obs_order_fields : [str]
-        The current order of placement field information.
-    EXP_ORDER_FIELDS : [str]
-        Desired order placement field information.
+    weights : dict of {str: int}
+        The weight, e.g. the file size, of each sample keyed by sample
+    n_shards : int
+        The maximum number of shards to generate
 
     Returns
     -------
-    Reordered placement: [[float]]
+    list of list of str
+        The samples of each shard, the heaviest shard first
 
     Notes
     -----
-    We started to store placements in qiita produced by SEPP, which
-    internally used pplacer.
-    The SEPP-bundled binary of pplacer is version v1.1.alpha13-0-g1ec7786
-    and returns placements in the EXP_ORDER_FIELDS order. Later versions,
-    specifically v1.1.alpha17 produces a different field order for
-    placements! We therefore cannot combine raw placements of these
-    different versions. Therefore, we here ensure that field order of
-    placements strictly adhers to what we expect.
-
-    A placement (plcmnt) is composed of a set of
-    potential placement positions (line) and every line
-    is composed of multiple fields. For example
-    [[-24653.717, 351337, 0.14285715, 5.000002e-07, 6.113515e-06],
-    [-24653.717, 351341, 0.14285715, 5.000002e-07, 6.113515e-06],
-    [-24653.717, 348440, 0.14285715, 5.000002e-07, 6.113515e-06],
-    [-24653.717, 351336, 0.14285715, 5.000002e-07, 6.113515e-06],
-    [-24653.717, 351353, 0.14285715, 5.000002e-07, 6.113515e-06],
-    [-24653.717, 351354, 0.14285715, 5.000002e-07, 6.113515e-06],
-    [-24653.717, 351302, 0.14285715, 5.000002e-07, 6.113515e-06]]
-    We iterate through all lines and re-order the fields by
-      a) iterating over the current index of the field: i
-      b) asking which position the current index i shall have in the
-         desired field order: EXP_ORDER_FIELDS
-      c) obtaining the index of the actual index
-      d) grep the field at this latter position
+    Samples are assigned from heaviest to lightest to the currently lightest
+    shard (longest processing time first), so a few huge samples end up in
+    shards of their own instead of holding up a shard full of small ones.
     """
-    return [[line[obs_order_fields.index(EXP_ORDER_FIELDS[i])]
-             for i in range(len(line))]
-            for line in plcmnt]
+    n_shards = max(1, min(n_shards, len(weights)))
+    shards = [(0, i, []) for i in range(n_shards)]
+    for sample in sorted(weights, key=lambda s: (-weights[s], s)):
+        weight, i, samples = heappop(shards)
+        samples.append(sample)
+        heappush(shards, (weight + weights[sample], i, samples))
+
+    return [samples for _, _, samples in sorted(shards, reverse=True)
+            if samples]
+
+
+def _merge_deblur_outputs(shard_dirs, out_dir, min_reads):
+    """Merges the per shard deblur results into the final deblur results
+
+    Parameters
+    ----------
+    shard_dirs : list of str
+        The deblur output directories of the shards
+    out_dir : str
+        The directory where the merged all/reference-hit BIOM and fasta files
+        are written
+    min_reads : int
+        The minimum number of reads of a sequence across all samples, deblur's
+        --min-reads
+
+    Notes
+    -----
+    The shards are deblurred without a dataset-wide read threshold as it can
+    only be applied once all samples are combined; it is applied here the
+    same way deblur does: over the full table, then limiting the reference
+    hits to the remaining sequences and samples. Samples left empty are
+    removed from both tables.
+    """
+    if not exists(out_dir):
+        mkdir(out_dir)
+
+    tables = {}
+    for name in ('all', 'reference-hit'):
+        shard_tables = [load_table(join(sd, '%s.biom' % name))
+                        for sd in shard_dirs
+                        if exists(join(sd, '%s.biom' % name))]
+        if not shard_tables:
+            continue
+        tables[name] = shard_tables[0].concat(
+            shard_tables[1:], axis='sample')
+
+    if min_reads > 0 and 'all' in tables:
+        table = tables['all']
+        table.filter(lambda v, i, md: v.sum() >= min_reads,
+                     axis='observation', inplace=True)
+        table.remove_empty(axis='sample', inplace=True)
+        if 'reference-hit' in tables:
+            hit = tables['reference-hit']
+            hit.filter(set(hit.ids(axis='observation')) & set(
+                table.ids(axis='observation')), axis='observation')
+            hit.filter(set(hit.ids()) & set(table.ids()), axis='sample')
+            hit.remove_empty(axis='sample', inplace=True)
+
+    for name, table in tables.items():
+        with biom_open(join(out_dir, '%s.biom' % name), 'w') as f:
+            table.to_hdf5(f, 'qp-deblur generated')
+        with open(join(out_dir, '%s.seqs.fa' % name), 'w') as f:
+            for seq in table.ids(axis='observation'):
+                f.write('>%s\n%s\n' % (seq, seq))
+
+
+def _parallelism(name, value):
+    """Validates a parallelism parameter of the command
+
+    Parameters
+    ----------
+    name : str
+        The name of the parameter, 'Jobs to start' or 'Threads per sample'
+    value : int or str
+        The value of the parameter, 0 or 'auto' to size it from the input and
+        the node
+
+    Returns
+    -------
+    int or str
+        The positive number given, or 'auto'
+
+    Raises
+    ------
+    ValueError
+        If the value is neither 0, 'auto' nor a positive integer
+    """
+    text = str(value).strip()
+    if text.lower() == 'auto':
+        return 'auto'
+    try:
+        number = int(text)
+    except ValueError:
+        number = -1
+    if number == 0:
+        return 'auto'
+    if number > 0:
+        return number
+    raise ValueError("'%s' should be a positive integer, or 0 to size it "
+                     "automatically, not '%s'" % (name, value))
+
+
+def _auto_sizing(sample_sizes, cpus, memory):
+    """Sizes the parallelism of splitting and deblurring the input
+
+    Parameters
+    ----------
+    sample_sizes : dict of {str: int} or None
+        The number of reads of each sample, None if they are not known
+    cpus : int
+        The number of CPUs available to the job
+    memory : int
+        The memory available to the job in bytes
+
+    Returns
+    -------
+    dict of {str: int}
+        The number of jobs used to generate the per sample files ('split
+        jobs'), the number of deblur jobs ('deblur jobs') and the number of
+        threads of each of them ('threads per sample')
+
+    Notes
+    -----
+    Samples are deblurred in parallel, one thread each, as long as there are
+    more samples than CPUs and memory allows. If a single sample has more
+    reads than an even share of the CPUs would process, it would hold up the
+    job, so fewer jobs with more threads each are used instead.
+    """
+    jobs = max(1, min(cpus, memory // AUTO_DEBLUR_JOB_MEMORY))
+    split_jobs = cpus
+    if sample_sizes:
+        jobs = min(jobs, len(sample_sizes))
+        split_jobs = min(cpus, len(sample_sizes))
+    threads = max(1, cpus // jobs)
+    if sample_sizes and jobs > 1 and threads == 1:
+        total = sum(sample_sizes.values())
+        if max(sample_sizes.values()) * jobs > total:
+            threads = 2
+            jobs = max(1, cpus // threads)
+
+    return {'split jobs': split_jobs, 'deblur jobs': jobs,
+            'threads per sample': threads}
+
+
+def _auto_sepp_threads(n_fragments, cpus):
+    """Sizes the number of SEPP threads
+
+    Parameters
+    ----------
+    n_fragments : int
+        The number of fragments to place
+    cpus : int
+        The number of CPUs available to the job
+
+    Returns
+    -------
+    int
+        The number of threads to pass to SEPP
+    """
+    return max(1, min(cpus, int(ceil(
+        float(n_fragments) / AUTO_SEPP_FRAGMENTS_PER_THREAD))))
+
+
+def _sample_cache_key(fp, parameters):
+    """Computes the per sample cache key of a per sample file
+
+    Parameters
+    ----------
+    fp : str
+        The path to the per sample file
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Returns
+    -------
+    str
+        The hex digest of the reads and the deblur parameters
+    """
+    params = {DEBLUR_PARAMS[k]: str(v)
+              for k, v in parameters.items()
+              if k != 'Reference phylogeny for SEPP' and
+              DEBLUR_PARAMS[k] not in SAMPLE_CACHE_IGNORED_PARAMS}
+    checksum = sha256(json.dumps(
+        [DEBLUR_VERSION, sorted(params.items())]).encode())
+    return file_checksum(fp, checksum).hexdigest()
+
+
+def _load_cached_samples(split_dir, files, parameters, cache_dir):
+    """Looks up per sample files in the per sample cache
+
+    Parameters
+    ----------
+    split_dir : str
+        The directory with the per sample files
+    files : list of str
+        The per sample files to look up
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    cache_dir : str
+        The per sample cache directory
+
+    Returns
+    -------
+    dict of {str: str}, dict of {str: dict}
+        The cache key of each file and the cached results of the files that
+        are in the cache, both keyed by file
+    """
+    keys = {f: _sample_cache_key(join(split_dir, f), parameters)
+            for f in files}
+    cached = {}
+    for f, key in keys.items():
+        fp = join(cache_dir, key[:2], '%s.json' % key)
+        # other jobs can evict the entry at any time, any failure to read
+        # it is a miss
+        try:
+            with open(fp) as fh:
+                cached[f] = json.load(fh)
+            utime(fp, None)
+        except (IOError, OSError, ValueError):
+            continue
+    return keys, cached
+
+
+def _cache_sample_results(shard_dir, keys, cache_dir):
+    """Stores the per sample results of a deblurred shard in the cache
+
+    Parameters
+    ----------
+    shard_dir : str
+        The deblur output directory of the shard
+    keys : dict of {str: str}
+        The cache key of each sample of the shard, keyed by sample id
+    cache_dir : str
+        The per sample cache directory
+    """
+    fp_table = join(shard_dir, 'all.biom')
+    if not exists(fp_table):
+        return
+    table = load_table(fp_table)
+    # only store results that can be mapped back to their per sample files
+    if not set(table.ids()) <= set(keys):
+        return
+    hits = set()
+    if exists(join(shard_dir, 'reference-hit.biom')):
+        hits = set(_biom_ids(join(shard_dir, 'reference-hit.biom'),
+                             axis='observation'))
+
+    observations = table.ids(axis='observation')
+    matrix = table.matrix_data.tocsc()
+    index = {sample: i for i, sample in enumerate(table.ids())}
+    for sample, key in keys.items():
+        counts = {}
+        if sample in index:
+            col = slice(matrix.indptr[index[sample]],
+                        matrix.indptr[index[sample] + 1])
+            counts = {str(o): float(v) for o, v in zip(
+                observations[matrix.indices[col]], matrix.data[col])}
+        entry_dir = join(cache_dir, key[:2])
+        makedirs(entry_dir, exist_ok=True)
+        fp = join(entry_dir, '%s.json' % key)
+        with open('%s.%d' % (fp, getpid()), 'w') as f:
+            json.dump({'all': counts,
+                       'reference-hit': sorted(hits & set(counts))}, f)
+        rename('%s.%d' % (fp, getpid()), fp)
+
+
+def _write_cached_samples(cached, out_dir):
+    """Writes cached per sample results as deblur output tables
+
+    Parameters
+    ----------
+    cached : dict of {str: dict}
+        The cached results keyed by sample id
+    out_dir : str
+        The directory where all.biom and reference-hit.biom are written
+    """
+    if not exists(out_dir):
+        mkdir(out_dir)
+    for name in ('all', 'reference-hit'):
+        counts = {sample: {seq: entry['all'][seq] for seq in entry[name]}
+                  for sample, entry in cached.items() if entry[name]}
+        if not counts:
+            continue
+        samples = sorted(counts)
+        observations = sorted({seq for c in counts.values() for seq in c})
+        index = {seq: i for i, seq in enumerate(observations)}
+        rows, cols, data = [], [], []
+        for j, sample in enumerate(samples):
+            for seq, count in counts[sample].items():
+                rows.append(index[seq])
+                cols.append(j)
+                data.append(count)
+        table = Table(coo_matrix((data, (rows, cols)), shape=(
+            len(observations), len(samples))), observations, samples)
+        with biom_open(join(out_dir, '%s.biom' % name), 'w') as f:
+            table.to_hdf5(f, 'qp-deblur generated')
+
+
+def _demux_sample_sizes(demux_fp):
+    """Retrieves the number of reads of each sample in a demux file
+
+    Parameters
+    ----------
+    demux_fp : str
+        The path to the demux file
+
+    Returns
+    -------
+    dict of {str: int}
+        The number of reads keyed by sample
+    """
+    with h5py.File(demux_fp, 'r') as demux:
+        return {sample: demux[sample]['sequence'].shape[0]
+                for sample in demux}
+
+
+def _biom_ids(fp, axis='sample'):
+    """Retrieves the ids of a BIOM table without loading its data
+
+    Parameters
+    ----------
+    fp : str
+        The path to the BIOM table
+    axis : {'sample', 'observation'}, optional
+        The axis to retrieve the ids of
+
+    Returns
+    -------
+    list of str
+        The ids, in the order of the table
+
+    Notes
+    -----
+    Only the ids dataset of an HDF5 BIOM table is read; older, non-HDF5,
+    tables are fully loaded.
+    """
+    if not h5py.is_hdf5(fp):
+        return [str(i) for i in load_table(fp).ids(axis=axis)]
+    with h5py.File(fp, 'r') as f:
+        return [i.decode('utf-8') if isinstance(i, bytes) else i
+                for i in f[axis]['ids'][:]]
+
+
+def _deblur_shards(split_dir, out_dir, parameters, n_shards, n_workers,
+                   demux_fp=None, n_split_jobs=1, cache_dir=None,
+                   cache_size=None, executor=None):
+    """Deblurs per sample files in shards and merges the results
+
+    Parameters
+    ----------
+    split_dir : str
+        The directory with the per sample files
+    out_dir : str
+        The deblur output directory, where the merged results are written
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    n_shards : int
+        The number of shards to split the samples into
+    n_workers : int
+        The number of shards to deblur at the same time
+    demux_fp : str, optional
+        The demux file the per sample files still need to be generated from.
+        If given, each shard is handed to deblur as soon as its per sample
+        files are written to split_dir, so splitting the remaining shards
+        overlaps with deblurring the previous ones.
+    n_split_jobs : int, optional
+        The number of parallel jobs used to generate the per sample files of
+        a shard; only used with demux_fp
+    cache_dir : str, optional
+        The per sample cache directory. If given, per sample files whose
+        reads were already deblurred with the same parameters are taken from
+        the cache instead of being deblurred again, and the results of the
+        other ones are added to it.
+    cache_size : int, optional
+        The maximum size of cache_dir in bytes, the least recently used
+        entries are removed once it is exceeded
+    executor : concurrent.futures.Executor, optional
+        The worker pool of the in-process engine, shared by all the shards.
+        If None, each shard runs the deblur command.
+
+    Raises
+    ------
+    ValueError
+        If any of the deblur runs fails, in which case the outputs of the
+        other shards, and the per sample files generated from demux_fp, are
+        removed
+    """
+    keys = {}
+    cached = {}
+    if demux_fp is None:
+        files = listdir(split_dir)
+        if cache_dir is not None:
+            keys, cached = _load_cached_samples(
+                split_dir, files, parameters, cache_dir)
+        shards = _partition_samples(
+            {f: getsize(join(split_dir, f)) for f in files if f not in cached},
+            n_shards)
+    else:
+        shards = _partition_samples(_demux_sample_sizes(demux_fp), n_shards)
+
+    # every shard runs on a single job, parallelism comes from running
+    # several shards at the same time; the dataset-wide read threshold is
+    # applied when merging
+    shard_params = dict(parameters)
+    shard_params['Jobs to start'] = 1
+    shard_params['Minimum dataset-wide read threshold'] = 0
+
+    shards_dir = join(dirname(out_dir), 'shards')
+    if not exists(shards_dir):
+        mkdir(shards_dir)
+    if executor is not None:
+        # the filtering databases are indexed once for all the shards
+        index_dir = join(shards_dir, 'index')
+        if not exists(index_dir):
+            mkdir(index_dir)
+        options = deblur_engine.index_databases(
+            _deblur_options(shard_params), index_dir)
+        shard_params['Indexed positive filtering database'] = options[
+            'pos-ref-db-fp']
+        shard_params['Indexed negative filtering database'] = options[
+            'neg-ref-db-fp']
+    shard_dirs = []
+    shard_files = []
+    futures = []
+    try:
+        # each worker thread only waits on its own deblur run
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as threads:
+            for i, shard in enumerate(shards):
+                if demux_fp is not None:
+                    # a failed shard fails the job, so the remaining shards
+                    # are not split anymore
+                    if any(f.done() and f.exception() is not None
+                           for f in futures):
+                        break
+                    # the per sample file names are defined by qiita_files, so
+                    # the files of this shard are the ones that are new in
+                    # split_dir after splitting its samples
+                    known = set(listdir(split_dir))
+                    to_per_sample_files(demux_fp, samples=shard,
+                                        out_dir=split_dir, n_jobs=n_split_jobs)
+                    shard = sorted(set(listdir(split_dir)) - known)
+                    if cache_dir is not None:
+                        shard_keys, shard_cached = _load_cached_samples(
+                            split_dir, shard, parameters, cache_dir)
+                        keys.update(shard_keys)
+                        cached.update(shard_cached)
+                        shard = [f for f in shard if f not in shard_cached]
+                    if not shard:
+                        continue
+                shard_dir = join(shards_dir, 'shard_%d' % i)
+                if not exists(shard_dir):
+                    mkdir(shard_dir)
+                for f in shard:
+                    if not exists(join(shard_dir, f)):
+                        symlink(join(split_dir, f), join(shard_dir, f))
+                shard_dirs.append(join(shards_dir, 'shard_%d_out' % i))
+                shard_files.append(shard)
+                futures.append(threads.submit(
+                    _run_deblur, [shard_dir], shard_dirs[-1], shard_params,
+                    executor))
+
+        for future in futures:
+            future.result()
+    except ValueError:
+        # the work of the other shards is of no use without the failed one,
+        # and the per sample files of a pipeline are not reused either
+        rmtree(shards_dir, ignore_errors=True)
+        if demux_fp is not None:
+            rmtree(split_dir, ignore_errors=True)
+        raise
+
+    if cache_dir is not None:
+        # deblur names the samples after their per sample files
+        for shard_dir, files in zip(shard_dirs, shard_files):
+            _cache_sample_results(
+                shard_dir, {splitext(f)[0]: keys[f] for f in files},
+                cache_dir)
+        if cached:
+            shard_dirs.append(join(shards_dir, 'cached'))
+            _write_cached_samples(
+                {splitext(f)[0]: entry for f, entry in cached.items()},
+                shard_dirs[-1])
+        evict_lru(cache_dir, cache_size)
+
+    _merge_deblur_outputs(
+        shard_dirs, out_dir,
+        int(parameters['Minimum dataset-wide read threshold']))
+
+
+def _sepp_reference_package(reference_phylogeny, reference_alignment,
+                            cache_dir):
+    """Returns the reference package of a SEPP reference, building it once
+
+    Parameters
+    ----------
+    reference_phylogeny : str
+        A filepath to the reference phylogeny
+    reference_alignment : str
+        A filepath to the reference alignment
+    cache_dir : str
+        The reference package cache directory
+
+    Returns
+    -------
+    str
+        The filepath of the RAxML info file of the reference
+
+    Raises
+    ------
+    ValueError
+        If RAxML fails to estimate the model of the reference
+
+    Notes
+    -----
+    Without an info file run-sepp.sh estimates the model parameters of a
+    custom reference for every set of fragments it places. The packages are
+    keyed by the checksum of the reference files, and built under a lock, so
+    the jobs of a node only build a package once.
+    """
+    key = _reference_checksum(reference_alignment, reference_phylogeny)
+    package_dir = join(cache_dir, key)
+    fp_info = join(package_dir, 'RAxML_info.reference')
+    if exists(fp_info):
+        return fp_info
+
+    makedirs(cache_dir, exist_ok=True)
+    with file_lock(join(cache_dir, '%s.lock' % key)):
+        # another job built it while this one waited on the lock
+        if exists(fp_info):
+            return fp_info
+        build_dir = '%s.%d.tmp' % (package_dir, getpid())
+        if exists(build_dir):
+            rmtree(build_dir)
+        mkdir(build_dir)
+        std_out, std_err, return_value = run_command(
+            ['raxmlHPC', '-f', 'e', '-m', 'GTRGAMMA', '-n', 'reference',
+             '-t', abspath(reference_phylogeny),
+             '-s', abspath(reference_alignment), '-w', abspath(build_dir)],
+            join(build_dir, 'raxml'), cwd=build_dir,
+            timeout=get_setting('SEPP_TIMEOUT', 0) or None)
+        if return_value != 0 or not exists(
+                join(build_dir, 'RAxML_info.reference')):
+            rmtree(build_dir)
+            raise ValueError("Error running raxmlHPC:\nStd out: %s\n"
+                             "Std err: %s" % (std_out, std_err))
+        # the package only shows up once it is complete
+        rename(build_dir, package_dir)
+    return fp_info
 
 
 def generate_sepp_placements(seqs, out_dir, threads, reference_phylogeny=None,
-                             reference_alignment=None):
+                             reference_alignment=None, batch_size=None,
+                             n_workers=1, retries=1, store=None,
+                             reference_cache=None, metrics=None):
     """Generates the SEPP commands
 
     Parameters
@@ -151,11 +829,31 @@ def generate_sepp_placements(seqs, out_dir, threads, reference_phylogeny=None,
     reference_alignment : str, optional
         A filepath to an alternative reference alignment for SEPP.
         If None, default alignment (Greengenes 13.8 99% id) is used.
+    batch_size : int, optional
+        If given, the seqs are split into batches of about batch_size seqs
+        of similar total length, each placed by its own SEPP run in a
+        sepp_batch_<i> directory of out_dir
+    n_workers : int, optional
+        The number of batches to place at the same time, threads are divided
+        among them
+    retries : int, optional
+        The number of times a failing batch is run again
+    store : qp_deblur.placements.PlacementStore, optional
+        The local placement store of the reference. Seqs found in it aren't
+        placed again, and the placements of the other ones, including the
+        rejected ones, are added to it.
+    reference_cache : str, optional
+        The reference package cache directory, see _sepp_reference_package.
+        Only used with an alternative reference phylogeny and alignment, the
+        default one ships with its package.
+    metrics : qp_deblur.metrics.JobMetrics, optional
+        Collects the number of SEPP runs in placement-only mode, or the time
+        the other runs spent building an insertion tree.
 
     Returns
     -------
-    dict of strings
-        keys are the seqs, values are the new placements as JSON strings
+    qp_deblur.placements.Placements
+        The placements of the seqs rejected by SEPP are not included
 
     Raises
     ------
@@ -163,47 +861,176 @@ def generate_sepp_placements(seqs, out_dir, threads, reference_phylogeny=None,
         If run-sepp.sh does not produce expected file placements.json which is
         an indicator that something failed.
     """
-    # return an empty dict if no sequences have been passed to the function
+    if store is not None:
+        stored = store.get(seqs)
+        missing = [seq for seq in seqs if seq not in stored]
+        placements = generate_sepp_placements(
+            missing, out_dir, threads, reference_phylogeny=reference_phylogeny,
+            reference_alignment=reference_alignment, batch_size=batch_size,
+            n_workers=n_workers, retries=retries,
+            reference_cache=reference_cache, metrics=metrics)
+        # rejected seqs are stored as well, so they aren't placed again
+        store.put({seq: placements.to_json(seq) if seq in placements
+                   else '' for seq in missing})
+        return Placements.concat([Placements.from_dict(stored), placements])
+
+    # return no placements if no sequences have been passed to the function
     if len(seqs) < 1:
-        return {}
+        return Placements.from_dict({})
 
-    # Create a multiple fasta file for all input seqs
-    file_input = "%s/input.fasta" % out_dir
+    reference_info = None
+    if reference_cache is not None and reference_phylogeny is not None \
+            and reference_alignment is not None:
+        try:
+            reference_info = _sepp_reference_package(
+                reference_phylogeny, reference_alignment, reference_cache)
+        except ValueError:
+            # run-sepp.sh estimates the model itself
+            reference_info = None
+
+    if batch_size is None or len(seqs) <= batch_size:
+        return _run_sepp(seqs, out_dir, threads, reference_phylogeny,
+                         reference_alignment, reference_info, metrics)
+
+    batches = _partition_samples({seq: len(seq) for seq in seqs},
+                                 int(ceil(len(seqs) / float(batch_size))))
+    n_workers = max(1, min(n_workers, len(batches)))
+    batch_threads = max(1, int(threads) // n_workers)
+
+    def run_batch(i):
+        batch_dir = join(out_dir, 'sepp_batch_%d' % i)
+        # a retried batch starts from a clean directory
+        if exists(batch_dir):
+            rmtree(batch_dir)
+        mkdir(batch_dir)
+        return _run_sepp(batches[i], batch_dir, batch_threads,
+                         reference_phylogeny, reference_alignment,
+                         reference_info, metrics)
+
+    parts = []
+    pending = list(range(len(batches)))
+    # each worker thread only waits on the SEPP run of its batch; only the
+    # batches that failed are run again
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for attempt in range(max(0, retries) + 1):
+            futures = [(i, executor.submit(run_batch, i)) for i in pending]
+            pending = []
+            for i, future in futures:
+                try:
+                    parts.append(future.result())
+                except ValueError as e:
+                    error = e
+                    pending.append(i)
+            if not pending:
+                break
+    if pending:
+        raise error
+
+    return Placements.concat(parts)
+
+
+@lru_cache(maxsize=None)
+def _sepp_placement_only(fp_sepp):
+    """Checks if run-sepp.sh can skip building an insertion tree
+
+    Parameters
+    ----------
+    fp_sepp : str or None
+        The path to run-sepp.sh
+
+    Returns
+    -------
+    bool
+        Whether the script has the -n option of
+        support_files/sepp/onlyplacements.patch
+    """
+    if fp_sepp is None:
+        return False
+    try:
+        with open(fp_sepp, errors='replace') as f:
+            return '--noTreeComputation' in f.read()
+    except (IOError, OSError):
+        return False
+
+
+def _run_sepp(seqs, out_dir, threads, reference_phylogeny=None,
+              reference_alignment=None, reference_info=None, metrics=None):
+    """Runs SEPP for a list of seqs, see generate_sepp_placements
+
+    Parameters
+    ----------
+    seqs : list of str
+        A list of seqs to generate placements
+    out_dir : str
+        The directory to run SEPP in
+    threads : int
+        Number if CPU cores to use
+    reference_phylogeny : str, optional
+        A filepath to an alternative reference phylogeny for SEPP.
+    reference_alignment : str, optional
+        A filepath to an alternative reference alignment for SEPP.
+    reference_info : str, optional
+        A filepath to the RAxML info file of the alternative reference.
+    metrics : qp_deblur.metrics.JobMetrics, optional
+        Collects 'sepp placement-only runs' or, for versions of run-sepp.sh
+        that always build an insertion tree, 'sepp tree seconds'.
+
+    Returns
+    -------
+    qp_deblur.placements.Placements
+        The placements of the seqs
+
+    Raises
+    ------
+    ValueError
+        If run-sepp.sh does not produce expected file placements.json
+    """
+    # Create a multiple fasta file for all input seqs, named by their
+    # position so SEPP doesn't carry the seqs around as names as well
+    file_input = abspath("%s/input.fasta" % out_dir)
+    names = {}
     with open(file_input, 'w') as fh_input:
-        for seq in seqs:
-            fh_input.write(">%s\n%s\n" % (seq, seq))
+        for i, seq in enumerate(seqs):
+            names[str(i)] = seq
+            fh_input.write(">%d\n%s\n" % (i, seq))
 
-    # execute SEPP
+    # execute SEPP, which writes its output into its working directory
     run_name = 'qiita'
-    param_phylogeny = ''
+    cmd = ['run-sepp.sh', file_input, run_name, '-x', str(threads)]
     if reference_phylogeny is not None:
-        param_phylogeny = ' -t %s ' % reference_phylogeny
-    param_alignment = ''
+        cmd.extend(['-t', reference_phylogeny])
     if reference_alignment is not None:
-        param_alignment = ' -a %s ' % reference_alignment
-    # SEPP writes output into the current working directory (cwd), therefore
-    # we here first need to store the cwd, then move into the output directory,
-    # perform SEPP and move back to the stored cwd for a clean state
-    curr_pwd = environ['PWD']
-    std_out, std_err, return_value = system_call(
-        'cd %s && run-sepp.sh %s %s -x %s %s %s; cd %s' %
-        (out_dir, file_input, run_name, threads,
-         param_phylogeny, param_alignment, curr_pwd))
+        cmd.extend(['-a', reference_alignment])
+    if reference_info is not None:
+        cmd.extend(['-r', reference_info])
+    # the insertion tree is built by generate_insertion_trees, so SEPP only
+    # needs to build one if it can't be told not to
+    placement_only = _sepp_placement_only(which('run-sepp.sh'))
+    if placement_only:
+        cmd.extend(['-n', '1'])
+    std_out, std_err, return_value = run_command(
+        cmd, join(out_dir, 'run-sepp'), cwd=out_dir,
+        timeout=get_setting('SEPP_TIMEOUT', 0) or None)
 
     # parse placements from SEPP results
     file_placements = '%s/%s_placement.json' % (out_dir, run_name)
-    if exists(file_placements):
-        with open(file_placements, 'r') as fh_placements:
-            plcmnts = json.loads(fh_placements.read())
-            obs_order_fields = plcmnts['fields']
-            return {seqlbl[0]: _reorder_fields(p['p'], obs_order_fields)
-                    for p in plcmnts['placements']
-                    for seqlbl in p['nm']}
+    if return_value == 0 and exists(file_placements):
+        if metrics is not None:
+            file_tree = '%s/%s_placement.tog.relabelled.xml' % (
+                out_dir, run_name)
+            if placement_only:
+                metrics.add('sepp placement-only runs', 1)
+            elif exists(file_tree):
+                # run-sepp.sh copies the placements before running guppy
+                metrics.add('sepp tree seconds', max(
+                    0.0, stat(file_tree).st_mtime -
+                    stat(file_placements).st_mtime))
+        # the placements are decoded one at a time into an array with its
+        # fields in the order of PLACEMENT_FIELDS
+        return Placements.from_jplace(file_placements, names=names)
     else:
-        # due to the wrapper style of run-sepp.sh the actual exit code is never
-        # returned and we have no way of finding out which sub-command failed
-        # Therefore, we can only assume that something went wrong by not
-        # observing the expected output file.
+        # run-sepp.sh is a wrapper, so neither its exit code nor its output
+        # tell which sub-command failed.
         # If the main SEPP program fails, it reports some information in two
         # files, the content of which we can read and report
         file_stderr = '%s/sepp-%s-err.log' % (out_dir, run_name)
@@ -214,95 +1041,86 @@ def generate_sepp_placements(seqs, out_dir, threads, reference_phylogeny=None,
         if exists(file_stdout):
             with open(file_stdout, 'r') as fh_stdout:
                 std_out = fh_stdout.readlines()
-        error_msg = ("Error running run-sepp.sh:\nStd out: %s\nStd err: %s"
-                     % (std_out, std_err))
+        error_msg = ("Error running run-sepp.sh (exit code %s):\nStd out: %s\n"
+                     "Std err: %s" % (return_value, std_out, std_err))
         raise ValueError(error_msg)
 
 
-def _generate_template_rename(file_reference_phylogeny,
-                              file_reference_alignment,
-                              out_dir):
-    """Produces placement template and rename script for reference phylogeny.
+def _use_guppy():
+    """Returns whether guppy inserts the placements, see QP_DEBLUR_TREE_ENGINE
+
+    Returns
+    -------
+    bool
+        True if 'guppy tog' is selected, False for qp_deblur.trees
+
+    Raises
+    ------
+    ValueError
+        If QP_DEBLUR_TREE_ENGINE is not 'native' or 'guppy'
+    """
+    engine = get_setting('TREE_ENGINE', 'native')
+    if engine not in ('native', 'guppy'):
+        raise ValueError("QP_DEBLUR_TREE_ENGINE should be 'native' or "
+                         "'guppy', not '%s'" % engine)
+    return engine == 'guppy'
+
+
+def _run_guppy(placements, file_ref_template, file_tree_escaped, out_dir,
+               metrics):
+    """Inserts placements into a reference with guppy tog
 
     Parameters
     ----------
-    file_reference_phylogeny : str
-        A filepath to an alternative reference phylogeny for SEPP.
-    file_reference_alignment : str
-        A filepath to an alternative reference alignment for SEPP.
+    placements : qp_deblur.placements.Placements or dict
+        The placements, see generate_insertion_trees
+    file_ref_template : str
+        Filepath to the reference placement json file
+    file_tree_escaped : str
+        Filepath of the insertion tree, with the names escaped for guppy
     out_dir : str
         The job output directory
-
-    Returns
-    -------
-    (str, str) : Filepaths of reference_template json file and
-    reference_rename python script.
+    metrics : qp_deblur.metrics.JobMetrics
+        Collects the timing of the guppy phase
 
     Raises
     ------
     ValueError
-        If a) the given out_dir directory does not exist.
-        b) the given reference phylogeny or alignment does not exist.
-        c) the run-sepp.sh wrapper script fails for any reason.
-
-    Notes
-    -----
-    This function only needs to be called once per reference phylogeny/
-    alignment, i.e. if we update Greengenes or extend SEPP for Silva or other
-    reference phylogenies. I am including this function for easier maintenance
-    in the future.
+        If the guppy binary exits with non-zero return code
     """
-    if not exists(out_dir):
-        raise ValueError("Output directory '%s' does not exist!" % out_dir)
-    if not exists(file_reference_phylogeny):
-        raise ValueError("Reference phylogeny file '%s' does not exits!" %
-                         file_reference_phylogeny)
-    if not exists(file_reference_alignment):
-        raise ValueError("Reference alignment file '%s' does not exits!" %
-                         file_reference_alignment)
-
-    # create a dummy sequence input file
-    file_input = '%s/input.fasta' % out_dir
-    with open(file_input, 'w') as f:
-        f.write('>dummySeq\n')
-        f.write('TACGTAGGGGGCAAGCGTTATCCGGATTTACTGGGTGTAAAGGGAGCGTAGACGGATGGA'
-                'CAAGTCTGATGTGAAAGGCTGGGGCCCAACCCCGGGACTGCATTGGAAACTGCCCGTCTT'
-                'GAGTG\n')
-    std_out, std_err, return_value = system_call(
-        'cd %s; run-sepp.sh %s dummy -x 1 -a %s -t %s' %
-        (out_dir, file_input, file_reference_alignment,
-         file_reference_phylogeny))
-    if return_value != 0:
-        error_msg = ("Error running SEPP:\nStd out: %s\nStd err: %s"
-                     % (std_out, std_err))
-        raise ValueError(error_msg)
-
-    # take resulting placement.json and turn it into the template by
-    # clearing the list of placements
-    file_template = '%s/tmpl_dummy_placement.json' % out_dir
-    with open('%s/dummy_placement.json' % out_dir, 'r') as f:
-        placements = json.loads(f.read())
-        placements['placements'] = []
-        with open(file_template, 'w') as fw:
-            json.dump(placements, fw)
+    # create a valid placement.json file as input for guppy
+    file_placements = '%s/placements.json' % out_dir
+    compress = get_setting('GUPPY_GZIP', False)
+    if compress:
+        file_placements += '.gz'
+    write_jplace(file_placements, file_ref_template, placements,
+                 precision=get_setting('GUPPY_PRECISION', 0) or None,
+                 compress=compress)
 
-    # Another file produced by SEPP is xxx_rename-json.py, where xxx is the
-    # name of the run, here "dummy". SEPP needs to escape node names before the
-    # reference tree is given to guppy which can only handle a limited name
-    # format. Thus, after guppy, the result needs to be back translated to
-    # original names with the rename-json.py script that is generated by SEPP.
-    return (file_template, '%s/dummy_rename-json.py' % out_dir)
+    # execute guppy
+    with metrics.phase('guppy', [file_placements]) as record:
+        std_out, std_err, return_value = run_command(
+            ['guppy', 'tog', file_placements, '-o', file_tree_escaped],
+            join(out_dir, 'guppy'),
+            timeout=get_setting('GUPPY_TIMEOUT', 0) or None)
+        if return_value != 0:
+            error_msg = ("Error running guppy:\nStd out: %s\nStd err: %s"
+                         % (std_out, std_err))
+            raise ValueError(error_msg)
+        record['output_bytes'] = getsize(file_tree_escaped)
 
 
 def generate_insertion_trees(placements, out_dir,
                              reference_template=None,
-                             reference_rename=None):
+                             reference_rename=None, metrics=None,
+                             reference_revnamemap=None, previous_dir=None):
     """Generates phylogenetic trees by inserting placements into a reference
 
     Parameters
     ----------
-    placements : dict of strings
-        keys are the seqs, values are the new placements as JSON strings
+    placements : qp_deblur.placements.Placements or dict
+        The placements, or a dict where keys are the seqs and values are the
+        placements as lists or JSON strings
     out_dir : str
         The job output directory
     reference_template : str, optional
@@ -314,6 +1132,18 @@ def generate_insertion_trees(placements, out_dir,
         Similar to reference_template, but a filepath to the generated python
         renaming script to undo the name scaping post guppy.
         If None, it falls back to the Greengenes 13.8 99% reference.
+    metrics : qp_deblur.metrics.JobMetrics, optional
+        Collects the timings of the insertion (or guppy), relabel and branch
+        length phases.
+    reference_revnamemap : str, optional
+        Filepath to the name map of the reference as JSON, used to undo the
+        name escaping in-process instead of running reference_rename.
+        If None and reference_rename is None, it falls back to the
+        Greengenes 13.8 99% reference.
+    previous_dir : str, optional
+        The output directory of an earlier call for the same reference. Its
+        insertion tree is updated with the fragments that were added,
+        removed or placed differently instead of being built again.
 
     Returns
     -------
@@ -325,19 +1155,40 @@ def generate_insertion_trees(placements, out_dir,
     ValueError
         If a) the given reference_template or reference_rename files do not
         exist
-        b) or the guppy binary exits with non-zero return code
+        b) or the placements can't be inserted into the reference, e.g. the
+        guppy binary exits with non-zero return code
         c) or the given rename script exists with non-zero return code.
+
+    Notes
+    -----
+    The placements are inserted in-process by qp_deblur.trees, unless
+    QP_DEBLUR_TREE_ENGINE selects guppy. The names are relabelled in-process
+    too, unless only a rename script is known for the reference.
+
+    The in-process insertion writes insertion_tree.index.npz next to the
+    insertion tree, which is what makes it possible to update the tree in a
+    later call; the updated tree is identical to the one built from scratch.
     """
+    if metrics is None:
+        metrics = JobMetrics()
+
     # test if reference file for rename script actually exists.
     file_ref_rename = qp_deblur.get_data(
         join('sepp', 'tmpl_gg13.8-99_rename-json.py'))
+    file_ref_revnamemap = reference_revnamemap
     if reference_rename is not None:
         file_ref_rename = reference_rename
+    elif file_ref_revnamemap is None:
+        file_ref_revnamemap = qp_deblur.get_data(
+            join('sepp', 'tmpl_gg13.8-99-revnamemap.json'))
     if not exists(file_ref_rename):
         raise ValueError("Reference rename script '%s' does not exits!" %
                          file_ref_rename)
+    if file_ref_revnamemap is not None and not exists(file_ref_revnamemap):
+        raise ValueError("Reference name map '%s' does not exits!" %
+                         file_ref_revnamemap)
 
-    # create a valid placement.json file as input for guppy
+    # test if the placement template of the reference actually exists
     file_ref_template = qp_deblur.get_data(
         join('sepp', 'tmpl_gg13.8-99_placement.json'))
     if reference_template is not None:
@@ -345,45 +1196,54 @@ def generate_insertion_trees(placements, out_dir,
     if not exists(file_ref_template):
         raise ValueError("Reference template '%s' does not exits!" %
                          file_ref_template)
-    with open(file_ref_template, 'r') as f:
-        plcmnts = json.loads(f.read())
 
-    plcmnts['placements'].extend(
-        [{'p': placement, 'nm': [[sequence, 1]]}
-         for sequence, placement
-         in placements.items()])
-
-    file_placements = '%s/placements.json' % out_dir
-    with open(file_placements, 'w') as f:
-        json.dump(plcmnts, f)
-
-    # execute guppy
+    # insert the placements into the reference tree
     file_tree_escaped = join(out_dir, 'insertion_tree.tre')
-    std_out, std_err, return_value = system_call(
-        'guppy tog %s -o %s' % (file_placements, file_tree_escaped))
-    if return_value != 0:
-        error_msg = ("Error running guppy:\nStd out: %s\nStd err: %s"
-                     % (std_out, std_err))
-        raise ValueError(error_msg)
+    if _use_guppy():
+        _run_guppy(placements, file_ref_template, file_tree_escaped, out_dir,
+                   metrics)
+    else:
+        with metrics.phase('insertion', [file_ref_template]) as record:
+            if not isinstance(placements, Placements):
+                placements = Placements.from_dict(placements)
+            previous = None
+            if previous_dir is not None:
+                previous = (join(previous_dir, 'insertion_tree.tre'),
+                            join(previous_dir, 'insertion_tree.index.npz'))
+            updated = insert_placements(
+                file_ref_template, placements, file_tree_escaped,
+                fp_index=join(out_dir, 'insertion_tree.index.npz'),
+                previous=previous)
+            record['output_bytes'] = getsize(file_tree_escaped)
+        metrics.count('insertion tree updates', int(updated))
 
     # execute node name re-labeling (to revert the escaping of names necessary
     # for guppy)
     file_tree = join(out_dir, 'insertion_tree.relabelled.tre')
-    std_out, std_err, return_value = system_call(
-        'cat %s | python %s > %s' %
-        (file_tree_escaped, file_ref_rename, file_tree))
-    if return_value != 0:
-        error_msg = (("Error running %s:\n"
-                      "Std out: %s\nStd err: %s")
-                     % (file_ref_rename, std_out, std_err))
-        raise ValueError(error_msg)
+    with metrics.phase('relabel', [file_tree_escaped]) as record:
+        if file_ref_revnamemap is not None:
+            relabel_tree(file_tree_escaped, file_tree, file_ref_revnamemap)
+        else:
+            with open(file_tree_escaped) as f_in, \
+                    open(file_tree, 'w') as f_out:
+                std_out, std_err, return_value = run_command(
+                    [sys.executable, file_ref_rename],
+                    join(out_dir, 'relabel'),
+                    timeout=get_setting('RELABEL_TIMEOUT', 0) or None,
+                    stdin=f_in, stdout=f_out)
+            if return_value != 0:
+                error_msg = (("Error running %s:\n"
+                              "Std out: %s\nStd err: %s")
+                             % (file_ref_rename, std_out, std_err))
+                raise ValueError(error_msg)
+        record['output_bytes'] = getsize(file_tree)
 
     # making sure that all branches in the generated tree have branch lenghts
-    tree = TreeNode.read(file_tree)
-    for node in tree.preorder(include_self=False):
-        if node.length is None:
-            node.length = 0.0
-    tree.write(file_tree)
+    with metrics.phase('branch length fix', [file_tree]) as record:
+        file_tree_filled = join(out_dir, 'insertion_tree.filled.tre')
+        fill_branch_lengths(file_tree, file_tree_filled)
+        rename(file_tree_filled, file_tree)
+        record['output_bytes'] = getsize(file_tree)
 
     return file_tree
 
@@ -412,7 +1272,33 @@ def deblur(qclient, job_id, parameters, out_dir):
     The code will check if the artifact has a preprocessed_demux element, if
     not it will use the preprocessed_fastq. We prefer to work with the
     preprocessed_demux as running time will be greatly improved
+
+    The wall and CPU time, and the input and output size of each phase of the
+    job are written to metrics.json and metrics.prom in out_dir.
+    """
+    metrics = JobMetrics(job_id)
+    try:
+        return _deblur(qclient, job_id, parameters, out_dir, metrics)
+    finally:
+        metrics.write(out_dir)
+
+
+def _deblur(qclient, job_id, parameters, out_dir, metrics):
+    """Runs deblur, see deblur
+
+    Parameters
+    ----------
+    qclient, job_id, parameters, out_dir
+        See deblur
+    metrics : qp_deblur.metrics.JobMetrics
+        Collects the timings and counters of the phases of the job
     """
+    # completed steps of a previous run of this job are skipped if their
+    # inputs didn't change and the files they produced are intact
+    fp_manifest = join(out_dir, 'step_manifest.json')
+    manifest = load_manifest(fp_manifest)
+    fp_sizing = join(out_dir, 'auto_sizing.json')
+    fp_deblur_log = join(out_dir, 'deblur.log')
     out_dir = join(out_dir, 'deblur_out')
     # Step 1 get the rest of the information need to run deblur
     qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
@@ -426,9 +1312,11 @@ def deblur(qclient, job_id, parameters, out_dir):
            for k, v in artifact_info['files'].items()}
 
     # Getting preparation information
-    prep_info = qclient.get(
-        '/qiita_db/prep_template/%s/' % artifact_info['prep_information'][0])
-    df = pd.read_csv(prep_info['prep-file'], sep='\t')
+    with metrics.phase('prep validation') as record:
+        prep_info = qclient.get('/qiita_db/prep_template/%s/'
+                                % artifact_info['prep_information'][0])
+        record['input_bytes'] = disk_usage([prep_info['prep-file']])
+        df = pd.read_csv(prep_info['prep-file'], sep='\t')
     if prep_info['data_type'] not in {'16S', '18S', 'ITS'}:
         error_msg = ('deblur was developed only for amplicon sequencing data')
         return False, None, error_msg
@@ -442,6 +1330,44 @@ def deblur(qclient, job_id, parameters, out_dir):
                      ', '.join(sorted(df.platform.unique())))
         return False, None, error_msg
 
+    input_type = ('preprocessed_demux' if 'preprocessed_demux' in fps
+                  else 'preprocessed_fastq')
+    inputs = {'input': object_checksum(
+        [file_checksum(fp).hexdigest() for fp in fps[input_type]])}
+    deblur_inputs = {'input': inputs['input'],
+                     'parameters': object_checksum(parameters)}
+    deblur_completed = step_completed(manifest, 'deblur', deblur_inputs)
+
+    # 'auto' parallelism is sized from the input and the resources of the
+    # node; the chosen values are kept in the job directory
+    try:
+        for name in ('Jobs to start', 'Threads per sample'):
+            parameters[name] = _parallelism(name, parameters[name])
+    except ValueError as e:
+        return False, None, str(e)
+    auto_jobs = parameters['Jobs to start'] == 'auto'
+    auto_threads = parameters['Threads per sample'] == 'auto'
+    split_jobs = 1
+    if auto_jobs or auto_threads:
+        sizing = _auto_sizing(
+            _demux_sample_sizes(fps['preprocessed_demux'][0])
+            if 'preprocessed_demux' in fps else None,
+            available_cpus(), available_memory())
+        if auto_jobs:
+            parameters['Jobs to start'] = sizing['deblur jobs']
+            split_jobs = sizing['split jobs']
+        if auto_threads:
+            parameters['Threads per sample'] = sizing['threads per sample']
+        with open(fp_sizing, 'w') as f:
+            json.dump(sizing, f)
+        qclient.update_job_step(
+            job_id, "Step 1 of 4: Using %s deblur jobs with %s threads per "
+            "sample" % (parameters['Jobs to start'],
+                        parameters['Threads per sample']))
+    if not auto_jobs:
+        split_jobs = int(parameters['Jobs to start'])
+    n_jobs = int(parameters['Jobs to start'])
+
     # Step 2 generating command deblur
     if 'preprocessed_demux' in fps:
         qclient.update_job_step(job_id, "Step 2 of 4: Generating per sample "
@@ -450,33 +1376,88 @@ def deblur(qclient, job_id, parameters, out_dir):
         if not exists(out_dir):
             mkdir(out_dir)
         split_out_dir = join(out_dir, 'split')
-        if not exists(split_out_dir):
-            mkdir(split_out_dir)
 
-        # using the same number of parallel jobs as defined by the command
-        n_jobs = int(parameters['Jobs to start'])
-        # [0] cause there should be only 1 file
-        to_per_sample_files(fps['preprocessed_demux'][0],
-                            out_dir=split_out_dir, n_jobs=n_jobs)
+        # with more than one shard the per sample files are deblurred by
+        # several independent deblur runs, which are merged afterwards;
+        # pipelining splits each shard right before handing it to deblur
+        n_shards = get_setting('SHARDS', 0)
+        pipeline = n_shards > 1 and get_setting('PIPELINE', False)
+        # the per sample cache works on the shards, a single shard is used if
+        # sharding isn't enabled
+        cache_dir = get_setting('CACHE_DIR', None)
+        if cache_dir is not None:
+            makedirs(cache_dir, exist_ok=True)
+            n_shards = max(n_shards, 1)
+        if not (pipeline or deblur_completed or
+                step_completed(manifest, 'split', inputs)):
+            # remove any per sample files of a previous incomplete run
+            if exists(split_out_dir):
+                rmtree(split_out_dir)
+            mkdir(split_out_dir)
+            with metrics.phase('split', fps['preprocessed_demux']) as record:
+                # [0] cause there should be only 1 file
+                to_per_sample_files(fps['preprocessed_demux'][0],
+                                    out_dir=split_out_dir, n_jobs=split_jobs)
+                record['output_bytes'] = disk_usage([split_out_dir])
+            record_step(fp_manifest, manifest, 'split', inputs,
+                        [split_out_dir])
 
         qclient.update_job_step(job_id, "Step 2 of 4: Generating per sample "
                                 "from demux (2/2)")
         out_dir = join(out_dir, 'deblured')
-        cmd = generate_deblur_workflow_commands([split_out_dir],
-                                                out_dir, parameters)
     else:
         qclient.update_job_step(job_id, "Step 2 of 4: Generating deblur "
                                 "command")
-        cmd = generate_deblur_workflow_commands(fps['preprocessed_fastq'],
-                                                out_dir, parameters)
+        n_shards = 0
+        pipeline = False
+        cache_dir = None
 
     # Step 3 execute deblur
-    qclient.update_job_step(job_id, "Step 3 of 4: Executing deblur job")
-    std_out, std_err, return_value = system_call(cmd)
-    if return_value != 0:
-        error_msg = ("Error running deblur:\nStd out: %s\nStd err: %s"
-                     % (std_out, std_err))
-        return False, None, error_msg
+    if deblur_completed:
+        qclient.update_job_step(job_id, "Step 3 of 4: Reusing deblur results "
+                                "of a previous run")
+    else:
+        qclient.update_job_step(job_id, "Step 3 of 4: Executing deblur job")
+        # deblur needs a clean output directory, so anything a previous
+        # incomplete run left behind is removed
+        stale = [out_dir]
+        if 'preprocessed_demux' in fps:
+            stale.append(join(dirname(out_dir), 'shards'))
+            if pipeline:
+                stale.append(split_out_dir)
+        for fp in stale:
+            if exists(fp):
+                rmtree(fp)
+        if pipeline:
+            mkdir(split_out_dir)
+
+        # the in-process engine deblurs the samples in a pool of worker
+        # processes and logs their progress to the job directory
+        try:
+            pool = (deblur_engine.worker_pool(n_jobs, fp_deblur_log)
+                    if _use_deblur_engine() else _no_pool())
+        except ValueError as e:
+            return False, None, str(e)
+
+        deblur_in = (fps['preprocessed_demux'] if pipeline
+                     else [split_out_dir] if 'preprocessed_demux' in fps
+                     else fps['preprocessed_fastq'])
+        with metrics.phase('deblur', deblur_in) as record, pool as executor:
+            try:
+                if n_shards > 1 or cache_dir is not None:
+                    _deblur_shards(
+                        split_out_dir, out_dir, parameters, n_shards, n_jobs,
+                        demux_fp=(fps['preprocessed_demux'][0] if pipeline
+                                  else None),
+                        n_split_jobs=split_jobs, cache_dir=cache_dir,
+                        cache_size=get_setting(
+                            'CACHE_SIZE', 10240) * 1024 * 1024,
+                        executor=executor)
+                else:
+                    _run_deblur(deblur_in, out_dir, parameters, executor)
+            except ValueError as e:
+                return False, None, str(e)
+            record['output_bytes'] = disk_usage([out_dir])
 
     # Generating artifact
     pb = partial(join, out_dir)
@@ -499,53 +1480,106 @@ def deblur(qclient, job_id, parameters, out_dir):
         with open(final_seqs_hit, 'w') as f:
             f.write("")
 
+    if not deblur_completed:
+        record_step(fp_manifest, manifest, 'deblur', deblur_inputs,
+                    [final_biom, final_seqs, final_biom_hit, final_seqs_hit])
+
     # Step 4, communicate with archive to check and generate placements
     qclient.update_job_step(job_id, "Step 4 of 4 (1/4): Retrieving "
                             "observations information")
-    features = list(load_table(final_biom_hit).ids(axis='observation'))
+    with metrics.phase('features load', [final_biom_hit]):
+        features = _biom_ids(final_biom_hit, axis='observation')
+    metrics.count('samples', len(_biom_ids(final_biom_hit)))
+    metrics.count('features', len(features))
 
     fp_phylogeny = None
     if features:
-        observations = qclient.post(
-            "/qiita_db/archive/observations/", data={'job_id': job_id,
-                                                     'features': features})
+        # the reference name is translated into the filepaths of the
+        # reference alignment and tree; if they are None the Greengenes 13.8
+        # reference shipped with the fragment-insertion conda package is used
+        try:
+            sepp_reference = get_reference(parameters.get(
+                'Reference phylogeny for SEPP', DEFAULT_REFERENCE))
+            fp_reference_template = sepp_reference.template
+            fp_reference_rename = sepp_reference.rename
+            fp_reference_revnamemap = sepp_reference.revnamemap
+        except ValueError as e:
+            return False, None, str(e)
+        fp_reference_alignment = sepp_reference.alignment
+        fp_reference_phylogeny = sepp_reference.phylogeny
+        reference = sepp_reference.checksum
+
+        # the local placement store is read before the archive, and the
+        # placements found in the archive, or added to it, are stored
+        store = None
+        fp_store = get_setting('PLACEMENT_CACHE', None)
+        if fp_store is not None:
+            store = PlacementStore(
+                fp_store, reference,
+                get_setting('PLACEMENT_CACHE_SIZE', 1024) * 1024 * 1024)
+        with metrics.phase('archive lookup'):
+            observations = store.get(features) if store is not None else {}
+            missing = [f for f in features if f not in observations]
+            if missing:
+                archived = qclient.post(
+                    "/qiita_db/archive/observations/",
+                    data={'job_id': job_id, 'features': missing})
+                if store is not None and archived:
+                    store.put(archived)
+                observations.update(archived)
+        metrics.count('stored fragments', len(features) - len(missing))
         novel_fragments = list(set(features) - set(observations.keys()))
+        metrics.count('novel fragments', len(novel_fragments))
 
         qclient.update_job_step(job_id, "Step 4 of 4 (2/4): Generating %d new "
                                 "placements" % len(novel_fragments))
 
-        # Once we support alternative reference phylogenies for SEPP in the
-        # future, we need to translate the reference name here into
-        # filepaths pointing to the correct reference alignment and
-        # reference tree. If left 'None' the Greengenes 13.8 reference
-        # shipped with the fragment-insertion conda package will be used.
-        fp_reference_alignment = None
-        fp_reference_phylogeny = None
-        fp_reference_template = None
-        fp_reference_rename = None
-        if 'Reference phylogeny for SEPP' in parameters:
-            if parameters['Reference phylogeny for SEPP'] == 'tiny':
-                fp_reference_alignment = qp_deblur.get_data(join(
-                    'sepp', 'reference_alignment_tiny.fasta'))
-                fp_reference_phylogeny = qp_deblur.get_data(join(
-                    'sepp', 'reference_phylogeny_tiny.nwk'))
-                fp_reference_template = qp_deblur.get_data(join(
-                    'sepp', 'tmpl_tiny_placement.json'))
-                fp_reference_rename = qp_deblur.get_data(join(
-                    'sepp', 'tmpl_tiny_rename-json.py'))
-        try:
-            new_placements = generate_sepp_placements(
-                novel_fragments, out_dir, parameters['Threads per sample'],
-                reference_alignment=fp_reference_alignment,
-                reference_phylogeny=fp_reference_phylogeny)
-        except ValueError as e:
-            return False, None, str(e)
+        # the placements of the novel fragments are kept until they are
+        # archived, so a job failing in between doesn't need to rerun SEPP
+        sepp_inputs = {'fragments': object_checksum(sorted(novel_fragments)),
+                       'reference': reference}
+        fp_sepp_placements = join(out_dir, 'sepp_placements.json')
+        if step_completed(manifest, 'sepp', sepp_inputs):
+            new_placements = Placements.load(fp_sepp_placements)
+        else:
+            sepp_threads = parameters['Threads per sample']
+            if auto_threads:
+                sepp_threads = _auto_sepp_threads(
+                    len(novel_fragments), available_cpus())
+                sizing['sepp threads'] = sepp_threads
+                with open(fp_sizing, 'w') as f:
+                    json.dump(sizing, f)
+            with metrics.phase('sepp') as record:
+                try:
+                    new_placements = generate_sepp_placements(
+                        novel_fragments, out_dir, sepp_threads,
+                        reference_alignment=fp_reference_alignment,
+                        reference_phylogeny=fp_reference_phylogeny,
+                        batch_size=get_setting('SEPP_BATCH_SIZE', 0) or None,
+                        n_workers=get_setting('SEPP_WORKERS', 1),
+                        retries=get_setting('SEPP_RETRIES', 1),
+                        reference_cache=get_setting(
+                            'SEPP_REFERENCE_CACHE', None), metrics=metrics)
+                except ValueError as e:
+                    return False, None, str(e)
+                new_placements.dump(fp_sepp_placements)
+                record['output_bytes'] = getsize(fp_sepp_placements)
+            record_step(fp_manifest, manifest, 'sepp', sepp_inputs,
+                        [fp_sepp_placements])
+
+        # the tree is composed from the placements the archive already had
+        # and the new ones, so the archive is only queried once. Fragments
+        # that have been rejected by SEPP, i.e. whoes placement is the empty
+        # string, are removed and all other placements converted from
+        # string to json
+        placements = Placements.concat(
+            [Placements.from_dict(observations), new_placements])
 
         qclient.update_job_step(job_id, "Step 4 of 4 (3/4): Archiving %d "
                                 "new placements" % len(novel_fragments))
         # values needs to be json strings as well
-        for fragment in new_placements.keys():
-            new_placements[fragment] = json.dumps(new_placements[fragment])
+        new_placements = {fragment: new_placements.to_json(fragment)
+                          for fragment in new_placements}
 
         # fragments that get rejected by a SEPP run don't show up in
         # the placement file, however being rejected is a valuable
@@ -555,28 +1589,28 @@ def deblur(qclient, job_id, parameters, out_dir):
         for fragment in novel_fragments:
             if fragment not in new_placements:
                 new_placements[fragment] = ""
+        metrics.count('rejected fragments', sum(
+            1 for plc in new_placements.values() if plc == ''))
         if len(new_placements.keys()) > 0:
-            qclient.patch(url="/qiita_db/archive/observations/", op="add",
-                          path=job_id, value=json.dumps(new_placements))
-
-        # retrieve all fragments and create actuall tree
+            with metrics.phase('archive upload'):
+                qclient.patch(url="/qiita_db/archive/observations/",
+                              op="add", path=job_id,
+                              value=json.dumps(new_placements))
+            # the new placements are only stored once they are archived, a
+            # fragment found in the store isn't sent to the archive again
+            if store is not None:
+                store.put(new_placements)
+
+        # create actuall tree
         qclient.update_job_step(job_id, "Step 4 of 4 (4/4): Composing "
                                 "phylogenetic insertion tree")
-        placements = qclient.post(
-            "/qiita_db/archive/observations/", data={'job_id': job_id,
-                                                     'features': features})
-        # remove fragments that have been rejected by SEPP, i.e. whoes
-        # placement is the empty string and
-        # convert all other placements from string to json
-        placements = {frag: json.loads(placements[frag])
-                      for frag, plc
-                      in placements.items()
-                      if plc != ''}
+        metrics.count('placed fragments', len(placements))
         try:
             fp_phylogeny = generate_insertion_trees(
                 placements, out_dir,
                 reference_template=fp_reference_template,
-                reference_rename=fp_reference_rename)
+                reference_rename=fp_reference_rename, metrics=metrics,
+                reference_revnamemap=fp_reference_revnamemap)
         except ValueError as e:
             return False, None, str(e)
     else:
@@ -598,7 +1632,10 @@ def generate_tree_from_fragments(fp_placements,
                                  fp_biom,
                                  out_dir,
                                  fp_reference_template=None,
-                                 fp_reference_rename=None):
+                                 fp_reference_rename=None,
+                                 metrics=None,
+                                 fp_reference_revnamemap=None,
+                                 previous_dir=None):
     """Generates a phylogenetic tree by inserting placements into a reference,
        and trims observations in BIOMs to those successfully matched to the
        tree.
@@ -620,6 +1657,16 @@ def generate_tree_from_fragments(fp_placements,
         Similar to fp_reference_template, but a filepath to the generated
         python renaming script to undo the name scaping post guppy.
         If None, it falls back to the Greengenes 13.8 99% reference.
+    metrics : qp_deblur.metrics.JobMetrics, optional
+        Collects the timings and counters of the phases. If None, they are
+        written to metrics.json and metrics.prom in out_dir.
+    fp_reference_revnamemap : str, optional
+        The path to the name map of the reference as JSON, to undo the name
+        escaping in-process instead of running fp_reference_rename.
+    previous_dir : str, optional
+        The output directory of an earlier call for the same reference, whose
+        insertion tree is updated instead of being built again, see
+        generate_insertion_trees.
 
     Returns
     -------
@@ -633,15 +1680,25 @@ def generate_tree_from_fragments(fp_placements,
         If the guppy binary exits with non-zero return code
         If the given rename script exists with non-zero return code.
     """
+    write_metrics = metrics is None
+    if write_metrics:
+        metrics = JobMetrics()
+
     with open(fp_placements) as placements_file:
-        placements = json.load(placements_file)
+        with metrics.phase('placements load', [fp_placements]):
+            placements = Placements.from_dict(json.load(placements_file))
+        metrics.count('placed fragments', len(placements))
 
         try:
             fp_phylogeny = generate_insertion_trees(
                                     placements,
                                     out_dir,
                                     reference_template=fp_reference_template,
-                                    reference_rename=fp_reference_rename)
+                                    reference_rename=fp_reference_rename,
+                                    metrics=metrics,
+                                    reference_revnamemap=(
+                                        fp_reference_revnamemap),
+                                    previous_dir=previous_dir)
         except Exception:
             # we can get an exception if the tree can't be build; there are
             # many reasons for this but perhaps the most important is a
@@ -650,25 +1707,128 @@ def generate_tree_from_fragments(fp_placements,
             fp_biom_out = None
 
         if fp_biom is not None and fp_phylogeny is not None:
-            # read tree
-            tree = TreeNode.read(str(fp_phylogeny))
-            fragments_tree = {str(tip.name) for tip in tree.tips()
-                              if tip.name is not None}
-
-            # load biom w/fragments not found in fp_phylogeny
-            biom_table = load_table(fp_biom)
-            fragments_table = set(map(str, biom_table.ids(axis='observation')))
-
-            # filter biom file
-            tbl_matched = biom_table.filter(fragments_table & fragments_tree,
-                                            axis='observation',
-                                            inplace=False)
-
-            fp_biom_out = '%s_insertion_filter.biom' % fp_biom[:-len('.biom')]
-            with biom_open(fp_biom_out, 'w') as f:
-                tbl_matched.to_hdf5(
-                    f, "Generated by Qiita, qp-deblur")
+            # the BIOM table is loaded while the tips are read from the tree
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                biom_table = executor.submit(load_table, fp_biom)
+                with metrics.phase('tip extraction', [fp_phylogeny]):
+                    fragments_tree = tip_names(fp_phylogeny)
+
+                with metrics.phase('biom filter', [fp_biom]) as record:
+                    biom_table = biom_table.result()
+                    fragments_table = set(
+                        map(str, biom_table.ids(axis='observation')))
+
+                    # filter biom file
+                    tbl_matched = biom_table.filter(
+                        fragments_table & fragments_tree, axis='observation',
+                        inplace=False)
+
+                    fp_biom_out = '%s_insertion_filter.biom' % \
+                        fp_biom[:-len('.biom')]
+                    with biom_open(fp_biom_out, 'w') as f:
+                        tbl_matched.to_hdf5(
+                            f, "Generated by Qiita, qp-deblur")
+                    record['output_bytes'] = getsize(fp_biom_out)
+            metrics.count('features', len(fragments_table))
+            metrics.count('matched features',
+                          len(tbl_matched.ids(axis='observation')))
         else:
             fp_biom_out = None
 
+        if write_metrics:
+            metrics.write(out_dir)
+
         return fp_phylogeny, fp_biom_out
+
+
+def _tree_from_fragments(entry, fp_reference_template, fp_reference_rename,
+                         fp_reference_revnamemap):
+    """Runs generate_tree_from_fragments for an entry of a batch
+
+    Parameters
+    ----------
+    entry : (str, str or None, str)
+        The paths to the placements, the BIOM table and the output directory
+    fp_reference_template, fp_reference_rename, fp_reference_revnamemap : str
+        The reference, see generate_tree_from_fragments
+
+    Returns
+    -------
+    dict
+        The paths to the placements ('fp_archive'), the tree ('archive') and
+        the trimmed BIOM table ('biom'), or the error of the entry ('error')
+    """
+    fp_archive, fp_biom, out_dir = entry
+    try:
+        fp_phylogeny, fp_biom_out = generate_tree_from_fragments(
+            fp_archive, fp_biom, out_dir,
+            fp_reference_template=fp_reference_template,
+            fp_reference_rename=fp_reference_rename,
+            fp_reference_revnamemap=fp_reference_revnamemap)
+    except Exception as e:
+        return {'fp_archive': fp_archive, 'error': str(e)}
+    return {'fp_archive': fp_archive, 'archive': fp_phylogeny,
+            'biom': fp_biom_out}
+
+
+def generate_trees_from_fragments(entries, fp_reference_template=None,
+                                  fp_reference_rename=None,
+                                  fp_reference_revnamemap=None,
+                                  n_workers=1):
+    """Runs generate_tree_from_fragments for a batch of placements
+
+    Parameters
+    ----------
+    entries : iterable of (str, str or None, str)
+        The paths to the placements, the BIOM table (None to skip the
+        trimming) and the output directory of each entry
+    fp_reference_template : str, optional
+        The path to the reference placement file, see
+        generate_tree_from_fragments
+    fp_reference_rename : str, optional
+        The path to the rename script of the reference, see
+        generate_tree_from_fragments
+    fp_reference_revnamemap : str, optional
+        The path to the name map of the reference, see
+        generate_tree_from_fragments
+    n_workers : int, optional
+        The number of entries processed at the same time
+
+    Yields
+    ------
+    dict
+        The result of each entry, in the order of the entries, see
+        _tree_from_fragments; an entry that fails doesn't stop the others
+
+    Notes
+    -----
+    The reference tree and name map are loaded once, before the worker
+    processes are started; where they are forked (the default on Linux) all
+    entries share them.
+    """
+    fp_template = fp_reference_template
+    if fp_template is None:
+        fp_template = qp_deblur.get_data(
+            join('sepp', 'tmpl_gg13.8-99_placement.json'))
+    fp_revnamemap = fp_reference_revnamemap
+    if fp_revnamemap is None and fp_reference_rename is None:
+        fp_revnamemap = qp_deblur.get_data(
+            join('sepp', 'tmpl_gg13.8-99-revnamemap.json'))
+    # a reference that can't be loaded is reported by each entry
+    try:
+        if not _use_guppy():
+            load_reference_tree(fp_template)
+        if fp_revnamemap is not None:
+            _load_revnamemap(fp_revnamemap)
+    except (IOError, ValueError):
+        pass
+
+    run = partial(_tree_from_fragments,
+                  fp_reference_template=fp_reference_template,
+                  fp_reference_rename=fp_reference_rename,
+                  fp_reference_revnamemap=fp_reference_revnamemap)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(run, entries)
+    else:
+        yield from map(run, entries)
@@ -0,0 +1,296 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import makedirs, remove
+from os.path import join, isdir, isfile, abspath
+from glob import glob
+from shutil import rmtree
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import logging
+
+# the deblur library is only needed by the in-process engine, the plugin
+# falls back to the deblur command if it can't be imported
+try:
+    from deblur import workflow as deblur_workflow
+    from deblur.deblurring import get_default_error_profile
+    from deblur.support_files import pos_db, neg_db
+except ImportError:
+    deblur_workflow = None
+
+# the per sample files picked up by deblur workflow
+SAMPLE_PATTERNS = ['*.fast[aq]', '*.fast[aq].gz', '*.fna', '*.fq', '*.fna.gz',
+                   '*.fq.gz']
+
+
+def available():
+    """Returns whether the deblur library can be used in-process
+
+    Returns
+    -------
+    bool
+        True if the deblur library is installed
+    """
+    return deblur_workflow is not None
+
+
+def _as_list(value):
+    """Returns a deblur multiple value option as a list"""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def workflow_arguments(params):
+    """Translates deblur workflow options to arguments of its functions
+
+    Parameters
+    ----------
+    params : dict of {str: object}
+        The deblur workflow options, keyed by option name without the leading
+        dashes, e.g. {'trim-length': 150}. Missing options take the defaults
+        of the deblur command.
+
+    Returns
+    -------
+    dict of {str: object}
+        The arguments of the deblur workflow functions
+
+    Raises
+    ------
+    ValueError
+        If the error distribution is not a comma separated list of numbers
+    """
+    error_dist = params.get('error-dist')
+    if error_dist is None:
+        error_dist = get_default_error_profile()
+    elif isinstance(error_dist, str):
+        try:
+            error_dist = [float(x) for x in error_dist.split(',')]
+        except ValueError:
+            raise ValueError('Error distribution must be a comma separated '
+                             'list of maximal error probability per hamming '
+                             'distance: %s' % error_dist)
+
+    return {
+        'pos_ref_fp': [abspath(fp) for fp in _as_list(
+            params.get('pos-ref-fp'))] or [pos_db],
+        'neg_ref_fp': [abspath(fp) for fp in _as_list(
+            params.get('neg-ref-fp'))] or [neg_db],
+        'pos_ref_db_fp': _as_list(params.get('pos-ref-db-fp')),
+        'neg_ref_db_fp': _as_list(params.get('neg-ref-db-fp')),
+        'mean_error': float(params.get('mean-error', 0.005)),
+        'error_dist': error_dist,
+        'indel_prob': float(params.get('indel-prob', 0.01)),
+        'indel_max': int(params.get('indel-max', 3)),
+        'trim_length': int(params['trim-length']),
+        'left_trim_length': int(params.get('left-trim-length', 0)),
+        'min_reads': int(params.get('min-reads', 10)),
+        'min_size': int(params.get('min-size', 2)),
+        'threads_per_sample': int(params.get('threads-per-sample', 1))}
+
+
+def _build_indexes(args, working_dir):
+    """Builds the missing SortMeRNA indexes of the filtering databases
+
+    Parameters
+    ----------
+    args : dict of {str: object}
+        The arguments of the deblur workflow functions, as returned by
+        workflow_arguments; updated in place
+    working_dir : str
+        The directory to store the indexes in
+    """
+    if not args['neg_ref_db_fp']:
+        args['neg_ref_db_fp'] = deblur_workflow.build_index_sortmerna(
+            ref_fp=args['neg_ref_fp'], working_dir=working_dir)
+    if not args['pos_ref_db_fp']:
+        args['pos_ref_db_fp'] = deblur_workflow.build_index_sortmerna(
+            ref_fp=args['pos_ref_fp'], working_dir=working_dir)
+
+
+def index_databases(params, index_dir):
+    """Indexes the filtering databases once for several workflow runs
+
+    Parameters
+    ----------
+    params : dict of {str: object}
+        The deblur workflow options, see workflow_arguments
+    index_dir : str
+        The directory to store the indexes in
+
+    Returns
+    -------
+    dict of {str: object}
+        The deblur workflow options with the indexed databases
+
+    Raises
+    ------
+    ValueError
+        If a database can't be indexed
+    """
+    args = workflow_arguments(params)
+    try:
+        _build_indexes(args, index_dir)
+    except Exception as e:
+        raise ValueError('Error running deblur:\n%s: %s' % (
+            type(e).__name__, e))
+    params = dict(params)
+    params['pos-ref-db-fp'] = args['pos_ref_db_fp']
+    params['neg-ref-db-fp'] = args['neg_ref_db_fp']
+    return params
+
+
+def _start_log(log_fp):
+    """Sends the log of the deblur library to a file
+
+    Parameters
+    ----------
+    log_fp : str or None
+        The log file, nothing is done if None
+
+    Returns
+    -------
+    logging.Handler or None
+        The new handler, None if there was nothing to do
+    """
+    logger = logging.getLogger('deblur')
+    logger.setLevel(logging.INFO)
+    if log_fp is None or any(
+            getattr(h, 'baseFilename', None) == abspath(log_fp)
+            for h in logger.handlers):
+        return None
+    # records are written as soon as they are logged, so the progress of
+    # a job can be followed while it runs
+    handler = logging.FileHandler(log_fp)
+    handler.setFormatter(logging.Formatter(
+        '%(levelname)s(%(process)d)%(asctime)s:%(message)s'))
+    logger.addHandler(handler)
+    return handler
+
+
+@contextmanager
+def worker_pool(n_workers, log_fp=None):
+    """Starts the worker processes that deblur the samples
+
+    Parameters
+    ----------
+    n_workers : int
+        The number of worker processes
+    log_fp : str, optional
+        The file to log the progress of the workers to; each worker starts
+        logging to it with its first sample
+
+    Yields
+    ------
+    concurrent.futures.ProcessPoolExecutor
+        The worker pool
+    """
+    handler = _start_log(log_fp)
+    executor = ProcessPoolExecutor(max_workers=max(1, n_workers))
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+        if handler is not None:
+            logging.getLogger('deblur').removeHandler(handler)
+            handler.close()
+
+
+def _log_file():
+    """Returns the file the deblur library logs to, None if there is none"""
+    for handler in logging.getLogger('deblur').handlers:
+        if getattr(handler, 'baseFilename', None) is not None:
+            return handler.baseFilename
+    return None
+
+
+def _deblur_sample(seqs_fp, working_dir, args, log_fp):
+    """Deblurs a per sample file, runs in the worker processes"""
+    # a worker logs to the file of the job, see worker_pool
+    _start_log(log_fp)
+    return deblur_workflow.launch_workflow(
+        seqs_fp=seqs_fp, working_dir=working_dir,
+        mean_error=args['mean_error'], error_dist=args['error_dist'],
+        indel_prob=args['indel_prob'], indel_max=args['indel_max'],
+        trim_length=args['trim_length'],
+        left_trim_length=args['left_trim_length'], min_size=args['min_size'],
+        ref_fp=args['neg_ref_fp'], ref_db_fp=args['neg_ref_db_fp'],
+        threads_per_sample=args['threads_per_sample'])
+
+
+def run_workflow(seqs_fp, out_dir, params, executor):
+    """Runs the deblur workflow with the deblur library
+
+    Parameters
+    ----------
+    seqs_fp : str
+        The per sample folder or the demultiplexed sequence file
+    out_dir : str
+        The output directory, it will have the same files as the output of
+        the deblur workflow command
+    params : dict of {str: object}
+        The deblur workflow options, see workflow_arguments
+    executor : concurrent.futures.Executor
+        The worker pool that deblurs the samples, see worker_pool
+
+    Raises
+    ------
+    ValueError
+        If the deblur library is not installed or any step of the workflow
+        fails
+    """
+    if not available():
+        raise ValueError('Error running deblur: the deblur library is not '
+                         'installed')
+
+    args = workflow_arguments(params)
+    working_dir = join(out_dir, 'deblur_working_dir')
+    makedirs(working_dir)
+
+    try:
+        if isdir(seqs_fp):
+            split_dir = seqs_fp
+        else:
+            split_dir = join(out_dir, 'split')
+            makedirs(split_dir)
+            with open(seqs_fp) as seqs_f:
+                deblur_workflow.split_sequence_file_on_sample_ids_to_files(
+                    seqs_f, split_dir)
+        seqs_fps = [fp for pattern in SAMPLE_PATTERNS
+                    for fp in glob(join(split_dir, pattern)) if isfile(fp)]
+
+        _build_indexes(args, working_dir)
+        log_fp = _log_file()
+        futures = [executor.submit(_deblur_sample, fp, working_dir, args,
+                                   log_fp)
+                   for fp in seqs_fps]
+        for fp, future in zip(seqs_fps, futures):
+            if future.result() is None:
+                logging.getLogger('deblur').warning(
+                    'deblurring failed for file %s' % fp)
+
+        fp_biom = join(out_dir, 'all.biom')
+        fp_seqs = join(out_dir, 'all.seqs.fa')
+        deblur_workflow.create_otu_table(
+            fp_biom, deblur_workflow.get_files_for_table(working_dir),
+            outputfasta_fp=fp_seqs, minreads=args['min_reads'])
+        tmp_files = deblur_workflow.remove_artifacts_from_biom_table(
+            fp_biom, fp_seqs, args['pos_ref_fp'], out_dir,
+            args['pos_ref_db_fp'], threads=args['threads_per_sample'])
+    except Exception as e:
+        raise ValueError('Error running deblur:\n%s: %s' % (
+            type(e).__name__, e))
+
+    for fp in tmp_files:
+        remove(fp)
+    rmtree(working_dir)
+    if split_dir != seqs_fp:
+        rmtree(split_dir)
@@ -0,0 +1,166 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import walk, rename
+from os.path import join, exists, isdir, getsize
+from collections import OrderedDict
+from contextlib import contextmanager
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from threading import Lock
+from time import time
+import json
+
+
+def disk_usage(paths):
+    """Computes the size of files and directories
+
+    Parameters
+    ----------
+    paths : list of str
+        The files and directories, missing ones are ignored
+
+    Returns
+    -------
+    int
+        The total size in bytes
+    """
+    size = 0
+    for path in paths:
+        if path is None or not exists(path):
+            continue
+        if isdir(path):
+            size += sum(getsize(join(root, f))
+                        for root, _, files in walk(path) for f in files)
+        else:
+            size += getsize(path)
+    return size
+
+
+def _cpu_time():
+    """Returns the CPU time used by this process and its finished children"""
+    return sum(r.ru_utime + r.ru_stime
+               for r in (getrusage(RUSAGE_SELF), getrusage(RUSAGE_CHILDREN)))
+
+
+class JobMetrics(object):
+    """Collects the timings and counters of the phases of a job
+
+    Parameters
+    ----------
+    job_id : str, optional
+        The job id, used to label the metrics
+    """
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self._lock = Lock()
+
+    @contextmanager
+    def phase(self, name, inputs=()):
+        """Times a phase of the job
+
+        Parameters
+        ----------
+        name : str
+            The name of the phase
+        inputs : list of str, optional
+            The files and directories read by the phase
+
+        Yields
+        ------
+        dict
+            The metrics of the phase; the caller sets 'output_bytes' to the
+            size of what the phase produced
+        """
+        record = {'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                  'input_bytes': disk_usage(inputs), 'output_bytes': 0}
+        self.phases[name] = record
+        wall, cpu = time(), _cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time() - wall
+            record['cpu_seconds'] = _cpu_time() - cpu
+
+    def count(self, name, value):
+        """Records a counter of the job, e.g. the number of samples
+
+        Parameters
+        ----------
+        name : str
+            The name of the counter
+        value : int
+            The value of the counter
+        """
+        self.counts[name] = value
+
+    def add(self, name, value):
+        """Adds to a counter of the job, e.g. from parallel SEPP runs
+
+        Parameters
+        ----------
+        name : str
+            The name of the counter, it starts at 0
+        value : int or float
+            The value to add
+        """
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_prometheus(self):
+        """Formats the metrics in the Prometheus text exposition format
+
+        Returns
+        -------
+        str
+            The metrics
+        """
+        labels = ''
+        if self.job_id is not None:
+            labels = 'job="%s",' % self.job_id
+
+        lines = []
+        for metric, help_text in (
+                ('wall_seconds', 'Wall time of a job phase'),
+                ('cpu_seconds', 'CPU time of a job phase, including its '
+                                'subprocesses'),
+                ('input_bytes', 'Size of the files read by a job phase'),
+                ('output_bytes', 'Size of the files written by a job phase')):
+            name = 'qp_deblur_phase_%s' % metric
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for phase, record in self.phases.items():
+                lines.append('%s{%sphase="%s"} %s' % (
+                    name, labels, phase, record[metric]))
+        lines.append('# HELP qp_deblur_count Counters of a job')
+        lines.append('# TYPE qp_deblur_count gauge')
+        for count, value in self.counts.items():
+            lines.append('qp_deblur_count{%sname="%s"} %s' % (
+                labels, count, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, out_dir):
+        """Writes the metrics as metrics.json and metrics.prom
+
+        Parameters
+        ----------
+        out_dir : str
+            The job directory
+        """
+        fp = join(out_dir, 'metrics.json')
+        with open('%s.tmp' % fp, 'w') as f:
+            json.dump({'job_id': self.job_id, 'phases': self.phases,
+                       'counts': self.counts}, f, indent=2)
+        rename('%s.tmp' % fp, fp)
+
+        fp = join(out_dir, 'metrics.prom')
+        with open('%s.tmp' % fp, 'w') as f:
+            f.write(self.to_prometheus())
+        rename('%s.tmp' % fp, fp)
@@ -0,0 +1,679 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import SEEK_END, stat
+from io import StringIO
+from collections.abc import Mapping
+from contextlib import closing
+from functools import lru_cache
+from json import JSONDecoder, JSONDecodeError, dumps, load, loads
+from time import time
+import gzip
+import sqlite3
+
+import numpy as np
+
+# sqlite limits the number of parameters of a statement
+SQL_BATCH = 500
+
+# the order of the fields of the placements stored in Qiita, the fields of
+# other pplacer versions are reordered by iter_placements
+PLACEMENT_FIELDS = ['edge_num', 'likelihood', 'like_weight_ratio',
+                    'distal_length', 'pendant_length']
+PLACEMENT_DTYPE = np.dtype([
+    (field, np.int64 if field == 'edge_num' else np.float64)
+    for field in PLACEMENT_FIELDS])
+
+# the number of placement lines decoded before they are converted to an array
+LINE_BATCH = 100000
+
+
+class PlacementStore(object):
+    """Local on-disk store of fragment placements
+
+    Parameters
+    ----------
+    fp : str
+        The path to the SQLite database, created if it doesn't exist
+    reference : str
+        The checksum of the reference phylogeny the placements belong to
+    max_size : int, optional
+        The maximum size of the stored placements in bytes, the least
+        recently used placements are removed once it is exceeded
+
+    Notes
+    -----
+    Placements are stored as the JSON strings the Qiita archive uses, the
+    empty string marks a fragment rejected by SEPP. Several jobs can share a
+    store, so it uses write-ahead logging, waits for the locks of the other
+    jobs and only keeps the database open while it's used.
+    """
+    def __init__(self, fp, reference, max_size=None):
+        self.fp = fp
+        self.reference = reference
+        self.max_size = max_size
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS placements ('
+                'reference TEXT NOT NULL, fragment TEXT NOT NULL, '
+                'placement TEXT NOT NULL, used REAL NOT NULL, '
+                'PRIMARY KEY (reference, fragment)) WITHOUT ROWID')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS placements_used '
+                'ON placements (used)')
+
+    def _connect(self):
+        """Opens the database"""
+        conn = sqlite3.connect(self.fp, timeout=600)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def get(self, fragments):
+        """Retrieves the stored placements of fragments
+
+        Parameters
+        ----------
+        fragments : list of str
+            The fragments
+
+        Returns
+        -------
+        dict of {str: str}
+            The placements of the stored fragments as JSON strings, the empty
+            string if the fragment was rejected
+        """
+        fragments = list(fragments)
+        placements = {}
+        with closing(self._connect()) as conn, conn:
+            for i in range(0, len(fragments), SQL_BATCH):
+                batch = fragments[i:i + SQL_BATCH]
+                marks = ','.join('?' * len(batch))
+                placements.update(conn.execute(
+                    'SELECT fragment, placement FROM placements WHERE '
+                    'reference = ? AND fragment IN (%s)' % marks,
+                    [self.reference] + batch))
+                conn.execute(
+                    'UPDATE placements SET used = ? WHERE reference = ? AND '
+                    'fragment IN (%s)' % marks,
+                    [time(), self.reference] + batch)
+        return placements
+
+    def put(self, placements):
+        """Stores placements
+
+        Parameters
+        ----------
+        placements : dict of {str: str}
+            The placements keyed by fragment as JSON strings, the empty
+            string for rejected fragments
+        """
+        now = time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO placements VALUES (?, ?, ?, ?)',
+                ((self.reference, fragment, placement, now)
+                 for fragment, placement in placements.items()))
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def size(self):
+        """Returns the size of the stored placements
+
+        Returns
+        -------
+        int
+            The size of the used pages of the database in bytes
+        """
+        with closing(self._connect()) as conn:
+            page_size, = conn.execute('PRAGMA page_size').fetchone()
+            page_count, = conn.execute('PRAGMA page_count').fetchone()
+            free, = conn.execute('PRAGMA freelist_count').fetchone()
+        return (page_count - free) * page_size
+
+    def evict(self, max_size):
+        """Removes the least recently used placements
+
+        Parameters
+        ----------
+        max_size : int
+            The maximum size of the stored placements in bytes
+
+        Notes
+        -----
+        The size of a placement isn't known up front, so the share of the
+        placements to remove is estimated from how much the store exceeds
+        max_size, aiming a tenth below max_size, until it fits.
+        """
+        size = self.size()
+        while size > max_size:
+            with closing(self._connect()) as conn, conn:
+                count, = conn.execute(
+                    'SELECT COUNT(*) FROM placements').fetchone()
+                if count == 0:
+                    break
+                n = int(count * (1 - 0.9 * max_size / float(size))) + 1
+                conn.execute(
+                    'DELETE FROM placements WHERE (reference, fragment) IN ('
+                    'SELECT reference, fragment FROM placements ORDER BY '
+                    'used LIMIT ?)', (n, ))
+            size = self.size()
+
+
+class _JSONReader(object):
+    """Decodes the members of a JSON object from a file piece by piece
+
+    Parameters
+    ----------
+    f : file
+        The open JSON file
+    chunk_size : int
+        The number of characters to read at once
+    """
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = JSONDecoder()
+
+    def _read(self, size):
+        """Appends size characters of the file to the buffer"""
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+        # the consumed part of the buffer is dropped
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next character that isn't whitespace, '' at the end"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._read(self.chunk_size)
+
+    def expect(self, chars):
+        """Consumes the next character, which must be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Invalid JSON: expected '%s' but found '%s'"
+                             % ("' or '".join(chars), char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decodes the next JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the buffer might continue
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            # the buffer grows geometrically for large values
+            self._read(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def members(self, stream_key):
+        """Yields the members of the JSON object
+
+        Parameters
+        ----------
+        stream_key : str
+            The member whose array elements are yielded one by one
+
+        Yields
+        ------
+        (str, object)
+            The key and value of each member, or the key and each element of
+            the array of stream_key
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == stream_key and self.peek() == '[':
+                self.expect('[')
+                if self.peek() != ']':
+                    while True:
+                        yield key, self.value()
+                        if self.expect(',]') == ']':
+                            break
+                else:
+                    self.expect(']')
+            else:
+                yield key, self.value()
+            if self.expect(',}') == '}':
+                return
+
+
+def _jplace_fields(fp, chunk_size):
+    """Reads the fields of a jplace file
+
+    Parameters
+    ----------
+    fp : str
+        The path to the jplace file
+    chunk_size : int
+        The number of characters to read at once
+
+    Returns
+    -------
+    list of str
+        The fields of the placements
+
+    Raises
+    ------
+    ValueError
+        If the file has no fields
+
+    Notes
+    -----
+    pplacer writes the fields after the placements, so they are looked up
+    at the end of the file first; if they aren't there the placements are
+    skipped over.
+    """
+    with open(fp, 'rb') as f:
+        f.seek(0, SEEK_END)
+        f.seek(max(0, f.tell() - chunk_size))
+        tail = f.read().decode('utf-8', 'ignore')
+    start = tail.rfind('"fields"')
+    if start != -1:
+        try:
+            reader = _JSONReader(StringIO(tail[start:]), chunk_size)
+            reader.value()
+            reader.expect(':')
+            fields = reader.value()
+            # only the last member of the object is followed by its end
+            reader.expect('}')
+            return fields
+        except ValueError:
+            pass
+
+    with open(fp) as f:
+        for key, value in _JSONReader(f, chunk_size).members('placements'):
+            if key == 'fields':
+                return value
+    raise ValueError("The placements in '%s' have no fields" % fp)
+
+
+def iter_placements(fp, fields=PLACEMENT_FIELDS, chunk_size=1024 * 1024):
+    """Yields the placements of a jplace file, e.g. SEPP's placement.json
+
+    Parameters
+    ----------
+    fp : str
+        The path to the jplace file
+    fields : list of str, optional
+        The order of the fields of the yielded placements
+    chunk_size : int, optional
+        The number of characters to read at once
+
+    Yields
+    ------
+    (str, list of list of float)
+        A fragment and its placement with the fields in the given order
+
+    Notes
+    -----
+    Only one placement is decoded at a time, so the memory used doesn't
+    depend on the number of placements of the file.
+
+    The pplacer bundled with SEPP (v1.1.alpha13) writes the fields in the
+    order of PLACEMENT_FIELDS, later versions such as v1.1.alpha17 don't.
+    The placements stored in Qiita have to be combinable, so their lines are
+    reordered by the fields of the file.
+    """
+    obs_fields = _jplace_fields(fp, chunk_size)
+    # the position of each field in the lines of the file
+    order = [obs_fields.index(field) for field in fields]
+
+    with open(fp) as f:
+        for key, plcmnt in _JSONReader(f, chunk_size).members('placements'):
+            if key != 'placements':
+                continue
+            # a placement can be shared by several fragments
+            lines = [[line[i] for i in order] for line in plcmnt['p']]
+            for seqlbl in plcmnt['nm']:
+                yield seqlbl[0], lines
+
+
+def _to_lines(rows, order):
+    """Converts placement lines to a structured array
+
+    Parameters
+    ----------
+    rows : list of list of float
+        The placement lines
+    order : list of int
+        The position of each of PLACEMENT_FIELDS in the lines
+
+    Returns
+    -------
+    np.ndarray of PLACEMENT_DTYPE
+        The placement lines
+    """
+    lines = np.empty(len(rows), dtype=PLACEMENT_DTYPE)
+    if rows:
+        raw = np.array(rows, dtype=np.float64)
+        for field, column in zip(PLACEMENT_FIELDS, order):
+            lines[field] = raw[:, column]
+    return lines
+
+
+class Placements(Mapping):
+    """The placements of fragments, backed by a structured array
+
+    Parameters
+    ----------
+    fragments : list of str
+        The placed fragments
+    lines : np.ndarray of PLACEMENT_DTYPE
+        The placement lines of all fragments, one after the other
+    counts : list of int
+        The number of placement lines of each fragment
+
+    Notes
+    -----
+    The placements are a read only mapping of fragment to its placement
+    lines. A line takes 40 bytes instead of the few hundred bytes of a list of
+    floats, the lists and JSON strings used by the Qiita archive and guppy are
+    only created by to_lists and to_json when they are needed.
+    """
+    def __init__(self, fragments, lines, counts):
+        self.fragments = list(fragments)
+        self.lines = lines
+        self.offsets = np.zeros(len(self.fragments) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self._index = {f: i for i, f in enumerate(self.fragments)}
+
+    @classmethod
+    def from_dict(cls, placements):
+        """Creates the placements from a dict
+
+        Parameters
+        ----------
+        placements : dict of {str: list or str}
+            The placements keyed by fragment, as lists of lines or as the
+            JSON strings of the Qiita archive, with the fields in the order of
+            PLACEMENT_FIELDS. Empty strings, i.e. fragments rejected by SEPP,
+            are skipped.
+
+        Returns
+        -------
+        Placements
+            The placements
+        """
+        fragments, counts, rows = [], [], []
+        for fragment, plcmnt in placements.items():
+            if isinstance(plcmnt, str):
+                if plcmnt == '':
+                    continue
+                plcmnt = loads(plcmnt)
+            fragments.append(fragment)
+            counts.append(len(plcmnt))
+            rows.extend(plcmnt)
+        return cls(fragments, _to_lines(rows, range(len(PLACEMENT_FIELDS))),
+                   counts)
+
+    @classmethod
+    def from_jplace(cls, fp, chunk_size=1024 * 1024, names=None):
+        """Reads the placements of a jplace file, e.g. SEPP's placement.json
+
+        Parameters
+        ----------
+        fp : str
+            The path to the jplace file
+        chunk_size : int, optional
+            The number of characters to read at once
+        names : dict of {str: str}, optional
+            The fragment of each name of the file, if the fragments were
+            given to SEPP under other names
+
+        Returns
+        -------
+        Placements
+            The placements
+
+        Notes
+        -----
+        The placements are read by iter_placements and converted to an array
+        once per batch of lines.
+        """
+        fragments, counts, rows, batches = [], [], [], []
+        for fragment, lines in iter_placements(fp, chunk_size=chunk_size):
+            fragments.append(fragment if names is None else names[fragment])
+            counts.append(len(lines))
+            rows.extend(lines)
+            if len(rows) >= LINE_BATCH:
+                batches.append(_to_lines(rows, range(len(PLACEMENT_FIELDS))))
+                rows = []
+        batches.append(_to_lines(rows, range(len(PLACEMENT_FIELDS))))
+        return cls(fragments, np.concatenate(batches), counts)
+
+    @classmethod
+    def load(cls, fp):
+        """Reads placements written by dump
+
+        Parameters
+        ----------
+        fp : str
+            The path to a JSON file of a dict of fragment to placement
+
+        Returns
+        -------
+        Placements
+            The placements
+        """
+        with open(fp) as f:
+            return cls.from_dict(load(f))
+
+    @classmethod
+    def concat(cls, parts):
+        """Combines placements
+
+        Parameters
+        ----------
+        parts : list of Placements
+            The placements to combine, a fragment placed in several of them
+            takes the placement of the last one
+
+        Returns
+        -------
+        Placements
+            The combined placements
+        """
+        owner = {}
+        for k, part in enumerate(parts):
+            owner.update(dict.fromkeys(part.fragments, k))
+
+        fragments, lines, counts = [], [np.empty(0, PLACEMENT_DTYPE)], []
+        for k, part in enumerate(parts):
+            keep = np.array([owner[f] == k for f in part.fragments],
+                            dtype=bool)
+            part_counts = np.diff(part.offsets)
+            fragments.extend(
+                f for f, kept in zip(part.fragments, keep) if kept)
+            lines.append(part.lines[np.repeat(keep, part_counts)])
+            counts.extend(part_counts[keep])
+        return cls(fragments, np.concatenate(lines), counts)
+
+    def __getitem__(self, fragment):
+        i = self._index[fragment]
+        return self.lines[self.offsets[i]:self.offsets[i + 1]]
+
+    def __contains__(self, fragment):
+        return fragment in self._index
+
+    def __iter__(self):
+        return iter(self.fragments)
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def to_lists(self, fragment):
+        """Returns the placement of a fragment as lists, e.g. for guppy
+
+        Parameters
+        ----------
+        fragment : str
+            The fragment
+
+        Returns
+        -------
+        list of list of float
+            The placement lines, with the fields in the order of
+            PLACEMENT_FIELDS
+        """
+        return [list(line) for line in self[fragment].tolist()]
+
+    def to_json(self, fragment):
+        """Returns the placement of a fragment as stored in the Qiita archive
+
+        Parameters
+        ----------
+        fragment : str
+            The fragment
+
+        Returns
+        -------
+        str
+            The placement lines as a JSON string
+        """
+        return dumps(self.to_lists(fragment))
+
+    def dump(self, fp):
+        """Writes the placements as a JSON dict of fragment to placement
+
+        Parameters
+        ----------
+        fp : str
+            The path to the JSON file
+        """
+        with open(fp, 'w') as f:
+            f.write('{')
+            for i, fragment in enumerate(self.fragments):
+                f.write('%s%s: %s' % (', ' if i else '', dumps(fragment),
+                                      self.to_json(fragment)))
+            f.write('}')
+
+
+@lru_cache(maxsize=None)
+def _jplace_template(fp, mtime):
+    """Serializes a placement template once per process
+
+    Parameters
+    ----------
+    fp : str
+        The path to the placement template
+    mtime : int
+        The modification time of the template, so a changed template is read
+        again
+
+    Returns
+    -------
+    (str, bool)
+        The JSON of the template up to and including its placements, without
+        closing the placements list, and whether it has placements
+    """
+    with open(fp) as f:
+        template = load(f)
+    members = ['%s: %s' % (dumps(key), dumps(value))
+               for key, value in template.items() if key != 'placements']
+    members.append('"placements": [%s' % ', '.join(
+        dumps(placement) for placement in template.get('placements', [])))
+    return '{%s' % ', '.join(members), bool(template.get('placements'))
+
+
+def _format_line(line_format, line):
+    """Formats a placement line as JSON
+
+    Parameters
+    ----------
+    line_format : str
+        The format of the line, of an int and four floats
+    line : tuple of (int, float, float, float, float)
+        The placement line
+
+    Returns
+    -------
+    str
+        The line, with NaN and infinite values written the way json.dumps
+        writes them
+    """
+    text = line_format % line
+    # none of the digits of a finite float contain an 'n'
+    if 'n' in text:
+        text = text.replace('nan', 'NaN').replace('inf', 'Infinity')
+    return text
+
+
+def write_jplace(fp, fp_template, placements, precision=None,
+                 compress=False):
+    """Writes the placements of a template and new placements as a jplace
+    file, e.g. for guppy
+
+    Parameters
+    ----------
+    fp : str
+        The path to the jplace file
+    fp_template : str
+        The path to the placement template of the reference
+    placements : Placements or dict
+        The new placements, or a dict of fragment to placement as lists or
+        JSON strings; the placements of a dict are written as they are and
+        the empty string marks a fragment without placement
+    precision : int, optional
+        The number of significant digits of the floats of Placements, all of
+        them if None
+    compress : bool, optional
+        Whether to gzip the jplace file
+
+    Notes
+    -----
+    The template is only parsed the first time it is written, and the new
+    placements are streamed to the file one fragment at a time.
+    """
+    head, has_placements = _jplace_template(fp_template,
+                                            stat(fp_template).st_mtime_ns)
+    if precision is None:
+        line_format = '[%d, %r, %r, %r, %r]'
+    else:
+        line_format = '[%%d%s]' % (', %%.%dg' % precision * 4)
+    opener = gzip.open if compress else open
+    with opener(fp, 'wt') as f:
+        f.write(head)
+        sep = ', ' if has_placements else ''
+        if isinstance(placements, Placements):
+            for i, fragment in enumerate(placements.fragments):
+                lines = placements.lines[
+                    placements.offsets[i]:placements.offsets[i + 1]]
+                f.write('%s{"p": [%s], "nm": [[%s, 1]]}' % (
+                    sep, ', '.join(_format_line(line_format, line)
+                                   for line in lines.tolist()),
+                    dumps(fragment)))
+                sep = ', '
+        else:
+            for fragment, placement in placements.items():
+                if placement == '':
+                    continue
+                if not isinstance(placement, str):
+                    placement = dumps(placement)
+                f.write('%s{"p": %s, "nm": [[%s, 1]]}' % (
+                    sep, placement, dumps(fragment)))
+                sep = ', '
+        f.write(']}')
@@ -0,0 +1,346 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import mkdir, makedirs, rename, getpid
+from os.path import join, exists, abspath, expanduser
+from ast import parse, literal_eval, Assign, Name
+from shutil import rmtree, copyfile
+import json
+
+import qp_deblur
+from qp_deblur.util import (
+    get_setting, file_checksum, object_checksum, run_command, file_lock)
+
+
+# the reference used if the job doesn't name one
+DEFAULT_REFERENCE = 'Greengenes_13.8'
+
+# the references shipped with the plugin, their files are in
+# support_files/sepp. The alignment and phylogeny of Greengenes 13.8 are
+# shipped with the fragment-insertion conda package, so they are None.
+REFERENCES = {
+    'Greengenes_13.8': {
+        'alignment': None, 'phylogeny': None,
+        'template': 'tmpl_gg13.8-99_placement.json',
+        'rename': 'tmpl_gg13.8-99_rename-json.py',
+        'revnamemap': 'tmpl_gg13.8-99-revnamemap.json'},
+    'tiny': {
+        'alignment': 'reference_alignment_tiny.fasta',
+        'phylogeny': 'reference_phylogeny_tiny.nwk',
+        'template': 'tmpl_tiny_placement.json',
+        'rename': 'tmpl_tiny_rename-json.py',
+        'revnamemap': 'tmpl_tiny-revnamemap.json'}}
+
+
+def _reference_checksum(fp_reference_alignment, fp_reference_phylogeny,
+                        fp_template=None):
+    """Computes the checksum identifying a SEPP reference
+
+    Parameters
+    ----------
+    fp_reference_alignment : str or None
+        The reference alignment, None for the default one
+    fp_reference_phylogeny : str or None
+        The reference phylogeny, None for the default one
+    fp_template : str, optional
+        The placement template of the reference
+
+    Returns
+    -------
+    str
+        The checksum of the contents of the reference files
+
+    Notes
+    -----
+    The files of the default reference are part of the fragment-insertion
+    package, so it is identified by its template instead, which embeds its
+    tree.
+    """
+    fps = [fp_reference_alignment, fp_reference_phylogeny]
+    if fps == [None, None] and fp_template is not None:
+        fps.append(fp_template)
+    return object_checksum([
+        file_checksum(fp).hexdigest() if fp is not None else None
+        for fp in fps])
+
+
+def _generate_template_rename(file_reference_phylogeny,
+                              file_reference_alignment,
+                              out_dir):
+    """Produces placement template and rename script for reference phylogeny.
+
+    Parameters
+    ----------
+    file_reference_phylogeny : str
+        A filepath to an alternative reference phylogeny for SEPP.
+    file_reference_alignment : str
+        A filepath to an alternative reference alignment for SEPP.
+    out_dir : str
+        The job output directory
+
+    Returns
+    -------
+    (str, str) : Filepaths of reference_template json file and
+    reference_rename python script.
+
+    Raises
+    ------
+    ValueError
+        If a) the given out_dir directory does not exist.
+        b) the given reference phylogeny or alignment does not exist.
+        c) the run-sepp.sh wrapper script fails for any reason.
+
+    Notes
+    -----
+    This function only needs to be called once per reference phylogeny/
+    alignment, i.e. if we update Greengenes or extend SEPP for Silva or other
+    reference phylogenies. Reference calls it the first time the files of a
+    reference that doesn't ship with them are used on a node.
+    """
+    if not exists(out_dir):
+        raise ValueError("Output directory '%s' does not exist!" % out_dir)
+    if not exists(file_reference_phylogeny):
+        raise ValueError("Reference phylogeny file '%s' does not exits!" %
+                         file_reference_phylogeny)
+    if not exists(file_reference_alignment):
+        raise ValueError("Reference alignment file '%s' does not exits!" %
+                         file_reference_alignment)
+
+    # create a dummy sequence input file
+    file_input = '%s/input.fasta' % out_dir
+    with open(file_input, 'w') as f:
+        f.write('>dummySeq\n')
+        f.write('TACGTAGGGGGCAAGCGTTATCCGGATTTACTGGGTGTAAAGGGAGCGTAGACGGATGGA'
+                'CAAGTCTGATGTGAAAGGCTGGGGCCCAACCCCGGGACTGCATTGGAAACTGCCCGTCTT'
+                'GAGTG\n')
+    std_out, std_err, return_value = run_command(
+        ['run-sepp.sh', abspath(file_input), 'dummy', '-x', '1', '-a',
+         file_reference_alignment, '-t', file_reference_phylogeny],
+        join(out_dir, 'run-sepp'), cwd=out_dir,
+        timeout=get_setting('SEPP_TIMEOUT', 0) or None)
+    if return_value != 0:
+        error_msg = ("Error running SEPP:\nStd out: %s\nStd err: %s"
+                     % (std_out, std_err))
+        raise ValueError(error_msg)
+
+    # take resulting placement.json and turn it into the template by
+    # clearing the list of placements
+    file_template = '%s/tmpl_dummy_placement.json' % out_dir
+    with open('%s/dummy_placement.json' % out_dir, 'r') as f:
+        placements = json.loads(f.read())
+        placements['placements'] = []
+        with open(file_template, 'w') as fw:
+            json.dump(placements, fw)
+
+    # Another file produced by SEPP is xxx_rename-json.py, where xxx is the
+    # name of the run, here "dummy". SEPP needs to escape node names before the
+    # reference tree is given to guppy which can only handle a limited name
+    # format. Thus, after guppy, the result needs to be back translated to
+    # original names with the rename-json.py script that is generated by SEPP.
+    return (file_template, '%s/dummy_rename-json.py' % out_dir)
+
+
+def _extract_revnamemap(fp_rename):
+    """Extracts the name map of a rename script generated by SEPP
+
+    Parameters
+    ----------
+    fp_rename : str
+        The path to the rename-json.py script
+
+    Returns
+    -------
+    dict of {str: str} or None
+        The original name of each escaped name, None if the script has no
+        literal name map
+    """
+    with open(fp_rename) as f:
+        tree = parse(f.read())
+    for node in tree.body:
+        if isinstance(node, Assign) and any(
+                isinstance(t, Name) and t.id.endswith('namemap')
+                for t in node.targets):
+            try:
+                return literal_eval(node.value)
+            except ValueError:
+                continue
+    return None
+
+
+class Reference(object):
+    """A SEPP reference phylogeny
+
+    Parameters
+    ----------
+    name : str
+        The name of the reference
+    alignment : str or None
+        The path to the reference alignment, None for the default one
+    phylogeny : str or None
+        The path to the reference phylogeny, None for the default one
+    template : str, optional
+        The path to the placement template of the reference
+    rename : str, optional
+        The path to the rename script of the reference
+    revnamemap : str, optional
+        The path to the name map of the reference
+
+    Notes
+    -----
+    The template, rename script and name map of a reference that doesn't ship
+    with them are built by a SEPP run on a dummy sequence the first time they
+    are used. They are kept in the reference cache of the node,
+    QP_DEBLUR_REFERENCE_CACHE, keyed by the checksum of the reference, so
+    only the first job of a node using the reference pays for that run.
+    """
+    def __init__(self, name, alignment, phylogeny, template=None,
+                 rename=None, revnamemap=None):
+        self.name = name
+        self.alignment = alignment
+        self.phylogeny = phylogeny
+        self._files = None
+        if template is not None and rename is not None:
+            self._files = {'template': template, 'rename': rename,
+                           'revnamemap': revnamemap}
+        self._checksum = None
+
+    @property
+    def checksum(self):
+        """The checksum of the alignment and phylogeny, or of the template
+        of the default reference, see _reference_checksum"""
+        if self._checksum is None:
+            self._checksum = _reference_checksum(
+                self.alignment, self.phylogeny,
+                self._files['template'] if self._files is not None else None)
+        return self._checksum
+
+    @property
+    def template(self):
+        """The path to the placement template"""
+        return self._build()['template']
+
+    @property
+    def rename(self):
+        """The path to the script undoing guppy's name escaping"""
+        return self._build()['rename']
+
+    @property
+    def revnamemap(self):
+        """The path to the name map as JSON, None if it is not known"""
+        return self._build()['revnamemap']
+
+    def _build(self):
+        """Returns the files of the reference, building them if needed
+
+        Returns
+        -------
+        dict of {str: str}
+            The paths to the template, rename script and name map
+
+        Raises
+        ------
+        ValueError
+            If the files of the reference can't be built
+        """
+        if self._files is not None:
+            return self._files
+
+        cache_dir = get_setting('REFERENCE_CACHE', expanduser(
+            join('~', '.cache', 'qp-deblur', 'references')))
+        package_dir = join(cache_dir, self.checksum)
+        fp_files = join(package_dir, 'files.json')
+        if not exists(fp_files):
+            makedirs(cache_dir, exist_ok=True)
+            with file_lock(join(cache_dir, '%s.lock' % self.checksum)):
+                # another job built it while this one waited on the lock
+                if not exists(fp_files):
+                    self._build_package(package_dir)
+        with open(fp_files) as f:
+            self._files = {k: join(package_dir, v) if v is not None else None
+                           for k, v in json.load(f).items()}
+        return self._files
+
+    def _build_package(self, package_dir):
+        """Builds the files of the reference into package_dir
+
+        Parameters
+        ----------
+        package_dir : str
+            The directory of the reference in the reference cache
+        """
+        build_dir = '%s.%d.tmp' % (package_dir, getpid())
+        if exists(build_dir):
+            rmtree(build_dir)
+        mkdir(build_dir)
+        try:
+            fp_template, fp_rename = _generate_template_rename(
+                abspath(self.phylogeny), abspath(self.alignment), build_dir)
+            files = {'template': 'placement.json',
+                     'rename': 'rename-json.py', 'revnamemap': None}
+            copyfile(fp_template, join(build_dir, files['template']))
+            copyfile(fp_rename, join(build_dir, files['rename']))
+            revnamemap = _extract_revnamemap(fp_rename)
+            if revnamemap is not None:
+                files['revnamemap'] = 'revnamemap.json'
+                with open(join(build_dir, files['revnamemap']), 'w') as f:
+                    json.dump(revnamemap, f)
+            with open(join(build_dir, 'files.json'), 'w') as f:
+                json.dump(files, f)
+        except Exception:
+            rmtree(build_dir)
+            raise
+        # the package only shows up once it is complete
+        if exists(package_dir):
+            rmtree(package_dir)
+        rename(build_dir, package_dir)
+
+
+# the references already looked up, by name
+_registry = {}
+
+
+def get_reference(name):
+    """Looks up a SEPP reference
+
+    Parameters
+    ----------
+    name : str
+        The name of the reference, one of REFERENCES or of the JSON file
+        QP_DEBLUR_REFERENCES, which maps names to the paths of the
+        'alignment' and 'phylogeny' of the references of the node
+
+    Returns
+    -------
+    Reference
+        The reference
+
+    Raises
+    ------
+    ValueError
+        If there is no reference with the given name
+    """
+    if name in _registry:
+        return _registry[name]
+
+    if name in REFERENCES:
+        files = {k: qp_deblur.get_data(join('sepp', v))
+                 if v is not None else None
+                 for k, v in REFERENCES[name].items()}
+        reference = Reference(name, **files)
+    else:
+        fp = get_setting('REFERENCES', None)
+        references = {}
+        if fp is not None:
+            with open(fp) as f:
+                references = json.load(f)
+        if name not in references:
+            raise ValueError("Unknown reference phylogeny '%s'" % name)
+        reference = Reference(name, references[name]['alignment'],
+                              references[name]['phylogeny'])
+    _registry[name] = reference
+    return reference
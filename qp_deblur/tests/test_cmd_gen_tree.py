@@ -11,7 +11,7 @@ from qiita_client.testing import PluginTestCase
 from unittest import main
 from subprocess import Popen, PIPE
 
-from os import remove
+from os import mkdir, remove
 from shutil import rmtree
 from tempfile import mkdtemp
 from os.path import exists, isdir, join
@@ -83,6 +83,50 @@ class TestCmdGenTree(PluginTestCase):
 
         self.assertNotEqual(checksum_original, checksum_output)
 
+    def test_cmd_gen_tree_manifest(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        archive_file = 'support_files/test_archive_file.json'
+        ref_template_file = 'support_files/sepp/tmpl_tiny_placement.json'
+        fp_output_biom = join(out_dir, 'output_table.biom')
+        shutil.copyfile('support_files/otu_table.biom', fp_output_biom)
+
+        # the second entry has no BIOM table, the third one fails
+        fp_manifest = join(out_dir, 'manifest.tsv')
+        entries = [(archive_file, fp_output_biom, join(out_dir, 'a')),
+                   (archive_file, '', join(out_dir, 'b')),
+                   ('/dev/notthere', '', join(out_dir, 'c'))]
+        with open(fp_manifest, 'w') as f:
+            for entry in entries:
+                f.write('%s\n' % '\t'.join(entry))
+            for _, _, entry_dir in entries:
+                mkdir(entry_dir)
+
+        p = Popen(["./scripts/generate_tree_from_fragments \
+                    --manifest %s \
+                    --jobs 2 \
+                    --fp_ref_template=%s" % (fp_manifest,
+                                             ref_template_file)],
+                  shell=True,
+                  stdout=PIPE)
+        p_out, p_err = p.communicate()
+
+        # an entry failed
+        self.assertEqual(p.returncode, 1)
+
+        results = [loads(line)
+                   for line in p_out.decode("utf-8").splitlines()]
+        self.assertEqual([r['fp_archive'] for r in results],
+                         [archive_file, archive_file, '/dev/notthere'])
+        self.assertEqual(results[0]['archive'],
+                         join(out_dir, 'a', 'insertion_tree.relabelled.tre'))
+        self.assertTrue(exists(results[0]['biom']))
+        self.assertEqual(results[1]['archive'],
+                         join(out_dir, 'b', 'insertion_tree.relabelled.tre'))
+        self.assertIsNone(results[1]['biom'])
+        self.assertIn('error', results[2])
+
 
 if __name__ == '__main__':
     main()
@@ -6,19 +6,27 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from unittest import main
-from os import close, remove, chmod
-from shutil import copyfile, rmtree
+from unittest import TestCase, main
+from os import close, remove, chmod, mkdir, listdir
+from shutil import copyfile, rmtree, which
 from tempfile import mkstemp, mkdtemp
 from json import dumps, load
 from os.path import exists, isdir, join
 from os import environ
 
+import numpy as np
+from biom import Table, load_table
+from biom.util import biom_open
 from qiita_client.testing import PluginTestCase
 
 from qp_deblur import plugin
 from qp_deblur.deblur import (
-    deblur, generate_deblur_workflow_commands)
+    deblur, generate_deblur_workflow_commands, _partition_samples,
+    _merge_deblur_outputs, _demux_sample_sizes, _sample_cache_key,
+    _load_cached_samples, _cache_sample_results, _write_cached_samples,
+    _auto_sizing, _auto_sepp_threads, _deblur_options, _use_deblur_engine,
+    _use_guppy, _biom_ids, _parallelism, _deblur_argv)
+from qp_deblur import engine as deblur_engine
 
 
 class deblurTests(PluginTestCase):
@@ -60,6 +68,11 @@ class deblurTests(PluginTestCase):
     def tearDown(self):
         # restore eventually changed PATH env var
         environ['PATH'] = self.oldpath
+        for var in ('QP_DEBLUR_ENGINE', 'QP_DEBLUR_TREE_ENGINE',
+                    'QP_DEBLUR_SHARDS', 'QP_DEBLUR_PIPELINE',
+                    'QP_DEBLUR_CACHE_DIR'):
+            if var in environ:
+                del environ[var]
         for fp in self._clean_up_files:
             if exists(fp):
                 if isdir(fp):
@@ -67,6 +80,72 @@ class deblurTests(PluginTestCase):
                 else:
                     remove(fp)
 
+    def _deblur_demux(self, params=None):
+        """Runs deblur on a new demux artifact of filtered_5_seqs.demux
+
+        Parameters
+        ----------
+        params : dict, optional
+            The parameters of the job, self.params if None
+
+        Returns
+        -------
+        boolean, list, str, str
+            The results of the job and its output directory
+        """
+        params = dict(self.params if params is None else params)
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        prep_info_dict = {
+            'SKB7.640196': {
+                'description_prep': 'SKB7', 'platform': 'Illumina'},
+            'SKB8.640193': {
+                'description_prep': 'SKB8', 'platform': 'Illumina'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                # magic #1 = testing study
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+        params['Demultiplexed sequences'] = aid
+
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['deblur', '2021.09', 'Deblur 2021.09']),
+                'status': 'running',
+                'parameters': dumps(params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        self.qclient.patch(url="/qiita_db/archive/observations/",
+                           op="add", path=jid,
+                           value=dumps(self.features))
+        success, ainfo, msg = deblur(self.qclient, jid, params, out_dir)
+        return success, ainfo, msg, out_dir
+
+    def _deblured(self, out_dir):
+        """Reads the deblur results of a demux job, in a fixed order"""
+        deblured = join(out_dir, 'deblur_out', 'deblured')
+        obs = {}
+        for name in ('all', 'reference-hit'):
+            table = load_table(join(deblured, '%s.biom' % name))
+            obs['%s.biom' % name] = table.sort_order(
+                sorted(table.ids())).sort_order(
+                    sorted(table.ids(axis='observation')),
+                    axis='observation')
+            with open(join(deblured, '%s.seqs.fa' % name)) as f:
+                obs['%s.seqs.fa' % name] = sorted(f.read().splitlines())
+        return obs
+
     def test_generate_deblur_workflow_commands_error(self):
         with self.assertRaises(ValueError):
             generate_deblur_workflow_commands(
@@ -86,6 +165,32 @@ class deblurTests(PluginTestCase):
 
         self.assertEqual(obs, exp)
 
+    def test_deblur_argv(self):
+        # the same options as the command, without quoting
+        obs = _deblur_argv(['fastq/s 1.fastq'], 'output', self.params)
+        self.assertEqual(obs[:6], ['deblur', 'workflow', '--seqs-fp',
+                                   'fastq/s 1.fastq', '--output-dir',
+                                   'output'])
+        self.assertEqual(obs[6:10], [
+            '--error-dist', '1, 0.06, 0.02, 0.02, 0.01, 0.005, 0.005, '
+            '0.005, 0.001, 0.001, 0.001, 0.0005', '--indel-max', '3'])
+        self.assertEqual(obs[-2:], ['--trim-length', '100'])
+
+        with self.assertRaises(ValueError):
+            _deblur_argv(['fastq/s1.fastq', 'fastq/s1.fastq'], 'output',
+                         self.params)
+
+    def test_deblur_options(self):
+        params = dict(self.params)
+        params['Positive filtering database'] = 'default'
+        obs = _deblur_options(params)
+        self.assertEqual(
+            list(obs), ['error-dist', 'indel-max', 'indel-prob',
+                        'jobs-to-start', 'mean-error', 'min-reads',
+                        'min-size', 'threads-per-sample', 'trim-length'])
+        self.assertEqual(obs['trim-length'], self.params[
+            'Sequence trim length (-1 for no trimming)'])
+
     def test_deblur_no_target_gene(self):
         # generating filepaths
         fd, fp = mkstemp(suffix='_seqs.demux')
@@ -266,6 +371,9 @@ class deblurTests(PluginTestCase):
         self.assertEqual('Preparation Information File does not have a '
                          'platform column, which is required', msg)
         self.assertFalse(success)
+        # the metrics of a failed job are written as well
+        with open(join(out_dir, 'metrics.json')) as f:
+            self.assertEqual(list(load(f)['phases']), ['prep validation'])
 
     def test_deblur(self):
         # generating filepaths
@@ -393,6 +501,223 @@ class deblurTests(PluginTestCase):
             tree = tree_fp.read()
             self.assertTrue(tree.endswith("'k__Bacteria':0.0);\n"))
 
+    def test_deblur_demux_engine(self):
+        if not deblur_engine.available():
+            self.skipTest('the deblur library is not installed')
+        # generating filepaths
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        # inserting new prep template
+        prep_info_dict = {
+            'SKB7.640196': {
+                'description_prep': 'SKB7', 'platform': 'Illumina'},
+            'SKB8.640193': {
+                'description_prep': 'SKB8', 'platform': 'Illumina'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                # magic #1 = testing study
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        # inserting artifacts
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        self.params['Demultiplexed sequences'] = aid
+
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['deblur', '2021.09', 'Deblur 2021.09']),
+                'status': 'running',
+                'parameters': dumps(self.params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        # pre-populate archive with fragment placements
+        self.qclient.patch(url="/qiita_db/archive/observations/",
+                           op="add", path=jid,
+                           value=dumps(self.features))
+        environ['QP_DEBLUR_ENGINE'] = 'library'
+        success, ainfo, msg = deblur(self.qclient, jid, self.params, out_dir)
+
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertTrue(exists(join(out_dir, 'deblur.log')))
+        self.assertEqual(
+            [(join(out_dir, 'deblur_out', 'deblured', 'all.biom'), 'biom'),
+             (join(out_dir, 'deblur_out', 'deblured', 'all.seqs.fa'),
+              'preprocessed_fasta')], ainfo[0].files)
+        self.assertEqual(
+            load_table(join(out_dir, 'deblur_out', 'deblured',
+                            'all.biom')).shape[1], 2)
+
+    def test_deblur_resume(self):
+        # generating filepaths
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        # inserting new prep template
+        prep_info_dict = {
+            'SKB7.640196': {
+                'description_prep': 'SKB7', 'platform': 'Illumina'},
+            'SKB8.640193': {
+                'description_prep': 'SKB8', 'platform': 'Illumina'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                # magic #1 = testing study
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        # inserting artifacts
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        self.params['Demultiplexed sequences'] = aid
+
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['deblur', '2021.09', 'Deblur 2021.09']),
+                'status': 'running',
+                'parameters': dumps(self.params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        # pre-populate archive with fragment placements
+        self.qclient.patch(url="/qiita_db/archive/observations/",
+                           op="add", path=jid,
+                           value=dumps(self.features))
+        success, ainfo, msg = deblur(
+            self.qclient, jid, dict(self.params), out_dir)
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertTrue(exists(join(out_dir, 'step_manifest.json')))
+
+        # a restarted job reuses the deblur results of the previous run, so
+        # a failing deblur binary doesn't matter anymore
+        fp_fake_deblur = join(out_dir, 'deblur')
+        with open(fp_fake_deblur, 'w') as f:
+            f.write('#!/bin/bash\nexit 123\n')
+        chmod(fp_fake_deblur, 0o775)
+        environ['PATH'] = '%s:%s' % (out_dir, self.oldpath)
+        success, obs_ainfo, msg = deblur(
+            self.qclient, jid, dict(self.params), out_dir)
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertEqual(ainfo[0].files, obs_ainfo[0].files)
+
+        # but not if the deblur results are gone
+        remove(join(out_dir, 'deblur_out', 'deblured', 'all.biom'))
+        success, ainfo, msg = deblur(
+            self.qclient, jid, dict(self.params), out_dir)
+        self.assertFalse(success)
+        self.assertIn('Error running deblur', msg)
+
+    def test_deblur_shards(self):
+        # the dataset-wide read threshold is applied over all the shards,
+        # while the trim length and the per sample threshold apply to each
+        # sample
+        params = dict(self.params)
+        params['Minimum dataset-wide read threshold'] = 2
+        params['Sequence trim length (-1 for no trimming)'] = 100
+        params['Minimum per-sample read threshold'] = 2
+        success, _, msg, out_dir = self._deblur_demux(params)
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        exp = self._deblured(out_dir)
+        self.assertGreater(len(exp['all.biom'].ids()), 1)
+
+        environ['QP_DEBLUR_SHARDS'] = '2'
+        success, _, msg, out_dir = self._deblur_demux(params)
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertTrue(exists(join(out_dir, 'deblur_out', 'shards',
+                                    'shard_1_out')))
+        self.assertEqual(self._deblured(out_dir), exp)
+
+    def test_deblur_pipeline(self):
+        success, _, msg, out_dir = self._deblur_demux()
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        exp = self._deblured(out_dir)
+
+        # splitting the demux file overlaps with deblurring the shards
+        environ['QP_DEBLUR_SHARDS'] = '2'
+        environ['QP_DEBLUR_PIPELINE'] = '1'
+        success, _, msg, out_dir = self._deblur_demux()
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertTrue(exists(join(out_dir, 'deblur_out', 'shards',
+                                    'shard_1_out')))
+        self.assertEqual(self._deblured(out_dir), exp)
+
+    def test_deblur_pipeline_failing_shard(self):
+        # a deblur binary that only fails on the second shard
+        fp_deblur = which('deblur')
+        bin_dir = mkdtemp()
+        self._clean_up_files.append(bin_dir)
+        fp_fake_deblur = join(bin_dir, 'deblur')
+        with open(fp_fake_deblur, 'w') as f:
+            f.write('#!/bin/bash\ncase " $* " in *"/shard_1 "*) exit 123;; '
+                    'esac\nexec %s "$@"\n' % fp_deblur)
+        chmod(fp_fake_deblur, 0o775)
+        environ['PATH'] = '%s:%s' % (bin_dir, self.oldpath)
+
+        environ['QP_DEBLUR_SHARDS'] = '2'
+        environ['QP_DEBLUR_PIPELINE'] = '1'
+        success, ainfo, msg, out_dir = self._deblur_demux()
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertIn('Error running deblur', msg)
+        # the split files and the outputs of the other shard are removed
+        self.assertFalse(exists(join(out_dir, 'deblur_out', 'shards')))
+        self.assertFalse(exists(join(out_dir, 'deblur_out', 'split')))
+
+    def test_deblur_cache(self):
+        cache_dir = mkdtemp()
+        self._clean_up_files.append(cache_dir)
+        environ['QP_DEBLUR_CACHE_DIR'] = cache_dir
+        success, _, msg, out_dir = self._deblur_demux()
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        exp = self._deblured(out_dir)
+        self.assertTrue(listdir(cache_dir))
+
+        # every sample is taken from the cache, none is deblurred
+        success, _, msg, out_dir = self._deblur_demux()
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertEqual(listdir(join(out_dir, 'deblur_out', 'shards')),
+                         ['cached'])
+        self.assertEqual(self._deblured(out_dir), exp)
+
+        # the samples deblurred with other parameters are not in the cache
+        params = dict(self.params)
+        params['Mean per nucleotide error rate'] = 0.006
+        success, _, msg, out_dir = self._deblur_demux(params)
+        self.assertEqual("", msg)
+        self.assertTrue(success)
+        self.assertNotIn('cached', listdir(
+            join(out_dir, 'deblur_out', 'shards')))
+        self.assertIn('shard_0_out', listdir(
+            join(out_dir, 'deblur_out', 'shards')))
+
     def test_deblur_failingbin(self):
         # generating filepaths
         fd, fp = mkstemp(suffix='_seqs.demux')
@@ -487,6 +812,7 @@ class deblurTests(PluginTestCase):
                            op="add", path=jid,
                            value=dumps(self.features))
         # create a fake guppy binary that will always fail
+        environ['QP_DEBLUR_TREE_ENGINE'] = 'guppy'
         fp_fake_guppy = join(out_dir, 'guppy')
         with open(fp_fake_guppy, 'w') as f:
             f.write('#!/bin/bash\nexit 123\n')
@@ -635,5 +961,216 @@ class deblurTests_binaryfail(PluginTestCase):
         self.assertIn('Error running run-sepp.sh', msg)
 
 
+class deblurShardTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def _write_shard(self, name, table, hit):
+        shard_dir = join(self.out_dir, name)
+        mkdir(shard_dir)
+        for fn, t in (('all.biom', table), ('reference-hit.biom', hit)):
+            with biom_open(join(shard_dir, fn), 'w') as f:
+                t.to_hdf5(f, 'test')
+        return shard_dir
+
+    def test_partition_samples(self):
+        obs = _partition_samples(
+            {'s1': 10, 's2': 1, 's3': 1, 's4': 5, 's5': 4}, 3)
+        self.assertEqual(obs, [['s1'], ['s4', 's3'], ['s5', 's2']])
+
+        # never more shards than samples
+        self.assertEqual(_partition_samples({'s1': 10}, 3), [['s1']])
+
+    def test_demux_sample_sizes(self):
+        obs = _demux_sample_sizes('support_files/filtered_5_seqs.demux')
+        self.assertEqual(obs, {'1.SKB7.640196': 15213,
+                               '1.SKB8.640193': 16235})
+
+    def test_biom_ids(self):
+        table = Table(np.array([[1, 0], [2, 3], [0, 4]]), ['o1', 'o2', 'o3'],
+                      ['s1', 's2'])
+        shard_dir = self._write_shard('shard', table, Table([], [], []))
+        fp = join(shard_dir, 'all.biom')
+        self.assertEqual(_biom_ids(fp), ['s1', 's2'])
+        self.assertEqual(_biom_ids(fp, axis='observation'),
+                         ['o1', 'o2', 'o3'])
+        self.assertEqual(
+            _biom_ids(join(shard_dir, 'reference-hit.biom'),
+                      axis='observation'), [])
+
+        # non-HDF5 tables are loaded
+        fp = join(self.out_dir, 'table.json')
+        with open(fp, 'w') as f:
+            f.write(table.to_json('test'))
+        self.assertEqual(_biom_ids(fp, axis='observation'),
+                         ['o1', 'o2', 'o3'])
+
+    def test_merge_deblur_outputs(self):
+        shard_dirs = [
+            self._write_shard(
+                'shard_0',
+                Table(np.array([[1, 2], [0, 3]]), ['AC', 'GT'], ['s1', 's2']),
+                Table(np.array([[1, 2]]), ['AC'], ['s1', 's2'])),
+            self._write_shard(
+                'shard_1',
+                Table(np.array([[5], [1]]), ['GT', 'TT'], ['s3']),
+                Table(np.array([[5], [1]]), ['GT', 'TT'], ['s3']))]
+        out_dir = join(self.out_dir, 'merged')
+
+        _merge_deblur_outputs(shard_dirs, out_dir, 0)
+        obs = load_table(join(out_dir, 'all.biom'))
+        self.assertCountEqual(obs.ids(), ['s1', 's2', 's3'])
+        self.assertCountEqual(obs.ids(axis='observation'),
+                              ['AC', 'GT', 'TT'])
+        self.assertEqual(obs.get_value_by_ids('GT', 's3'), 5)
+        with open(join(out_dir, 'reference-hit.seqs.fa')) as f:
+            self.assertEqual(f.read(), '>AC\nAC\n>GT\nGT\n>TT\nTT\n')
+
+        # the dataset-wide threshold is applied over the merged table
+        _merge_deblur_outputs(shard_dirs, out_dir, 3)
+        obs = load_table(join(out_dir, 'all.biom'))
+        self.assertCountEqual(obs.ids(axis='observation'), ['AC', 'GT'])
+        obs = load_table(join(out_dir, 'reference-hit.biom'))
+        self.assertCountEqual(obs.ids(axis='observation'), ['AC', 'GT'])
+        with open(join(out_dir, 'all.seqs.fa')) as f:
+            self.assertEqual(f.read(), '>AC\nAC\n>GT\nGT\n')
+
+        # samples left without reference hits are removed as well
+        shard_dirs.append(self._write_shard(
+            'shard_2', Table(np.array([[4], [1]]), ['GT', 'TT'], ['s4']),
+            Table(np.array([[1]]), ['TT'], ['s4'])))
+        _merge_deblur_outputs(shard_dirs, out_dir, 3)
+        obs = load_table(join(out_dir, 'all.biom'))
+        self.assertCountEqual(obs.ids(), ['s1', 's2', 's3', 's4'])
+        obs = load_table(join(out_dir, 'reference-hit.biom'))
+        self.assertCountEqual(obs.ids(), ['s1', 's2', 's3'])
+
+    def test_sample_cache(self):
+        split_dir = join(self.out_dir, 'split')
+        mkdir(split_dir)
+        for sample, reads in (('s1', 'AC\nGT\n'), ('s2', 'GT\n'),
+                              ('s3', 'TT\n')):
+            with open(join(split_dir, '%s.fastq' % sample), 'w') as f:
+                f.write(reads)
+        params = {'Mean per nucleotide error rate': 0.005,
+                  'Jobs to start': 1,
+                  'Sequence trim length (-1 for no trimming)': 100}
+        cache_dir = join(self.out_dir, 'cache')
+        files = ['s1.fastq', 's2.fastq', 's3.fastq']
+
+        # parameters that don't change the results are not part of the key
+        key = _sample_cache_key(join(split_dir, 's1.fastq'), params)
+        params['Jobs to start'] = 4
+        self.assertEqual(
+            key, _sample_cache_key(join(split_dir, 's1.fastq'), params))
+        params['Sequence trim length (-1 for no trimming)'] = 150
+        self.assertNotEqual(
+            key, _sample_cache_key(join(split_dir, 's1.fastq'), params))
+
+        keys, cached = _load_cached_samples(
+            split_dir, files, params, cache_dir)
+        self.assertEqual(cached, {})
+
+        shard_dir = self._write_shard(
+            'shard_0',
+            Table(np.array([[1, 0], [2, 3]]), ['AC', 'GT'], ['s1', 's2']),
+            Table(np.array([[2, 3]]), ['GT'], ['s1', 's2']))
+        _cache_sample_results(
+            shard_dir, {'s1': keys['s1.fastq'], 's2': keys['s2.fastq'],
+                        's3': keys['s3.fastq']}, cache_dir)
+
+        obs_keys, cached = _load_cached_samples(
+            split_dir, files, params, cache_dir)
+        self.assertEqual(obs_keys, keys)
+        self.assertEqual(cached, {
+            's1.fastq': {'all': {'AC': 1, 'GT': 2}, 'reference-hit': ['GT']},
+            's2.fastq': {'all': {'GT': 3}, 'reference-hit': ['GT']},
+            's3.fastq': {'all': {}, 'reference-hit': []}})
+
+        _write_cached_samples(
+            {'s1': cached['s1.fastq'], 's2': cached['s2.fastq'],
+             's3': cached['s3.fastq']}, join(self.out_dir, 'cached'))
+        obs = load_table(join(self.out_dir, 'cached', 'all.biom'))
+        self.assertEqual(obs.ids().tolist(), ['s1', 's2'])
+        self.assertEqual(obs.get_value_by_ids('GT', 's2'), 3)
+        obs = load_table(join(self.out_dir, 'cached', 'reference-hit.biom'))
+        self.assertEqual(obs.ids(axis='observation').tolist(), ['GT'])
+
+
+class deblurAutoSizingTests(TestCase):
+    def test_auto_sizing(self):
+        gb = 1024 ** 3
+        # more samples than CPUs: one thread per sample
+        obs = _auto_sizing({str(i): 10 for i in range(100)}, 8, 64 * gb)
+        self.assertEqual(obs, {'split jobs': 8, 'deblur jobs': 8,
+                               'threads per sample': 1})
+
+        # few samples: the remaining CPUs become threads
+        obs = _auto_sizing({'s1': 10, 's2': 10}, 8, 64 * gb)
+        self.assertEqual(obs, {'split jobs': 2, 'deblur jobs': 2,
+                               'threads per sample': 4})
+
+        # a dominating sample gets more threads
+        sizes = {str(i): 10 for i in range(100)}
+        sizes['big'] = 1000
+        obs = _auto_sizing(sizes, 8, 64 * gb)
+        self.assertEqual(obs, {'split jobs': 8, 'deblur jobs': 4,
+                               'threads per sample': 2})
+
+        # memory limits the number of jobs
+        obs = _auto_sizing({str(i): 10 for i in range(100)}, 8, 2 * gb)
+        self.assertEqual(obs['deblur jobs'], 2)
+
+        # unknown samples
+        obs = _auto_sizing(None, 4, 64 * gb)
+        self.assertEqual(obs, {'split jobs': 4, 'deblur jobs': 4,
+                               'threads per sample': 1})
+
+    def test_parallelism(self):
+        self.assertEqual(_parallelism('Jobs to start', 1), 1)
+        self.assertEqual(_parallelism('Jobs to start', ' 4 '), 4)
+        # 0 means auto, which keeps the parameter an integer
+        self.assertEqual(_parallelism('Jobs to start', 0), 'auto')
+        self.assertEqual(_parallelism('Jobs to start', 'Auto'), 'auto')
+        for value in ('aut', '', '-1', '1.5'):
+            with self.assertRaisesRegex(ValueError, "'Jobs to start' should "
+                                        "be a positive integer, or 0"):
+                _parallelism('Jobs to start', value)
+
+    def test_auto_sepp_threads(self):
+        self.assertEqual(_auto_sepp_threads(0, 8), 1)
+        self.assertEqual(_auto_sepp_threads(2500, 8), 3)
+        self.assertEqual(_auto_sepp_threads(100000, 8), 8)
+
+
+class deblurEngineTests(TestCase):
+    def tearDown(self):
+        for var in ('QP_DEBLUR_ENGINE', 'QP_DEBLUR_TREE_ENGINE',
+                    'QP_DEBLUR_SHARDS', 'QP_DEBLUR_PIPELINE',
+                    'QP_DEBLUR_CACHE_DIR'):
+            if var in environ:
+                del environ[var]
+
+    def test_use_deblur_engine(self):
+        self.assertFalse(_use_deblur_engine())
+        environ['QP_DEBLUR_ENGINE'] = 'library'
+        self.assertEqual(_use_deblur_engine(), deblur_engine.available())
+        environ['QP_DEBLUR_ENGINE'] = 'foo'
+        with self.assertRaisesRegex(ValueError, 'QP_DEBLUR_ENGINE should'):
+            _use_deblur_engine()
+
+    def test_use_guppy(self):
+        self.assertFalse(_use_guppy())
+        environ['QP_DEBLUR_TREE_ENGINE'] = 'guppy'
+        self.assertTrue(_use_guppy())
+        environ['QP_DEBLUR_TREE_ENGINE'] = 'foo'
+        with self.assertRaisesRegex(ValueError,
+                                    'QP_DEBLUR_TREE_ENGINE should'):
+            _use_guppy()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,53 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main, skipIf
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+import logging
+
+from qp_deblur import engine
+
+
+@skipIf(not engine.available(), 'the deblur library is not installed')
+class engineTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_workflow_arguments(self):
+        obs = engine.workflow_arguments(
+            {'trim-length': '100', 'error-dist': '1, 0.06, 0.02',
+             'min-reads': 0, 'pos-ref-db-fp': 'pos.idx'})
+        self.assertEqual(obs['trim_length'], 100)
+        self.assertEqual(obs['error_dist'], [1, 0.06, 0.02])
+        self.assertEqual(obs['min_reads'], 0)
+        self.assertEqual(obs['min_size'], 2)
+        self.assertEqual(obs['pos_ref_db_fp'], ['pos.idx'])
+        self.assertEqual(obs['neg_ref_db_fp'], [])
+        self.assertEqual(len(obs['pos_ref_fp']), 1)
+
+        with self.assertRaisesRegex(ValueError, 'Error distribution'):
+            engine.workflow_arguments(
+                {'trim-length': '100', 'error-dist': '1, a'})
+
+    def test_worker_pool(self):
+        log_fp = join(self.out_dir, 'deblur.log')
+        with engine.worker_pool(2, log_fp) as executor:
+            self.assertEqual(executor.submit(sum, [1, 2]).result(), 3)
+            logging.getLogger('deblur').info('a message')
+        self.assertTrue(exists(log_fp))
+        with open(log_fp) as f:
+            self.assertIn('a message', f.read())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import mkdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+
+from qp_deblur.metrics import JobMetrics, disk_usage
+
+
+class metricsTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_disk_usage(self):
+        mkdir(join(self.out_dir, 'a'))
+        with open(join(self.out_dir, 'a', 'b'), 'w') as f:
+            f.write('ACGT')
+        with open(join(self.out_dir, 'c'), 'w') as f:
+            f.write('AC')
+        self.assertEqual(disk_usage([join(self.out_dir, 'a')]), 4)
+        self.assertEqual(disk_usage([self.out_dir]), 6)
+        self.assertEqual(disk_usage([join(self.out_dir, 'c'), None,
+                                     join(self.out_dir, 'missing')]), 2)
+
+    def test_phase(self):
+        fp = join(self.out_dir, 'in.txt')
+        with open(fp, 'w') as f:
+            f.write('ACGT')
+        metrics = JobMetrics('job1')
+        with metrics.phase('split', [fp]) as record:
+            record['output_bytes'] = 10
+        self.assertEqual(list(metrics.phases), ['split'])
+        record = metrics.phases['split']
+        self.assertEqual(record['input_bytes'], 4)
+        self.assertEqual(record['output_bytes'], 10)
+        self.assertGreaterEqual(record['wall_seconds'], 0)
+        self.assertGreaterEqual(record['cpu_seconds'], 0)
+
+        # failing phases are recorded as well
+        with self.assertRaises(ValueError):
+            with metrics.phase('deblur'):
+                raise ValueError('failed')
+        self.assertEqual(list(metrics.phases), ['split', 'deblur'])
+
+    def test_add(self):
+        metrics = JobMetrics()
+        metrics.add('sepp tree seconds', 1.5)
+        metrics.add('sepp tree seconds', 2)
+        self.assertEqual(metrics.counts, {'sepp tree seconds': 3.5})
+
+    def test_to_prometheus(self):
+        metrics = JobMetrics('job1')
+        with metrics.phase('split'):
+            pass
+        metrics.count('samples', 2)
+        obs = metrics.to_prometheus().splitlines()
+        self.assertIn('# TYPE qp_deblur_phase_wall_seconds gauge', obs)
+        self.assertIn(
+            'qp_deblur_phase_input_bytes{job="job1",phase="split"} 0', obs)
+        self.assertIn('qp_deblur_count{job="job1",name="samples"} 2', obs)
+
+        metrics = JobMetrics()
+        metrics.count('samples', 2)
+        self.assertIn('qp_deblur_count{name="samples"} 2',
+                      metrics.to_prometheus().splitlines())
+
+    def test_write(self):
+        metrics = JobMetrics('job1')
+        with metrics.phase('split'):
+            pass
+        metrics.count('samples', 2)
+        metrics.write(self.out_dir)
+
+        with open(join(self.out_dir, 'metrics.json')) as f:
+            obs = json.load(f)
+        self.assertEqual(obs['job_id'], 'job1')
+        self.assertEqual(list(obs['phases']), ['split'])
+        self.assertEqual(obs['counts'], {'samples': 2})
+        with open(join(self.out_dir, 'metrics.prom')) as f:
+            self.assertEqual(f.read(), metrics.to_prometheus())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+import gzip
+import json
+
+from qp_deblur.placements import (PLACEMENT_FIELDS, PlacementStore,
+                                  Placements, iter_placements, write_jplace)
+
+
+class placementStoreTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.fp = join(self.out_dir, 'placements.db')
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_get_put(self):
+        store = PlacementStore(self.fp, 'ref1')
+        self.assertEqual(store.get(['AAAA', 'CCCC']), {})
+
+        plc = json.dumps([[351337, -24653.717, 0.14, 5e-07, 6e-06]])
+        store.put({'AAAA': plc, 'CCCC': ''})
+        self.assertEqual(store.get(['AAAA', 'CCCC', 'GGGG']),
+                         {'AAAA': plc, 'CCCC': ''})
+
+        # the placements are kept per reference ...
+        self.assertEqual(PlacementStore(self.fp, 'ref2').get(['AAAA']), {})
+        # ... and on disk
+        self.assertEqual(PlacementStore(self.fp, 'ref1').get(['AAAA']),
+                         {'AAAA': plc})
+
+    def test_evict(self):
+        store = PlacementStore(self.fp, 'ref1')
+        plc = json.dumps([[1, -2.0, 0.5, 0.1, 0.2]] * 5)
+        store.put({'A%d' % i: plc for i in range(2000)})
+        # reading a placement makes it the most recently used one
+        store.get(['A0'])
+
+        size = store.size()
+        store.evict(size // 2)
+        self.assertLessEqual(store.size(), size // 2)
+        obs = store.get(['A%d' % i for i in range(2000)])
+        self.assertIn('A0', obs)
+        self.assertGreater(len(obs), 0)
+        self.assertLess(len(obs), 2000)
+
+        # the size is enforced when adding placements
+        store = PlacementStore(self.fp, 'ref1', max_size=size // 4)
+        store.put({'B%d' % i: plc for i in range(10)})
+        self.assertLessEqual(store.size(), size // 4)
+
+
+class iterPlacementsTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.fp = join('support_files', 'sepp', 'placements.json')
+        with open(self.fp) as f:
+            plcmnts = json.load(f)
+        self.fields = plcmnts['fields']
+        # the file has the fields in the order of PLACEMENT_FIELDS
+        self.assertEqual(self.fields, PLACEMENT_FIELDS)
+        self.exp = {seqlbl[0]: p['p']
+                    for p in plcmnts['placements'] for seqlbl in p['nm']}
+        self.plcmnts = plcmnts
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_iter_placements(self):
+        self.assertEqual(dict(iter_placements(self.fp)), self.exp)
+        # values spanning several reads
+        self.assertEqual(dict(iter_placements(self.fp, chunk_size=7)),
+                         self.exp)
+
+    def test_iter_placements_fields_first(self):
+        # other jplace writers put the fields before the placements
+        fp = join(self.out_dir, 'placements.json')
+        with open(fp, 'w') as f:
+            json.dump({'fields': self.fields[::-1], 'version': 3,
+                       'placements': [
+                           {'p': [line[::-1] for line in p['p']],
+                            'nm': p['nm']}
+                           for p in self.plcmnts['placements']]}, f)
+        self.assertEqual(dict(iter_placements(fp, chunk_size=64)),
+                         self.exp)
+
+    def test_iter_placements_empty(self):
+        fp = join(self.out_dir, 'placements.json')
+        with open(fp, 'w') as f:
+            json.dump({'placements': [], 'fields': self.fields}, f)
+        self.assertEqual(list(iter_placements(fp)), [])
+
+        with open(fp, 'w') as f:
+            json.dump({'placements': []}, f)
+        with self.assertRaisesRegex(ValueError, 'have no fields'):
+            list(iter_placements(fp))
+
+
+class placementsTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.fp = join('support_files', 'sepp', 'placements.json')
+        with open(self.fp) as f:
+            plcmnts = json.load(f)
+        self.assertEqual(plcmnts['fields'], PLACEMENT_FIELDS)
+        self.exp = {seqlbl[0]: p['p']
+                    for p in plcmnts['placements'] for seqlbl in p['nm']}
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_from_jplace(self):
+        obs = Placements.from_jplace(self.fp, chunk_size=64)
+        self.assertCountEqual(obs, self.exp)
+        for fragment, plcmnt in self.exp.items():
+            self.assertEqual(obs.to_lists(fragment), plcmnt)
+            self.assertEqual(obs[fragment]['edge_num'].tolist(),
+                             [line[0] for line in plcmnt])
+
+    def test_from_jplace_names(self):
+        # the fragments are given to SEPP under short names
+        with open(self.fp) as f:
+            plcmnts = json.load(f)
+        names = {}
+        for i, p in enumerate(plcmnts['placements']):
+            names[str(i)] = p['nm'][0][0]
+            p['nm'] = [[str(i), 1]]
+        fp = join(self.out_dir, 'placements.json')
+        with open(fp, 'w') as f:
+            json.dump(plcmnts, f)
+        obs = Placements.from_jplace(fp, names=names)
+        self.assertEqual({f: obs.to_lists(f) for f in obs}, self.exp)
+
+    def test_from_dict(self):
+        obs = Placements.from_dict({
+            'AAAA': [[1, -2.0, 0.5, 0.1, 0.2]],
+            'CCCC': json.dumps([[3, -4.0, 0.5, 0.1, 0.2]] * 2),
+            'GGGG': ''})
+        self.assertEqual(list(obs), ['AAAA', 'CCCC'])
+        self.assertNotIn('GGGG', obs)
+        self.assertEqual(len(obs['CCCC']), 2)
+        self.assertEqual(obs.to_json('AAAA'), '[[1, -2.0, 0.5, 0.1, 0.2]]')
+        self.assertEqual(len(Placements.from_dict({})), 0)
+
+    def test_concat(self):
+        obs = Placements.concat([
+            Placements.from_dict({'AAAA': [[1, -2.0, 0.5, 0.1, 0.2]],
+                                  'CCCC': [[3, -4.0, 0.5, 0.1, 0.2]]}),
+            Placements.from_dict({}),
+            Placements.from_dict({'AAAA': [[5, -6.0, 0.5, 0.1, 0.2]] * 2})])
+        self.assertCountEqual(obs, ['AAAA', 'CCCC'])
+        self.assertEqual(obs.to_lists('AAAA'), [[5, -6.0, 0.5, 0.1, 0.2]] * 2)
+        self.assertEqual(obs.to_lists('CCCC'), [[3, -4.0, 0.5, 0.1, 0.2]])
+
+    def test_dump_load(self):
+        fp = join(self.out_dir, 'placements.json')
+        Placements.from_jplace(self.fp).dump(fp)
+        with open(fp) as f:
+            self.assertEqual(json.load(f), self.exp)
+        obs = Placements.load(fp)
+        self.assertEqual({f: obs.to_lists(f) for f in obs}, self.exp)
+
+    def test_write_jplace(self):
+        fp_template = join('support_files', 'sepp',
+                           'tmpl_tiny_placement.json')
+        with open(fp_template) as f:
+            template = json.load(f)
+        fp = join(self.out_dir, 'placements.json')
+        placements = Placements.from_dict(self.exp)
+        write_jplace(fp, fp_template, placements)
+        with open(fp) as f:
+            obs = json.load(f)
+        exp = dict(template)
+        exp['placements'] = template['placements'] + [
+            {'p': plcmnt, 'nm': [[fragment, 1]]}
+            for fragment, plcmnt in self.exp.items()]
+        self.assertEqual(obs, exp)
+
+        # the placements of a dict are written as they are
+        write_jplace(fp, fp_template, {'AAAA': ['this is wrong'],
+                                       'CCCC': '[[1, 2]]', 'GGGG': ''})
+        with open(fp) as f:
+            obs = json.load(f)
+        self.assertEqual(obs['placements'][len(template['placements']):],
+                         [{'p': ['this is wrong'], 'nm': [['AAAA', 1]]},
+                          {'p': [[1, 2]], 'nm': [['CCCC', 1]]}])
+
+        # compact floats and gzip
+        write_jplace(fp + '.gz', fp_template,
+                     Placements.from_dict({'AAAA': [[1, -2.123456, 0.5,
+                                                     0.1, 1e-07]]}),
+                     precision=3, compress=True)
+        with gzip.open(fp + '.gz', 'rt') as f:
+            obs = json.load(f)
+        self.assertEqual(obs['placements'][-1],
+                         {'p': [[1, -2.12, 0.5, 0.1, 1e-07]],
+                          'nm': [['AAAA', 1]]})
+
+        # NaN and infinite values are written the way json writes them
+        for precision in (None, 3):
+            write_jplace(fp, fp_template, Placements.from_dict(
+                {'AAAA': [[1, float('nan'), float('inf'), float('-inf'),
+                           1e-07]]}), precision=precision)
+            with open(fp) as f:
+                text = f.read()
+            self.assertIn('[1, NaN, Infinity, -Infinity, 1e-07]', text)
+            self.assertEqual(json.loads(text)['placements'][-1]['p'][0][0], 1)
+
+
+if __name__ == '__main__':
+    main()
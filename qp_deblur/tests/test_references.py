@@ -0,0 +1,117 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, chmod
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+
+from qp_deblur import references
+from qp_deblur.references import Reference, get_reference
+
+
+class referencesTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.oldenv = dict(environ)
+        environ['QP_DEBLUR_REFERENCE_CACHE'] = join(self.out_dir, 'cache')
+        references._registry.clear()
+
+        # a fake run-sepp.sh that counts how often it builds a reference
+        self.fp_count = join(self.out_dir, 'count')
+        fp_sepp = join(self.out_dir, 'run-sepp.sh')
+        with open(fp_sepp, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    'echo run >> %s\n'
+                    'echo \'{"tree": "(A{0});", "placements": [{"p": [], '
+                    '"nm": []}], "fields": []}\' > dummy_placement.json\n'
+                    'echo \'revnamemap = {"UQrYOlnDN0": "A"}\' > '
+                    'dummy_rename-json.py\n' % self.fp_count)
+        chmod(fp_sepp, 0o775)
+        environ['PATH'] = '%s:%s' % (self.out_dir, environ['PATH'])
+
+        self.fp_alignment = join(self.out_dir, 'alignment.fasta')
+        self.fp_phylogeny = join(self.out_dir, 'phylogeny.nwk')
+        with open(self.fp_alignment, 'w') as f:
+            f.write('>A\nACGT\n')
+        with open(self.fp_phylogeny, 'w') as f:
+            f.write('(A);\n')
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.oldenv)
+        references._registry.clear()
+        rmtree(self.out_dir)
+
+    def test_get_reference(self):
+        obs = get_reference('tiny')
+        self.assertIs(get_reference('tiny'), obs)
+        self.assertTrue(obs.template.endswith('tmpl_tiny_placement.json'))
+        self.assertTrue(exists(obs.alignment))
+        # shipped references don't need SEPP
+        self.assertFalse(exists(self.fp_count))
+
+        self.assertIsNone(get_reference('Greengenes_13.8').alignment)
+        with self.assertRaisesRegex(ValueError, "Unknown reference"):
+            get_reference('silva')
+
+        fp = join(self.out_dir, 'references.json')
+        with open(fp, 'w') as f:
+            json.dump({'silva': {'alignment': self.fp_alignment,
+                                 'phylogeny': self.fp_phylogeny}}, f)
+        environ['QP_DEBLUR_REFERENCES'] = fp
+        self.assertEqual(get_reference('silva').phylogeny, self.fp_phylogeny)
+
+    def test_checksum(self):
+        # the default reference is identified by its template
+        fp_template = join(self.out_dir, 'template.json')
+        with open(fp_template, 'w') as f:
+            f.write('{"tree": "(A{0});"}')
+        obs = Reference('default', None, None, fp_template, fp_template)
+        self.assertEqual(
+            Reference('default', None, None, fp_template,
+                      fp_template).checksum, obs.checksum)
+        with open(fp_template, 'w') as f:
+            f.write('{"tree": "(B{0});"}')
+        self.assertNotEqual(
+            Reference('default', None, None, fp_template,
+                      fp_template).checksum, obs.checksum)
+
+        # other references by their alignment and phylogeny
+        obs = Reference('new', self.fp_alignment, self.fp_phylogeny)
+        self.assertEqual(
+            Reference('new', self.fp_alignment, self.fp_phylogeny,
+                      fp_template, fp_template).checksum, obs.checksum)
+
+    def test_build(self):
+        obs = Reference('new', self.fp_alignment, self.fp_phylogeny)
+        with open(obs.template) as f:
+            self.assertEqual(json.load(f)['placements'], [])
+        self.assertTrue(exists(obs.rename))
+        with open(obs.revnamemap) as f:
+            self.assertEqual(json.load(f), {'UQrYOlnDN0': 'A'})
+
+        # other jobs of the node use the cached files
+        again = Reference('new', self.fp_alignment, self.fp_phylogeny)
+        self.assertEqual(again.template, obs.template)
+        with open(self.fp_count) as f:
+            self.assertEqual(f.read(), 'run\n')
+
+    def test_build_error(self):
+        with open(join(self.out_dir, 'run-sepp.sh'), 'w') as f:
+            f.write('#!/bin/bash\nexit 1\n')
+        obs = Reference('new', self.fp_alignment, self.fp_phylogeny)
+        with self.assertRaisesRegex(ValueError, "Error running SEPP"):
+            obs.template
+        self.assertFalse(exists(join(self.out_dir, 'cache', obs.checksum)))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,15 +9,18 @@
 from unittest import TestCase, main
 from subprocess import Popen, PIPE
 
-from os import remove
-from os.path import join, abspath
+from os import remove, environ, chmod, listdir
+from os.path import join, abspath, exists
 from shutil import rmtree, which
 from tempfile import mkdtemp
+from json import dumps
 
 from qp_deblur.deblur import (generate_sepp_placements,
                               generate_insertion_trees,
-                              _generate_template_rename,
-                              _reorder_fields)
+                              _sepp_reference_package,
+                              _sepp_placement_only)
+from qp_deblur.placements import PlacementStore
+from qp_deblur.references import _generate_template_rename
 
 
 TESTPREFIX = 'foo'
@@ -170,6 +173,93 @@ class seppTests(TestCase):
         # clean up working directory
         rmtree(out_dir)
 
+    def test_generate_sepp_placements_batches(self):
+        out_dir = mkdtemp()
+        placements = generate_sepp_placements(
+            self.seqs, out_dir, 2, reference_alignment=self.fp_ref_alignment,
+            reference_phylogeny=self.fp_ref_phylogeny, batch_size=4,
+            n_workers=2)
+
+        # every batch runs in its own directory ...
+        self.assertTrue(exists(join(out_dir, 'sepp_batch_0')))
+        self.assertTrue(exists(join(out_dir, 'sepp_batch_1')))
+        # ... and the merged placements equal the ones of a single run
+        self.assertCountEqual(placements, self.exp)
+        self.assertEqual(placements[self.seqs[6]][0][0], 957)
+
+        rmtree(out_dir)
+
+    def test_generate_sepp_placements_store(self):
+        out_dir = mkdtemp()
+        store = PlacementStore(join(out_dir, 'placements.db'), 'tiny')
+        store.put({seq: dumps(self.exp[seq]) if seq in self.exp else ''
+                   for seq in self.seqs})
+        # all seqs are stored, so SEPP doesn't run and can't fail
+        placements = generate_sepp_placements(
+            self.seqs, out_dir, 1, reference_phylogeny='/dev/null',
+            store=store)
+        self.assertCountEqual(placements, self.exp)
+
+        rmtree(out_dir)
+
+    def test_generate_sepp_placements_batches_nonzero(self):
+        out_dir = mkdtemp()
+        self.assertRaisesRegex(
+            ValueError, "Error running run-sepp.sh", generate_sepp_placements,
+            self.seqs, out_dir, 1, reference_phylogeny='/dev/null',
+            batch_size=4, n_workers=2, retries=1)
+
+        rmtree(out_dir)
+
+    def test_sepp_reference_package(self):
+        out_dir = mkdtemp()
+        cache_dir = join(out_dir, 'cache')
+        # a fake raxmlHPC that counts how often it builds a package
+        fp_count = join(out_dir, 'count')
+        fp_raxml = join(out_dir, 'raxmlHPC')
+        with open(fp_raxml, 'w') as f:
+            f.write('#!/bin/bash\necho run >> %s\n'
+                    'echo info > "${@: -1}/RAxML_info.reference"\n' % fp_count)
+        chmod(fp_raxml, 0o775)
+        oldpath = environ['PATH']
+        environ['PATH'] = '%s:%s' % (out_dir, oldpath)
+        try:
+            obs = _sepp_reference_package(
+                self.fp_ref_phylogeny, self.fp_ref_alignment, cache_dir)
+            self.assertTrue(exists(obs))
+            self.assertEqual(_sepp_reference_package(
+                self.fp_ref_phylogeny, self.fp_ref_alignment, cache_dir), obs)
+            with open(fp_count) as f:
+                self.assertEqual(f.read(), 'run\n')
+
+            # failing builds leave nothing behind
+            with open(fp_raxml, 'w') as f:
+                f.write('#!/bin/bash\nexit 1\n')
+            self.assertRaisesRegex(
+                ValueError, "Error running raxmlHPC", _sepp_reference_package,
+                self.fp_ref_phylogeny, self.fp_ref_phylogeny, cache_dir)
+            self.assertEqual(len([f for f in listdir(cache_dir)
+                                  if not f.endswith('.lock')]), 1)
+        finally:
+            environ['PATH'] = oldpath
+
+        rmtree(out_dir)
+
+    def test_sepp_placement_only(self):
+        out_dir = mkdtemp()
+        fp_patched = join(out_dir, 'run-sepp-patched.sh')
+        fp_plain = join(out_dir, 'run-sepp-plain.sh')
+        with open(fp_patched, 'w') as f:
+            f.write('\t\t-n|--noTreeComputation)\n')
+        with open(fp_plain, 'w') as f:
+            f.write('\t\t-t|--tree)\n')
+        self.assertTrue(_sepp_placement_only(fp_patched))
+        self.assertFalse(_sepp_placement_only(fp_plain))
+        self.assertFalse(_sepp_placement_only(join(out_dir, 'missing')))
+        self.assertFalse(_sepp_placement_only(None))
+
+        rmtree(out_dir)
+
     def test_generate_sepp_placements_noseqs(self):
         self.assertEqual(generate_sepp_placements([], None, 1), {})
 
@@ -199,6 +289,28 @@ class seppTests(TestCase):
             tree = "".join(f.readlines())
             for seq in self.seqs:
                 self.assertIn(seq, tree)
+
+        # the names are relabelled in-process with the name map
+        with open(file_tree) as f:
+            exp = f.read()
+        file_tree = generate_insertion_trees(
+            self.exp, out_dir,
+            reference_template=self.fp_ref_template,
+            reference_rename=self.fp_ref_rename,
+            reference_revnamemap=join('support_files', 'sepp',
+                                      'tmpl_tiny-revnamemap.json'))
+        with open(file_tree) as f:
+            self.assertEqual(f.read(), exp)
+
+        # the tree of a previous output directory is updated
+        next_dir = mkdtemp()
+        file_tree = generate_insertion_trees(
+            self.exp, next_dir,
+            reference_template=self.fp_ref_template,
+            reference_rename=self.fp_ref_rename, previous_dir=out_dir)
+        with open(file_tree) as f:
+            self.assertEqual(f.read(), exp)
+        rmtree(next_dir)
         rmtree(out_dir)
 
     def test_generate_insertion_trees_errors(self):
@@ -224,6 +336,8 @@ class seppTests(TestCase):
             reference_rename=file_missing)
 
         # test if errors in guppy execution are catched
+        environ['QP_DEBLUR_TREE_ENGINE'] = 'guppy'
+        self.addCleanup(environ.pop, 'QP_DEBLUR_TREE_ENGINE')
         self.assertRaisesRegex(
             ValueError,
             "Error running guppy",
@@ -298,50 +412,5 @@ class seppTests(TestCase):
         rmtree(out_dir)
 
 
-class pplacerReorderTests(TestCase):
-    def test__reorder_fields(self):
-        jplace = {
-            "tree": "",
-            "placements": [{
-                "p": [[351337, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515],
-                      [351341, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515],
-                      [348440, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515],
-                      [351336, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515],
-                      [351353, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515],
-                      [351354, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515],
-                      [351302, -24653.717, 0.14285715, 5.000002E-7,
-                       0.000006113515]],
-                "nm": [["TGG...", 1]]}],
-            "metadata": {
-                "invocation": "SEPP-generated json file (sepp 2)."
-            },
-            "version": 1,
-            "fields": ["edge_num", "likelihood", "like_weight_ratio",
-                       "distal_length", "pendant_length"]}
-
-        # keep the very same order
-        obs = _reorder_fields(jplace['placements'][0]['p'], jplace['fields'],
-                              EXP_ORDER_FIELDS=['edge_num', 'likelihood',
-                                                'like_weight_ratio',
-                                                'distal_length',
-                                                'pendant_length'])
-        self.assertEqual(obs[0], [351337, -24653.717, 0.14285715, 5.000002E-7,
-                                  0.000006113515])
-
-        # flip edge_num with pedant_length
-        obs = _reorder_fields(jplace['placements'][0]['p'], jplace['fields'],
-                              EXP_ORDER_FIELDS=['pendant_length', 'likelihood',
-                                                'like_weight_ratio',
-                                                'distal_length', 'edge_num'])
-        self.assertEqual(obs[0], [0.000006113515, -24653.717, 0.14285715,
-                                  5.000002E-7, 351337])
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,241 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from collections import OrderedDict
+from os.path import join
+from subprocess import PIPE, run
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+import sys
+
+from qp_deblur.placements import Placements
+from qp_deblur.trees import (
+    JplaceTree, fill_branch_lengths, insert_placements, load_reference_tree,
+    relabel_tree, tip_names)
+
+
+class jplaceTreeTests(TestCase):
+    def test_jplace_tree(self):
+        tree = JplaceTree('((A:0.1{0},B:0.2{1})AB:0.3{2},C:1{3})root;')
+        self.assertEqual(tree.names, ['root', 'AB', 'A', 'B', 'C'])
+        self.assertEqual(tree.lengths, [None, 0.3, 0.1, 0.2, 1.0])
+        self.assertEqual(tree.children, [[1, 4], [2, 3], [], [], []])
+        self.assertEqual(tree.edges, {0: 2, 1: 3, 2: 1, 3: 4})
+
+        # jplace version 1 puts the edge numbers in brackets
+        self.assertEqual(JplaceTree('(A:0.1[0],B:0.2[1]);').edges,
+                         {0: 1, 1: 2})
+
+        with self.assertRaisesRegex(ValueError, 'unbalanced'):
+            JplaceTree('((A:0.1{0},B:0.2{1});')
+
+
+class insertPlacementsTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.fp_template = join(self.out_dir, 'template.json')
+        with open(self.fp_template, 'w') as f:
+            json.dump({'tree': '((A:0.1{0},B:0.2{1})AB:0.3{2},C:1{3});',
+                       'placements': [], 'version': 3,
+                       'fields': ['edge_num', 'likelihood',
+                                  'like_weight_ratio', 'distal_length',
+                                  'pendant_length']}, f)
+        self.fp_tree = join(self.out_dir, 'tree.tre')
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_insert_placements(self):
+        placements = Placements.from_dict(OrderedDict([
+            # fragments at the same position are inserted by name, whatever
+            # the order of the placements
+            ('Z', [[0, -10.0, 1.0, 0.04, 0.02]]),
+            ('Y', [[2, -10.0, 1.0, 0.25, 0.2]]),
+            # the best placement is the one with the highest weight ratio
+            ('X', [[3, -10.0, 0.1, 0.5, 0.05], [0, -9.0, 0.9, 0.04, 0.01]])]))
+        insert_placements(self.fp_template, placements, self.fp_tree)
+        with open(self.fp_tree) as f:
+            self.assertEqual(
+                f.read(), '(((((A:0.04,X:0.01):0.0,Z:0.02):0.06,B:0.2)'
+                          'AB:0.25,Y:0.2):0.05,C:1.0);\n')
+
+    def test_insert_placements_previous(self):
+        fp_index = join(self.out_dir, 'tree.index.npz')
+        self.assertFalse(insert_placements(
+            self.fp_template, Placements.from_dict({
+                'X': [[0, -10.0, 1.0, 0.04, 0.01]],
+                'Y': [[2, -10.0, 1.0, 0.25, 0.2]],
+                'Z': [[0, -10.0, 1.0, 0.04, 0.02]]}),
+            self.fp_tree, fp_index))
+
+        # Y is removed, W is added, Z moves and X stays where it is
+        placements = Placements.from_dict(OrderedDict([
+            ('Z', [[3, -10.0, 1.0, 0.5, 0.02]]),
+            ('X', [[0, -10.0, 1.0, 0.04, 0.01]]),
+            ('W', [[0, -10.0, 1.0, 0.04, 0.03]])]))
+        fp_full = join(self.out_dir, 'full.tre')
+        insert_placements(self.fp_template, placements, fp_full)
+        with open(fp_full) as f:
+            exp = f.read()
+        self.assertEqual(exp, '((((A:0.04,W:0.03):0.0,X:0.01):0.06,B:0.2)'
+                              'AB:0.3,(C:0.5,Z:0.02):0.5);\n')
+
+        fp_updated = join(self.out_dir, 'updated.tre')
+        fp_updated_index = join(self.out_dir, 'updated.index.npz')
+        self.assertTrue(insert_placements(
+            self.fp_template, placements, fp_updated, fp_updated_index,
+            previous=(self.fp_tree, fp_index)))
+        with open(fp_updated) as f:
+            self.assertEqual(f.read(), exp)
+
+        # the index of the updated tree allows updating it again
+        insert_placements(self.fp_template, Placements.from_dict({}),
+                          self.fp_tree, previous=(fp_updated,
+                                                  fp_updated_index))
+        with open(self.fp_tree) as f:
+            self.assertEqual(f.read(), '((A:0.1,B:0.2)AB:0.3,C:1.0);\n')
+
+        # an index of another template is not used
+        with open(self.fp_template, 'a') as f:
+            f.write('\n')
+        self.assertFalse(insert_placements(
+            self.fp_template, placements, fp_updated,
+            previous=(self.fp_tree, fp_updated_index)))
+
+    def test_load_reference_tree(self):
+        tree, template = load_reference_tree(self.fp_template)
+        self.assertEqual(tree.names, ['', 'AB', 'A', 'B', 'C'])
+        self.assertEqual(template, {})
+        # the tree is only read again once the template changes
+        self.assertIs(load_reference_tree(self.fp_template)[0], tree)
+        with open(self.fp_template, 'a') as f:
+            f.write('\n')
+        self.assertIsNot(load_reference_tree(self.fp_template)[0], tree)
+
+    def test_insert_placements_errors(self):
+        placements = Placements.from_dict({'X': [[7, -1.0, 1.0, 0.1, 0.1]]})
+        with self.assertRaisesRegex(ValueError, 'edge 7'):
+            insert_placements(self.fp_template, placements, self.fp_tree)
+
+    def test_insert_placements_guppy(self):
+        # support_files/insertion_tree.relabelled.tre was inserted by
+        # 'guppy tog' into the tiny reference, whose template has placements
+        # of its own
+        fp_exp = join('support_files', 'insertion_tree.relabelled.tre')
+        with open(fp_exp) as f:
+            exp = f.read()
+        with open(join('support_files', 'test_archive_file.json')) as f:
+            archived = json.load(f)
+        placements = Placements.from_dict(
+            {seq: plc for seq, plc in archived.items() if seq in exp})
+        self.assertEqual(len(placements), 2)
+
+        insert_placements(
+            join('support_files', 'sepp', 'tmpl_tiny_placement.json'),
+            placements, self.fp_tree)
+        with open(self.fp_tree) as f:
+            self.assertEqual(f.read(), exp)
+
+
+class relabelTreeTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.fp_revnamemap = join(self.out_dir, 'revnamemap.json')
+        with open(self.fp_revnamemap, 'w') as f:
+            json.dump({'UQrYOlnDN0A': 'A', 'UQrYOlnDN0B': 'B b',
+                       'UQrYOlnDN0C': '0.7'}, f)
+        self.fp_tree = join(self.out_dir, 'tree.tre')
+        self.fp_out = join(self.out_dir, 'relabelled.tre')
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_relabel_tree(self):
+        with open(self.fp_tree, 'w') as f:
+            f.write("((UQrYOlnDN0A:0.1,UQrYOlnDN0B:0.2)UQrYOlnDN0C:0.3,"
+                    "UQrYOlnDN0D:1.0,xUQrYOlnDN0A,UQrYOlnDNUQrYOlnDN0B)"
+                    "UQrYOlnDN0A;\n")
+        # a small chunk size splits names across chunks
+        for chunk_size in (3, 1024):
+            relabel_tree(self.fp_tree, self.fp_out, self.fp_revnamemap,
+                         chunk_size)
+            with open(self.fp_out) as f:
+                # the root name runs into ';' and the line break, and a
+                # match starts at the first escape prefix, even though all
+                # names of the map share a longer one, so the rename scripts
+                # leave them alone
+                self.assertEqual(
+                    f.read(), "((A:0.1,'B b':0.2)'0.7':0.3,UQrYOlnDN0D:1.0,"
+                              "xA,UQrYOlnDNUQrYOlnDN0B)UQrYOlnDN0A;\n")
+
+    def test_relabel_tree_rename_script(self):
+        fp_tree = join('support_files', 'insertion_tree.relabelled.tre')
+        with open(fp_tree) as f_in:
+            exp = run([sys.executable, join('support_files', 'sepp',
+                                            'tmpl_tiny_rename-json.py')],
+                      stdin=f_in, stdout=PIPE, stderr=PIPE,
+                      universal_newlines=True, check=True).stdout
+        relabel_tree(fp_tree, self.fp_out,
+                     join('support_files', 'sepp',
+                          'tmpl_tiny-revnamemap.json'))
+        with open(self.fp_out) as f:
+            self.assertEqual(f.read(), exp)
+
+
+class fillBranchLengthsTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.fp_tree = join(self.out_dir, 'tree.tre')
+        self.fp_out = join(self.out_dir, 'filled.tre')
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_fill_branch_lengths(self):
+        with open(self.fp_tree, 'w') as f:
+            f.write("((A:0.1,'B:(b''s)',):0.2,(C,D:1e-05)CD,())root;\n")
+        # a small chunk size splits names and lengths across chunks
+        for chunk_size in (2, 1024):
+            fill_branch_lengths(self.fp_tree, self.fp_out, chunk_size)
+            with open(self.fp_out) as f:
+                self.assertEqual(
+                    f.read(), "((A:0.1,'B:(b''s)':0.0,:0.0):0.2,"
+                              "(C:0.0,D:1e-05)CD:0.0,(:0.0):0.0)root;\n")
+
+    def test_fill_branch_lengths_guppy(self):
+        fp_tree = join('support_files', 'insertion_tree.relabelled.tre')
+        fill_branch_lengths(fp_tree, self.fp_out)
+        with open(fp_tree) as f:
+            exp = f.read()
+        with open(self.fp_out) as f:
+            self.assertEqual(f.read(), exp)
+
+
+class tipNamesTests(TestCase):
+    def test_tip_names(self):
+        out_dir = mkdtemp()
+        self.addCleanup(rmtree, out_dir)
+        fp_tree = join(out_dir, 'tree.tre')
+        with open(fp_tree, 'w') as f:
+            f.write("((ACGT:0.1,'B:(b''s)':0.2)AB:0.3,(, C_c,D)CD:0.0,"
+                    "(E:1)'F')root;\n")
+        # a small chunk size splits names across chunks
+        for chunk_size in (2, 1024):
+            self.assertEqual(tip_names(fp_tree, chunk_size),
+                             {'ACGT', "B:(b's)", 'C c', 'D', 'E'})
+
+        # the tips of an insertion tree are the reference and the fragments
+        obs = tip_names(join('support_files', 'insertion_tree.relabelled.tre'))
+        self.assertEqual(len(obs), 520)
+        self.assertIn('151811', obs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, utime, listdir, mkdir, remove
+from os.path import join, exists, realpath
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from contextlib import suppress
+from signal import SIGTERM
+from subprocess import Popen
+import sys
+
+from qp_deblur.util import (
+    get_setting, file_checksum, evict_lru, object_checksum, load_manifest,
+    step_completed, record_step, available_cpus, available_memory,
+    run_command)
+
+
+class utilTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+        for var in ('QP_DEBLUR_FOO', ):
+            if var in environ:
+                del environ[var]
+
+    def test_get_setting(self):
+        self.assertEqual(get_setting('FOO', 3), 3)
+        environ['QP_DEBLUR_FOO'] = '5'
+        self.assertEqual(get_setting('FOO', 3), 5)
+        self.assertEqual(get_setting('FOO', None), '5')
+        environ['QP_DEBLUR_FOO'] = 'yes'
+        self.assertTrue(get_setting('FOO', False))
+        with self.assertRaisesRegex(ValueError, 'QP_DEBLUR_FOO should be'):
+            get_setting('FOO', 3)
+
+    def test_file_checksum(self):
+        fp = join(self.out_dir, 'a.txt')
+        with open(fp, 'w') as f:
+            f.write('ACGT')
+        self.assertEqual(
+            file_checksum(fp).hexdigest(),
+            '1dff3e84fe7877e0673b69bbddcf40124e396e3f9943dd890c91b6a09adb9af0')
+
+    def test_evict_lru(self):
+        for i, name in enumerate(['a', 'b', 'c']):
+            with open(join(self.out_dir, name), 'w') as f:
+                f.write('x' * 10)
+            utime(join(self.out_dir, name), (i, i))
+        # the least recently used file goes first
+        evict_lru(self.out_dir, 25)
+        self.assertCountEqual(listdir(self.out_dir), ['b', 'c'])
+        evict_lru(self.out_dir, 100)
+        self.assertCountEqual(listdir(self.out_dir), ['b', 'c'])
+        evict_lru(self.out_dir, 0)
+        self.assertEqual(listdir(self.out_dir), [])
+
+    def test_object_checksum(self):
+        self.assertEqual(object_checksum({'a': 1, 'b': [1, 2]}),
+                         object_checksum({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(object_checksum({'a': 1}),
+                            object_checksum({'a': 2}))
+
+    def test_step_manifest(self):
+        fp_manifest = join(self.out_dir, 'step_manifest.json')
+        self.assertEqual(load_manifest(fp_manifest), {})
+
+        step_dir = join(self.out_dir, 'split')
+        mkdir(step_dir)
+        fp = join(step_dir, 's1.fastq')
+        with open(fp, 'w') as f:
+            f.write('ACGT')
+        manifest = {}
+        record_step(fp_manifest, manifest, 'split', {'input': 'abc'},
+                    [step_dir, join(self.out_dir, 'missing')])
+        self.assertEqual(list(load_manifest(fp_manifest)['split']['files']),
+                         [fp])
+
+        manifest = load_manifest(fp_manifest)
+        self.assertTrue(step_completed(manifest, 'split', {'input': 'abc'}))
+        self.assertFalse(step_completed(manifest, 'split', {'input': 'xyz'}))
+        self.assertFalse(step_completed(manifest, 'deblur', {'input': 'abc'}))
+
+        # modified files invalidate the step, even if their size is the same
+        with open(fp, 'w') as f:
+            f.write('ACGA')
+        mtime_ns = load_manifest(fp_manifest)['split']['files'][fp][
+            'mtime_ns']
+        utime(fp, ns=(mtime_ns, mtime_ns + 1000000000))
+        self.assertFalse(step_completed(manifest, 'split', {'input': 'abc'}))
+        # the state of the file is what matters, a removed file never matches
+        utime(fp, ns=(mtime_ns, mtime_ns))
+        self.assertTrue(step_completed(manifest, 'split', {'input': 'abc'}))
+        remove(fp)
+        self.assertFalse(step_completed(manifest, 'split', {'input': 'abc'}))
+
+    def test_available_resources(self):
+        self.assertGreaterEqual(available_cpus(), 1)
+        self.assertGreater(available_memory(), 0)
+
+    def test_run_command(self):
+        prefix = join(self.out_dir, 'cmd')
+        std_out, std_err, return_value = run_command(
+            ['sh', '-c', 'pwd; echo oops >&2; exit 3'], prefix,
+            cwd=self.out_dir)
+        self.assertEqual(return_value, 3)
+        self.assertEqual(std_err, 'oops\n')
+        self.assertEqual(std_out, '%s\n' % realpath(self.out_dir))
+        with open('%s.stdout.log' % prefix) as f:
+            self.assertEqual(f.read(), std_out)
+
+        # standard input and output can be files
+        fp_in, fp_out = join(self.out_dir, 'in'), join(self.out_dir, 'out')
+        with open(fp_in, 'w') as f:
+            f.write('ACGT\n')
+        with open(fp_in) as f_in, open(fp_out, 'w') as f_out:
+            std_out, _, return_value = run_command(
+                ['cat'], prefix, stdin=f_in, stdout=f_out)
+        self.assertEqual((std_out, return_value), ('', 0))
+        with open(fp_out) as f:
+            self.assertEqual(f.read(), 'ACGT\n')
+
+        _, std_err, return_value = run_command(
+            [join(self.out_dir, 'missing')], prefix)
+        self.assertEqual(return_value, 127)
+        self.assertIn('No such file', std_err)
+
+    def test_run_command_timeout(self):
+        prefix = join(self.out_dir, 'cmd')
+        fp = join(self.out_dir, 'done')
+        # the child of the command is killed as well
+        with self.assertRaisesRegex(ValueError, 'timed out after 0.5'):
+            run_command(['sh', '-c', 'echo started; (sleep 1; touch %s) & '
+                         'wait' % fp], prefix, timeout=0.5)
+        with open('%s.stdout.log' % prefix) as f:
+            self.assertEqual(f.read(), 'started\n')
+        sleep(1)
+        self.assertFalse(exists(fp))
+
+    def test_handle_sigterm(self):
+        prefix = join(self.out_dir, 'cmd')
+        job = Popen([sys.executable, '-c', (
+            'from qp_deblur.util import handle_sigterm, run_command\n'
+            'handle_sigterm()\n'
+            'run_command(["sh", "-c", "sleep 60 & echo $!; wait"], %r)\n'
+            % prefix)])
+        self.addCleanup(job.kill)
+        pid = None
+        for _ in range(100):
+            with suppress(IOError):
+                with open('%s.stdout.log' % prefix) as f:
+                    pid = f.read().strip()
+            if pid:
+                break
+            sleep(0.1)
+        self.assertTrue(pid)
+
+        # the job exits and the sleep started by its command is killed
+        job.send_signal(SIGTERM)
+        self.assertEqual(job.wait(timeout=30), 128 + SIGTERM)
+        for _ in range(50):
+            if not _alive(int(pid)):
+                break
+            sleep(0.1)
+        self.assertFalse(_alive(int(pid)))
+
+
+def _alive(pid):
+    """Whether a process is running, zombies are not"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+if __name__ == '__main__':
+    main()
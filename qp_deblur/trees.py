@@ -0,0 +1,693 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from functools import lru_cache
+from os import stat
+from os.path import abspath, exists
+from string import punctuation, whitespace
+import json
+import re
+
+import numpy as np
+
+from qp_deblur.placements import Placements, _jplace_fields, _JSONReader
+
+# the tokens of a jplace tree: structure, branch lengths, edge numbers (as
+# {n} or [n], depending on the jplace version) and names
+_TOKENS = re.compile(
+    r"[(),;]|:[^(),:;\[\]{}]*|\{\d+\}|\[\d+\]|'(?:[^']|'')*'|[^(),:;\[\]{}']+")
+
+# the tokens of an escaped tree as seen by the rename scripts of SEPP: the
+# delimiters and the runs between them, which end at a line break
+_RENAME_TOKENS = re.compile(r"[(),:<>]|[^(),:<>\n]+\n?|\n")
+# the fixed prefix SEPP escapes node names with, where the regular expression
+# of its rename scripts starts a match
+_ESCAPE_PREFIX = 'UQrYOlnDN'
+_QUOTED_CHARS = frozenset(punctuation + whitespace)
+
+# the tokens of a Newick tree as far as its branch lengths are concerned:
+# quoted names, which may be cut off by the end of a chunk, the delimiters
+# and the runs between them
+_NEWICK_TOKENS = re.compile(r"'(?:[^']|'')*'?|[(),:;]|[^(),:;']+")
+
+
+class JplaceTree(object):
+    """The reference tree of a jplace file, indexed by edge number
+
+    Parameters
+    ----------
+    newick : str
+        The tree of the jplace file, a Newick tree with the edge numbers of
+        pplacer
+
+    Attributes
+    ----------
+    names : list of str
+        The name of each node, as written in the tree
+    lengths : list of float or None
+        The length of the edge above each node
+    children : list of list of int
+        The children of each node
+    edges : dict of {int: int}
+        The node below each edge, keyed by edge number
+    root : int
+        The root node
+
+    Raises
+    ------
+    ValueError
+        If the tree is not a valid jplace tree
+    """
+    def __init__(self, newick):
+        self.names, self.lengths, self.children = [], [], []
+        self.edges = {}
+        self.root = self._add()
+        node = self.root
+        stack = []
+        for token in _TOKENS.findall(newick):
+            if token == '(':
+                stack.append(node)
+                child = self._add()
+                self.children[node].append(child)
+                node = child
+            elif token == ',':
+                if not stack:
+                    raise ValueError("Invalid jplace tree: ',' at the root")
+                child = self._add()
+                self.children[stack[-1]].append(child)
+                node = child
+            elif token == ')':
+                if not stack:
+                    raise ValueError("Invalid jplace tree: unbalanced ')'")
+                node = stack.pop()
+            elif token == ';':
+                break
+            elif token[0] == ':':
+                self.lengths[node] = float(token[1:])
+            elif token[0] in '{[':
+                self.edges[int(token[1:-1])] = node
+            else:
+                self.names[node] += token.strip()
+        if stack:
+            raise ValueError("Invalid jplace tree: unbalanced '('")
+
+    def _add(self):
+        """Adds a node to the tree, returning its index"""
+        self.names.append('')
+        self.lengths.append(None)
+        self.children.append([])
+        return len(self.names) - 1
+
+
+def _format_length(length):
+    """Formats a branch length the way guppy does"""
+    text = '%g' % length
+    if text.lstrip('-').isdigit():
+        text += '.0'
+    return text
+
+
+def _best_placements(placements):
+    """Finds the best placement of each fragment
+
+    Parameters
+    ----------
+    placements : qp_deblur.placements.Placements
+        The placements
+
+    Returns
+    -------
+    np.ndarray of PLACEMENT_DTYPE
+        The placement line with the highest like_weight_ratio of each
+        fragment, the first one of ties, in the order of the fragments
+    """
+    counts = np.diff(placements.offsets)
+    if not len(counts) or counts.min() < 1:
+        raise ValueError("Every fragment needs at least one placement")
+    fragment = np.repeat(np.arange(len(counts)), counts)
+    # lexsort is stable, so ties keep the order of the lines
+    order = np.lexsort((-placements.lines['like_weight_ratio'], fragment))
+    return placements.lines[order[placements.offsets[:-1]]]
+
+
+def _add_grafts(edges, placements, inserted):
+    """Adds the best placement of each fragment to the grafts of its node
+
+    Parameters
+    ----------
+    edges : dict of {int: int}
+        The node below each edge, keyed by edge number
+    placements : qp_deblur.placements.Placements
+        The placements of the fragments
+    inserted : dict of {int: list of (float, str, float)}
+        The distal length, name and pendant length of the fragments inserted
+        above each node, in the order they were added
+
+    Raises
+    ------
+    ValueError
+        If a placement refers to an edge that is not in the reference tree
+    """
+    if not len(placements):
+        return
+    best = _best_placements(placements)
+    for fragment, line in zip(placements.fragments, best.tolist()):
+        edge_num, _, _, distal, pendant = line
+        if edge_num not in edges:
+            raise ValueError("Fragment '%s' is placed on edge %s which "
+                             "is not in the reference tree"
+                             % (fragment, edge_num))
+        inserted.setdefault(edges[edge_num], []).append(
+            (distal, fragment, pendant))
+
+
+def _sorted_grafts(template, placements, edges):
+    """Returns the grafts of each node, in the order they are written
+
+    Parameters
+    ----------
+    template : dict of {int: list of (float, str, float)}
+        The grafts of the placements of the template
+    placements : qp_deblur.placements.Placements
+        The placements of the fragments
+    edges : dict of {int: int}
+        The node below each edge, keyed by edge number
+
+    Returns
+    -------
+    dict of {int: list of (float, str, float)}
+        The distal length, name and pendant length of the fragments inserted
+        above each node, sorted by distal length; fragments at the same
+        position are sorted by name, after those of the template
+    """
+    # the order of the placements depends on the dict they came from, so it
+    # can't break ties
+    added = {}
+    _add_grafts(edges, placements, added)
+    inserted = {node: list(grafts) for node, grafts in template.items()}
+    for node, grafts in added.items():
+        inserted.setdefault(node, []).extend(sorted(grafts))
+    for grafts in inserted.values():
+        # sort is stable, fragments at the same position keep their order
+        grafts.sort(key=lambda graft: graft[0])
+    return inserted
+
+
+def _template_id(fp_template):
+    """Identifies a placement template by its path, size and modification
+    time"""
+    template_stat = stat(fp_template)
+    return '%s:%d:%d' % (abspath(fp_template), template_stat.st_size,
+                         template_stat.st_mtime_ns)
+
+
+def load_reference_tree(fp_template):
+    """Reads the reference tree of a placement template, once per process
+
+    Parameters
+    ----------
+    fp_template : str
+        The path to the placement template of the reference
+
+    Returns
+    -------
+    (JplaceTree, dict of {int: list of (float, str, float)})
+        The reference tree and the grafts of the placements of the template,
+        see _add_grafts; neither may be modified
+
+    Raises
+    ------
+    ValueError
+        If the template is not a valid jplace file
+    """
+    return _load_reference_tree(fp_template, _template_id(fp_template))
+
+
+# reference trees are large, only the most recently used ones are kept
+@lru_cache(maxsize=2)
+def _load_reference_tree(fp_template, template_id):
+    """Reads the reference tree of a placement template, see
+    load_reference_tree"""
+    with open(fp_template) as f:
+        newick = None
+        for key, value in _JSONReader(f, 1024 * 1024).members('placements'):
+            if key == 'tree':
+                newick = value
+                break
+    if newick is None:
+        raise ValueError("The template '%s' has no tree" % fp_template)
+    tree = JplaceTree(newick)
+
+    # the template placements can't be read without their fields
+    template = {}
+    try:
+        _jplace_fields(fp_template, 1024 * 1024)
+    except ValueError:
+        pass
+    else:
+        _add_grafts(tree.edges, Placements.from_jplace(fp_template),
+                    template)
+    return tree, template
+
+
+def insert_placements(fp_template, placements, fp_tree, fp_index=None,
+                      previous=None):
+    """Inserts the fragments into the reference tree, like guppy tog
+
+    Parameters
+    ----------
+    fp_template : str
+        The path to the placement template of the reference, its placements
+        are inserted as well
+    placements : qp_deblur.placements.Placements
+        The placements of the fragments
+    fp_tree : str
+        The path to write the Newick tree to; node names are escaped as in
+        the template
+    fp_index : str, optional
+        The path to write the index of the tree to, which lets a later
+        insertion update the tree instead of building it again
+    previous : (str, str), optional
+        The paths to a tree inserted before and to its index. If the index
+        belongs to the same template, only the nodes whose fragments changed
+        are written again.
+
+    Returns
+    -------
+    bool
+        Whether the previous tree was updated
+
+    Raises
+    ------
+    ValueError
+        If the template is not a valid jplace file, or a placement refers to
+        an edge that is not in the reference tree
+
+    Notes
+    -----
+    Each fragment is attached by a pendant edge of its pendant_length to the
+    edge of its best placement, at distal_length from the end of the edge
+    away from the root. Fragments placed on the same edge are attached in
+    the order of their distal_length, fragments of the template first and
+    the others by name.
+
+    An updated tree is identical to the tree built from scratch: the text of
+    a node only depends on its name, length and fragments, so the text of the
+    nodes whose fragments didn't change is copied from the previous tree.
+    """
+    template_id = _template_id(fp_template)
+    if previous is not None and all(exists(fp) for fp in previous):
+        index = _load_index(previous[1])
+        if index['template'] == template_id:
+            _update_tree(index, placements, previous[0], fp_tree, fp_index)
+            return True
+
+    tree, template = load_reference_tree(fp_template)
+    inserted = _sorted_grafts(template, placements, tree.edges)
+
+    offsets = None
+    if fp_index is not None:
+        offsets = np.zeros((4, len(tree.names)), dtype=np.int64)
+    with open(fp_tree, 'w') as f:
+        f.write(''.join(_newick_tokens(tree, inserted, offsets)))
+        f.write('\n')
+
+    if fp_index is not None:
+        lengths = np.array([np.nan if length is None else length
+                            for length in tree.lengths])
+        _save_index(fp_index, {
+            'template': template_id, 'root': tree.root, 'offsets': offsets,
+            'lengths': lengths, 'edges': tree.edges,
+            'template_grafts': template, 'grafts': inserted})
+    return False
+
+
+def _save_index(fp_index, index):
+    """Writes the index of an insertion tree
+
+    Parameters
+    ----------
+    fp_index : str
+        The path to the index, a numpy .npz file
+    index : dict
+        The id of the template, the root, the offsets of each node in the
+        tree (see _newick_tokens), the lengths, the edges, the grafts of the
+        template and the grafts of the tree
+    """
+    arrays = {'offsets': index['offsets'], 'lengths': index['lengths'],
+              'edges': np.array(sorted(index['edges'].items()),
+                                dtype=np.int64).reshape(-1, 2)}
+    names = {}
+    for key in ('template_grafts', 'grafts'):
+        nodes = sorted(index[key])
+        arrays[key] = np.array(
+            [(node, distal, pendant) for node in nodes
+             for distal, _, pendant in index[key][node]],
+            dtype=np.float64).reshape(-1, 3)
+        names[key] = [name for node in nodes
+                      for _, name, _ in index[key][node]]
+    header = json.dumps({'template': index['template'],
+                         'root': index['root'], 'names': names})
+    arrays['header'] = np.frombuffer(header.encode(), dtype=np.uint8)
+    with open(fp_index, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _load_index(fp_index):
+    """Reads the index of an insertion tree, see _save_index"""
+    with np.load(fp_index) as arrays:
+        header = json.loads(arrays['header'].tobytes().decode())
+        index = {'template': header['template'], 'root': header['root'],
+                 'offsets': arrays['offsets'], 'lengths': arrays['lengths'],
+                 'edges': dict(arrays['edges'].tolist())}
+        for key in ('template_grafts', 'grafts'):
+            grafts = {}
+            for (node, distal, pendant), name in zip(
+                    arrays[key].tolist(), header['names'][key]):
+                grafts.setdefault(int(node), []).append(
+                    (distal, name, pendant))
+            index[key] = grafts
+    return index
+
+
+def _update_tree(index, placements, fp_previous, fp_tree, fp_index):
+    """Writes an insertion tree by updating the nodes of a previous one
+
+    Parameters
+    ----------
+    index : dict
+        The index of the previous tree, see _save_index
+    placements : qp_deblur.placements.Placements
+        The placements of the fragments
+    fp_previous : str
+        The path to the previous tree
+    fp_tree : str
+        The path to write the tree to
+    fp_index : str or None
+        The path to write the index of the tree to
+    """
+    inserted = _sorted_grafts(index['template_grafts'], placements,
+                              index['edges'])
+    previous = index['grafts']
+    touched = [node for node in set(previous).union(inserted)
+               if previous.get(node, []) != inserted.get(node, [])]
+
+    with open(fp_previous) as f:
+        text = f.read()
+    node_start, tail_start, tail_end, name_length = index['offsets'].tolist()
+    # each edit replaces text[start:end]; they are sorted by their key, which
+    # puts the prefix of a node before its tail at the same offset
+    edits = []
+    for node in touched:
+        grafts = inserted.get(node, [])
+        start = node_start[node]
+        edits.append((start * 4, start, start + len(previous.get(node, [])),
+                      '(' * len(grafts)))
+        start = tail_start[node]
+        length = index['lengths'][node]
+        edits.append((start * 4 + 1, start, tail_end[node], _tail(
+            text[start:start + name_length[node]],
+            None if np.isnan(length) else float(length), grafts,
+            node == index['root'])))
+    edits.sort()
+
+    with open(fp_tree, 'w') as f:
+        position = 0
+        for _, start, end, replacement in edits:
+            f.write(text[position:start])
+            f.write(replacement)
+            position = end
+        f.write(text[position:])
+
+    if fp_index is not None:
+        # an offset moves by the edits before it, the same key order is used
+        # for the start (0), tail (1) and end (2) of the nodes
+        keys = np.array([edit[0] for edit in edits], dtype=np.int64)
+        shifts = np.concatenate([[0], np.cumsum(
+            [len(edit[3]) - (edit[2] - edit[1]) for edit in edits],
+            dtype=np.int64)])
+        offsets = index['offsets'].copy()
+        for kind in (0, 1, 2):
+            offsets[kind] += shifts[np.searchsorted(
+                keys, offsets[kind] * 4 + kind)]
+        _save_index(fp_index, dict(index, offsets=offsets, grafts=inserted))
+
+
+def _tail(name, length, grafts, is_root):
+    """Returns the text of a node after its children
+
+    Parameters
+    ----------
+    name : str
+        The name of the node
+    length : float or None
+        The length of the edge above the node
+    grafts : list of (float, str, float)
+        The distal length, name and pendant length of the fragments inserted
+        above the node, sorted by distal length
+    is_root : bool
+        Whether the node is the root
+
+    Returns
+    -------
+    str
+        The name of the node, the fragments inserted above it, the rest of
+        its length and, for the root, the end of the tree
+    """
+    tail = [name]
+    distal = 0.0
+    for position, fragment, pendant in grafts:
+        tail.append(':%s,%s:%s)' % (_format_length(position - distal),
+                                    fragment, _format_length(pendant)))
+        distal = position
+    if length is not None:
+        tail.append(':%s' % _format_length(length - distal))
+    if is_root:
+        tail.append(';')
+    return ''.join(tail)
+
+
+def _newick_tokens(tree, inserted, offsets=None):
+    """Yields the Newick tree with the inserted fragments
+
+    Parameters
+    ----------
+    tree : JplaceTree
+        The reference tree
+    inserted : dict of {int: list of (float, str, float)}
+        The distal length, name and pendant length of the fragments inserted
+        above each node, sorted by distal length
+    offsets : np.ndarray of int64, optional
+        Filled with the offset in the tree of the start of each node, of its
+        tail (see _tail) and of the end of its tail, and the length of its
+        name
+
+    Yields
+    ------
+    str
+        The pieces of the Newick tree
+
+    Notes
+    -----
+    The tree is walked without recursion, reference trees are too deep for
+    Python's recursion limit.
+    """
+    position = 0
+    stack = [(True, tree.root)]
+    while stack:
+        is_node, node = stack.pop()
+        if not is_node:
+            if node == ',':
+                position += 1
+                yield node
+                continue
+            # the tail of an internal node follows its children
+            tail = _tail(tree.names[node], tree.lengths[node],
+                         inserted.get(node, []), node == tree.root)
+            position += 1
+            if offsets is not None:
+                offsets[1:3, node] = position, position + len(tail)
+            position += len(tail)
+            yield ')' + tail
+            continue
+
+        prefix = '(' * len(inserted.get(node, []))
+        if offsets is not None:
+            offsets[0, node] = position
+            offsets[3, node] = len(tree.names[node])
+        position += len(prefix)
+        if tree.children[node]:
+            position += 1
+            yield prefix + '('
+            stack.append((False, node))
+            for i, child in enumerate(reversed(tree.children[node])):
+                if i:
+                    stack.append((False, ','))
+                stack.append((True, child))
+        else:
+            tail = _tail(tree.names[node], tree.lengths[node],
+                         inserted.get(node, []), node == tree.root)
+            if offsets is not None:
+                offsets[1:3, node] = position, position + len(tail)
+            position += len(tail)
+            yield prefix + tail
+
+
+@lru_cache(maxsize=None)
+def _load_revnamemap(fp_revnamemap):
+    """Loads the name map of a reference, once per process
+
+    Parameters
+    ----------
+    fp_revnamemap : str
+        The path to the name map as JSON
+
+    Returns
+    -------
+    dict of {str: str}
+        The name of each escaped name as written to the relabelled tree,
+        quoted if needed
+    """
+    with open(fp_revnamemap) as f:
+        revnamemap = json.load(f)
+    labels = {}
+    for escaped, name in revnamemap.items():
+        if _QUOTED_CHARS.intersection(name):
+            name = "'%s'" % name
+        labels[escaped] = name
+    return labels
+
+
+def relabel_tree(fp_tree, fp_out, fp_revnamemap, chunk_size=1024 * 1024):
+    """Undoes the escaping of the node names of a tree, like the rename
+    script of the reference
+
+    Parameters
+    ----------
+    fp_tree : str
+        The path to the tree with escaped names
+    fp_out : str
+        The path to write the relabelled tree to
+    fp_revnamemap : str
+        The path to the name map of the reference as JSON
+    chunk_size : int, optional
+        The number of characters read at a time
+
+    Notes
+    -----
+    A name is replaced if the run of characters between two delimiters, from
+    the first occurrence of SEPP's escape prefix on, is in the name map,
+    exactly where the rename script's regular expression would match.
+    """
+    labels = _load_revnamemap(fp_revnamemap)
+    with open(fp_tree) as f_in, open(fp_out, 'w') as f_out:
+        carry = ''
+        while True:
+            chunk = f_in.read(chunk_size)
+            tokens = _RENAME_TOKENS.findall(carry + chunk)
+            carry = ''
+            # the last run may continue in the next chunk
+            if chunk and tokens and tokens[-1][-1] not in '(),:<>\n':
+                carry = tokens.pop()
+            pieces = []
+            for token in tokens:
+                start = token.find(_ESCAPE_PREFIX)
+                if start != -1 and token[start:] in labels:
+                    token = token[:start] + labels[token[start:]]
+                pieces.append(token)
+            f_out.write(''.join(pieces))
+            if not chunk:
+                break
+
+
+def fill_branch_lengths(fp_tree, fp_out, chunk_size=1024 * 1024):
+    """Gives every branch of a tree without a length a length of 0.0
+
+    Parameters
+    ----------
+    fp_tree : str
+        The path to the Newick tree
+    fp_out : str
+        The path to write the tree to
+    chunk_size : int, optional
+        The number of characters read at a time
+
+    Notes
+    -----
+    The tree is streamed and otherwise written as it is, so scikit-bio reads
+    the same tree as if it had set the missing lengths of all nodes but the
+    root to 0.0 itself.
+    """
+    with open(fp_tree) as f_in, open(fp_out, 'w') as f_out:
+        carry = ''
+        has_length = False
+        while True:
+            chunk = f_in.read(chunk_size)
+            tokens = _NEWICK_TOKENS.findall(carry + chunk)
+            carry = ''
+            # the last name or length may continue in the next chunk
+            if chunk and tokens and tokens[-1] not in '(),:;':
+                carry = tokens.pop()
+            pieces = []
+            for token in tokens:
+                if token == ':':
+                    has_length = True
+                elif token in '(),':
+                    if token != '(' and not has_length:
+                        pieces.append(':0.0')
+                    has_length = False
+                pieces.append(token)
+            f_out.write(''.join(pieces))
+            if not chunk:
+                break
+
+
+def tip_names(fp_tree, chunk_size=1024 * 1024):
+    """Returns the names of the tips of a tree, as scikit-bio reads them
+
+    Parameters
+    ----------
+    fp_tree : str
+        The path to the Newick tree
+    chunk_size : int, optional
+        The number of characters read at a time
+
+    Returns
+    -------
+    set of str
+        The names of the tips; quotes are removed from quoted names and
+        underscores in unquoted names are read as spaces
+
+    Notes
+    -----
+    A tip is a name right after '(' or ',', so the tree is only tokenized,
+    not built.
+    """
+    names = set()
+    with open(fp_tree) as f:
+        carry = ''
+        is_tip = True
+        while True:
+            chunk = f.read(chunk_size)
+            tokens = _NEWICK_TOKENS.findall(carry + chunk)
+            carry = ''
+            # the last name may continue in the next chunk
+            if chunk and tokens and tokens[-1] not in '(),:;':
+                carry = tokens.pop()
+            for token in tokens:
+                if token in '(),:;':
+                    is_tip = token in '(,'
+                elif is_tip and not token.isspace():
+                    if token[0] == "'":
+                        names.add(token[1:-1].replace("''", "'"))
+                    else:
+                        names.add(token.strip().replace('_', ' '))
+                    is_tip = False
+            if not chunk:
+                break
+    return names
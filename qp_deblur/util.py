@@ -0,0 +1,506 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import (environ, walk, stat, remove, rename, cpu_count, sysconf,
+                killpg)
+from os.path import join, exists, isdir
+from collections import deque
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from hashlib import sha256
+from json import dumps, dump, load
+from math import ceil
+from signal import SIGTERM, SIGKILL, signal
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from threading import Event, RLock, Thread
+
+# not available on every platform, e.g. macOS
+try:
+    from os import sched_getaffinity
+except ImportError:
+    sched_getaffinity = None
+
+# the size a command log grows to before it is rotated, and the number of
+# rotated logs kept
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 2
+# the number of lines of each output of a command kept for error messages
+LOG_TAIL_LINES = 50
+# the seconds a command gets to exit after SIGTERM before it is killed
+KILL_GRACE = 10
+
+# the commands started by run_command that are still running, and whether
+# the job was cancelled, see handle_sigterm
+_RUNNING = set()
+_RUNNING_LOCK = RLock()
+_CANCELLED = Event()
+
+
+def get_setting(name, default):
+    """Returns a node level setting of the plugin
+
+    Parameters
+    ----------
+    name : str
+        The name of the setting, read from the environment variable
+        QP_DEBLUR_<name>
+    default : bool, int, float or str
+        The value to use if the variable is not set. The value read from the
+        environment is cast to the type of the default.
+
+    Returns
+    -------
+    bool, int, float or str
+        The value of the setting
+
+    Raises
+    ------
+    ValueError
+        If the value in the environment can't be cast to the type of default
+
+    Notes
+    -----
+    These settings describe how the plugin executes on the node it has been
+    deployed to (e.g. parallelism or cache locations), they are not part of
+    the Qiita command parameters as they don't change the results of a job.
+    The exception is GUPPY_PRECISION, which rounds the placements written
+    for guppy when the tree engine is guppy.
+    """
+    var = 'QP_DEBLUR_%s' % name
+    value = environ.get(var, '').strip()
+    if not value:
+        return default
+
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if default is None or isinstance(default, str):
+        return value
+    try:
+        return type(default)(value)
+    except ValueError:
+        raise ValueError("%s should be of type %s, not '%s'" % (
+            var, type(default).__name__, value))
+
+
+def file_checksum(fp, checksum=None):
+    """Computes the checksum of a file
+
+    Parameters
+    ----------
+    fp : str
+        The path to the file
+    checksum : hashlib hash, optional
+        The hash to update, a new sha256 is used if None
+
+    Returns
+    -------
+    hashlib hash
+        The updated hash
+    """
+    if checksum is None:
+        checksum = sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum
+
+
+def evict_lru(cache_dir, max_size):
+    """Removes the least recently used files of a cache directory
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory
+    max_size : int
+        The maximum size of the cache directory in bytes
+
+    Notes
+    -----
+    The modification time of a file is its last use, so readers of a cache
+    entry need to update it with os.utime. Several jobs can share a cache
+    directory, so files that disappear while evicting are ignored.
+    """
+    entries = []
+    for root, _, files in walk(cache_dir):
+        for f in files:
+            try:
+                st = stat(join(root, f))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, join(root, f)))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, fp in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            remove(fp)
+        except OSError:
+            pass
+        total -= size
+
+
+def object_checksum(obj):
+    """Computes the checksum of a JSON serializable object
+
+    Parameters
+    ----------
+    obj : object
+        The object, e.g. a dict of parameters
+
+    Returns
+    -------
+    str
+        The sha256 hex digest of the object's sorted JSON representation
+    """
+    return sha256(dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(fp):
+    """Loads the step manifest of a job
+
+    Parameters
+    ----------
+    fp : str
+        The path to the manifest
+
+    Returns
+    -------
+    dict
+        The completed steps of the job, empty if the manifest doesn't exist
+        or can't be read
+    """
+    try:
+        with open(fp) as f:
+            return load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def step_completed(manifest, step, inputs):
+    """Checks if a job step completed with the given inputs
+
+    Parameters
+    ----------
+    manifest : dict
+        The step manifest of the job
+    step : str
+        The name of the step
+    inputs : dict of {str: str}
+        The checksums of the inputs of the step
+
+    Returns
+    -------
+    bool
+        Whether the step completed with the same inputs and all the files it
+        produced are still intact
+
+    Notes
+    -----
+    The files are compared by size and modification time, reading them
+    again would cost as much as a good part of the step.
+    """
+    entry = manifest.get(step)
+    if entry is None or entry['inputs'] != inputs:
+        return False
+    for fp, info in entry['files'].items():
+        if not exists(fp) or _file_state(fp) != info:
+            return False
+    return True
+
+
+def _file_state(fp):
+    """Returns the size and modification time of a file, see record_step"""
+    st = stat(fp)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def record_step(fp, manifest, step, inputs, files):
+    """Records a completed job step in the step manifest
+
+    Parameters
+    ----------
+    fp : str
+        The path to the manifest
+    manifest : dict
+        The step manifest of the job, updated in place
+    step : str
+        The name of the step
+    inputs : dict of {str: str}
+        The checksums of the inputs of the step
+    files : list of str
+        The files and directories produced by the step
+    """
+    fps = []
+    for path in files:
+        if isdir(path):
+            fps.extend(join(root, f)
+                       for root, _, dfiles in walk(path) for f in dfiles)
+        elif exists(path):
+            fps.append(path)
+    manifest[step] = {'inputs': inputs,
+                      'files': {f: _file_state(f) for f in fps}}
+
+    # the manifest is replaced atomically so a job dying while writing it
+    # never leaves a partial manifest behind
+    with open('%s.tmp' % fp, 'w') as f:
+        dump(manifest, f)
+    rename('%s.tmp' % fp, fp)
+
+
+@contextmanager
+def file_lock(fp):
+    """Holds an exclusive lock on a file while in the context
+
+    Parameters
+    ----------
+    fp : str
+        The path to the lock file, created if it doesn't exist
+
+    Notes
+    -----
+    The lock is shared by all the processes of the node using the same lock
+    file, e.g. the jobs building the same cache entry.
+    """
+    with open(fp, 'a') as f:
+        flock(f, LOCK_EX)
+        try:
+            yield
+        finally:
+            flock(f, LOCK_UN)
+
+
+def _read_cgroup(fp):
+    """Reads the first line of a cgroup file, None if it can't be read"""
+    try:
+        with open(fp) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def available_cpus():
+    """Returns the number of CPUs the plugin can use
+
+    Returns
+    -------
+    int
+        The number of CPUs of the affinity mask, limited by the CPU quota of
+        the cgroup (v1 or v2) the plugin runs in
+    """
+    if sched_getaffinity is not None:
+        cpus = len(sched_getaffinity(0))
+    else:
+        cpus = cpu_count() or 1
+
+    quota = None
+    cpu_max = _read_cgroup('/sys/fs/cgroup/cpu.max')
+    if cpu_max is not None and not cpu_max.startswith('max'):
+        limit, period = cpu_max.split()[:2]
+        quota = float(limit) / float(period)
+    else:
+        limit = _read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if limit is not None and period is not None and int(limit) > 0:
+            quota = float(limit) / float(period)
+    if quota is not None:
+        cpus = min(cpus, int(ceil(quota)))
+
+    return max(1, cpus)
+
+
+def available_memory():
+    """Returns the memory the plugin can use
+
+    Returns
+    -------
+    int
+        The available memory of the node in bytes, limited by the memory
+        limit of the cgroup (v1 or v2) the plugin runs in
+    """
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except (IOError, OSError):
+        pass
+    if memory is None:
+        memory = sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES')
+
+    for fp in ('/sys/fs/cgroup/memory.max',
+               '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = _read_cgroup(fp)
+        if limit is not None and limit.isdigit():
+            memory = min(memory, int(limit))
+            break
+
+    return memory
+
+
+def _stream_log(stream, fp, tail):
+    """Copies the lines of a stream to a rotating log file
+
+    Parameters
+    ----------
+    stream : file
+        The binary stream, closed once exhausted
+    fp : str
+        The path to the log file
+    tail : collections.deque
+        Collects the last lines of the stream
+    """
+    f = open(fp, 'wb')
+    try:
+        for line in iter(stream.readline, b''):
+            if f.tell() and f.tell() + len(line) > LOG_MAX_BYTES:
+                f.close()
+                for i in range(LOG_BACKUPS, 1, -1):
+                    if exists('%s.%d' % (fp, i - 1)):
+                        rename('%s.%d' % (fp, i - 1), '%s.%d' % (fp, i))
+                rename(fp, '%s.1' % fp)
+                f = open(fp, 'wb')
+            f.write(line)
+            f.flush()
+            tail.append(line)
+    finally:
+        f.close()
+        stream.close()
+
+
+def _kill_group(proc):
+    """Terminates the process group of a command, see run_command"""
+    try:
+        killpg(proc.pid, SIGTERM)
+        try:
+            proc.wait(timeout=KILL_GRACE)
+        except TimeoutExpired:
+            pass
+        # children that ignored SIGTERM or outlived the command
+        killpg(proc.pid, SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    proc.wait()
+
+
+def _terminate(signum, frame):
+    """Kills the running commands and exits the job, see handle_sigterm"""
+    _CANCELLED.set()
+    with _RUNNING_LOCK:
+        running = list(_RUNNING)
+    for proc in running:
+        try:
+            killpg(proc.pid, SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+    # the command waited on by the main thread is killed for good by the
+    # finally of run_command
+    raise SystemExit(128 + signum)
+
+
+def handle_sigterm():
+    """Makes a SIGTERM of the job kill the commands it's running
+
+    Notes
+    -----
+    run_command starts each command in its own process group so that a
+    timeout kills all of its processes, which also keeps a SIGTERM sent to
+    the job's process group from reaching them. Once this is called, a
+    SIGTERM sends SIGTERM to the process group of every running command,
+    stops new commands from starting and exits the job. It has to be called
+    from the main thread.
+    """
+    signal(SIGTERM, _terminate)
+
+
+def run_command(argv, log_prefix, cwd=None, timeout=None, stdin=None,
+                stdout=None):
+    """Runs an external command
+
+    Parameters
+    ----------
+    argv : list of str
+        The command and its arguments
+    log_prefix : str
+        The path prefix of the logs, the outputs of the command are written to
+        <log_prefix>.stdout.log and <log_prefix>.stderr.log as they are
+        produced
+    cwd : str, optional
+        The working directory of the command
+    timeout : float, optional
+        The wall-clock seconds the command can run for, None for no limit
+    stdin : file, optional
+        The input of the command, nothing if None
+    stdout : file, optional
+        Where the standard output of the command is written instead of its
+        log, e.g. the output file of a filter
+
+    Returns
+    -------
+    str, str, int
+        The last lines of the standard output and error and the exit code,
+        127 if the command can't be started
+
+    Raises
+    ------
+    ValueError
+        If the command runs for longer than timeout, or the job was cancelled
+        before it started
+
+    Notes
+    -----
+    The command runs in its own process group, which is killed as a whole
+    if it times out or the job is interrupted while waiting on it, see
+    handle_sigterm.
+    """
+    tails = {'stdout': deque(maxlen=LOG_TAIL_LINES),
+             'stderr': deque(maxlen=LOG_TAIL_LINES)}
+    with _RUNNING_LOCK:
+        if _CANCELLED.is_set():
+            raise ValueError("%s was not started, the job was cancelled"
+                             % argv[0])
+        try:
+            proc = Popen(argv, cwd=cwd,
+                         stdin=DEVNULL if stdin is None else stdin,
+                         stdout=PIPE if stdout is None else stdout,
+                         stderr=PIPE, start_new_session=True)
+        except OSError as e:
+            # like a shell would, e.g. if the command is not installed
+            return '', str(e), 127
+        _RUNNING.add(proc)
+    streams = {'stderr': proc.stderr}
+    if stdout is None:
+        streams['stdout'] = proc.stdout
+    readers = [Thread(target=_stream_log, args=(
+        stream, '%s.%s.log' % (log_prefix, name), tails[name]))
+        for name, stream in streams.items()]
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    try:
+        proc.wait(timeout=timeout)
+    except TimeoutExpired:
+        timed_out = True
+    finally:
+        if proc.returncode is None:
+            _kill_group(proc)
+        with _RUNNING_LOCK:
+            _RUNNING.discard(proc)
+        for reader in readers:
+            reader.join()
+
+    std_out, std_err = [b''.join(tails[name]).decode('utf-8', 'replace')
+                        for name in ('stdout', 'stderr')]
+    if timed_out:
+        raise ValueError("%s timed out after %s seconds:\nStd out: %s\n"
+                         "Std err: %s" % (argv[0], timeout, std_out, std_err))
+    return std_out, std_err, proc.returncode
@@ -47,7 +47,7 @@ setup(name='qp-deblur',
       scripts=['scripts/configure_deblur', 'scripts/start_deblur',
                'scripts/generate_tree_from_fragments'],
       extras_require={'test': ["nose >= 0.10.1", "pep8"]},
-      install_requires=['click', 'scikit-bio', 'pandas', 'future',
+      install_requires=['click', 'numpy', 'scikit-bio', 'pandas', 'future',
                         'deblur>=1.1.0', 'qiita-files @ https://github.com/'
                         'qiita-spots/qiita-files/archive/master.zip',
                         'qiita_client @ https://github.com/qiita-spots/'